@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+
+"""asyncio engine for the chat server
+
+Speaks the same CHAT/1.0 protocol as the selectors engine in server.py and
+uses the same status codes and options, rooms, direct messages, history,
+compression and CHAT/2.0 are only served by the selectors engine. A room or
+direct message, or a command other than DISCONNECT, is answered with
+400 Unsupported. Start it with:
+
+    python3 server.py --engine asyncio
+
+The transports buffer outgoing data themselves, pause_writing and
+resume_writing tell us when a client crosses the high and low water marks.
+"""
+
+import asyncio
+import signal
+import time
+
+from server import ADDR, COMMANDS, FORMAT, FrameReader, isText, parseRegistration, getArgs, log
+
+clients = dict()  # clients: { Client Name: ChatProtocol }
+connections = set()
+handshakes = set()
+
+
+def broadcast(clientName, message):
+    """Broadcasts the message to all clients except for the sender
+
+    Args:
+        clientName (string): the registered nickname
+        message (string): the sent message
+    """
+    if clientName == '':
+        frame = f'{message}\n'.encode(FORMAT)
+    else:
+        frame = f'@{clientName}: {message}\n'.encode(FORMAT)
+
+    for name, protocol in list(clients.items()):
+        if name != clientName:
+            protocol.deliver(frame)
+
+
+class ChatProtocol(asyncio.BufferedProtocol):
+    """One client connection, from the handshake to the disconnect"""
+
+    def __init__(self, options):
+        self.options = options
+        self.reader = FrameReader()
+        self.transport = None
+        self.addr = None
+        self.name = None
+        self.state = 'handshaking'
+        self.timer = None
+        self.throttled = 0  # time the client became a slow consumer
+        self.dropped = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.addr = transport.get_extra_info('peername')
+        options = self.options
+
+        if (len(connections) >= options.max_connections or
+                len(handshakes) >= options.max_handshakes):
+            log.warning('busy', 'Server busy, rejecting client address: {addr}', addr=self.addr)
+            transport.write('503 Server busy\n'.encode(FORMAT))
+            transport.close()
+            self.state = 'closed'
+            return
+
+        log.debug('accept', 'Accepted connection from client address: {addr}', addr=self.addr)
+
+        transport.set_write_buffer_limits(high=options.high_water, low=options.low_water)
+        connections.add(self)
+        handshakes.add(self)
+        self.timer = asyncio.get_running_loop().call_later(
+            options.handshake_timeout, self.expire)
+
+    def get_buffer(self, sizehint):
+        return self.reader.buffer
+
+    def buffer_updated(self, nbytes):
+        self.reader.received(nbytes)
+
+        try:
+            frames = self.reader.frames()
+        except ValueError:
+            log.warning('too-long', 'Message from client address {addr} is too long', addr=self.addr)
+            self.transport.close()
+            return
+
+        for frame in frames:
+            if self.state == 'handshaking':
+                self.register(frame)
+            elif self.state == 'registered':
+                self.handleMessage(frame)
+            else:
+                break
+
+    def register(self, line):
+        """Completes the handshake with the registration line
+
+        Args:
+            line (bytes): the registration line
+        """
+        handshakes.discard(self)
+        self.timer.cancel()
+
+        # resume= is accepted but no token is given, a client that comes
+        # back registers like a new one
+
+        if isText(line):
+            controlMsg, username, _, _ = parseRegistration(
+                line.decode(FORMAT), clients, versions=('CHAT/1.0',), extensions={'resume': None})
+        else:
+            controlMsg, username = '400 Invalid registration', None
+        self.transport.write(f'{controlMsg}\n'.encode(FORMAT))
+
+        if username is None:
+            log.info('register', '{status} from client address: {addr}', status=controlMsg, addr=self.addr)
+            self.state = 'closing'
+            self.transport.close()
+            return
+
+        log.info('register', 'Connection to client estatblished, waiting to reveive messages '
+                 'from user "{name}" ... ', name=username)
+
+        self.name = username
+        self.state = 'registered'
+        clients[username] = self
+
+        log.info('register', 'Number of connected client:  {clients}', clients=len(clients))
+
+    def expire(self):
+        """Closes the connection if it has not registered in time"""
+        if self.state == 'handshaking':
+            log.info('register', 'Registration timed out for client address: {addr}', addr=self.addr)
+            handshakes.discard(self)
+            self.transport.write('408 Registration timeout\n'.encode(FORMAT))
+            self.state = 'closing'
+            self.transport.close()
+
+    def handleMessage(self, message):
+        """Handles a single framed message from a registered client
+
+        Only DISCONNECT and messages to everyone are served, anything
+        else gets a 400 rather than going out to everyone.
+
+        Args:
+            message (bytes): the message without its line terminator
+        """
+        if not isText(message):
+            self.reply('400 Invalid UTF-8')
+            return
+
+        if message.startswith(COMMANDS):
+            command = message.decode(FORMAT)
+            log.debug('command', 'Received message from user {name}: {text}', name=self.name, text=command)
+            if not command.startswith('DISCONNECT '):
+                self.reply('400 Unsupported')
+                return
+            self.state = 'closing'
+            self.transport.close()
+            return
+
+        # the header is @sender, or @sender #room or @sender @recipient
+        # which the selectors engine serves, everthing after the ': ' is
+        # the actual message
+
+        end = message.find(b': ')
+        if end < 0:
+            self.reply('400 Malformed message')
+            return
+        if len(message[:end].split()) > 1:
+            self.reply('400 Unsupported')
+            return
+
+        line = message[end + 2:].decode(FORMAT)
+
+        log.debug('message', 'Received message from user {name}: {text}', name=self.name, text=line)
+
+        broadcast(self.name, line)
+
+    def reply(self, status):
+        """Answers the client with a status line
+
+        Args:
+            status (string): e.g. 400 Unsupported
+        """
+        self.transport.write(f'{status}\n'.encode(FORMAT))
+
+    def deliver(self, frame):
+        """Writes a frame unless the client is a slow consumer
+
+        Args:
+            frame (bytes): the encoded message
+        """
+        if not self.throttled:
+            self.transport.write(frame)
+            return
+
+        self.dropped += 1
+        if (self.options.slow_consumer == 'evict' and
+                time.monotonic() - self.throttled > self.options.slow_consumer_grace):
+            log.warning('slow-consumer', 'Evicting slow consumer {name}, {queued} bytes queued',
+                        name=self.name, queued=self.transport.get_write_buffer_size())
+            self.state = 'closing'
+            self.transport.abort()
+
+    def pause_writing(self):
+        log.warning('slow-consumer', 'User {name} is a slow consumer, {queued} bytes queued',
+                    name=self.name, queued=self.transport.get_write_buffer_size())
+        self.throttled = time.monotonic()
+
+    def resume_writing(self):
+        log.info('slow-consumer', 'User {name} recovered, {dropped} messages dropped',
+                 name=self.name, dropped=self.dropped)
+        self.throttled = 0
+
+    def connection_lost(self, exc):
+        connections.discard(self)
+        handshakes.discard(self)
+        if self.timer:
+            self.timer.cancel()
+
+        if self.name is not None and clients.get(self.name) is self:
+            if self.state == 'registered':
+                log.info('disconnect', 'Received message from user {name}: DISCONNECT {name} CHAT/1.0',
+                         name=self.name)
+            log.info('disconnect', 'Disconnecting user {name}', name=self.name)
+            clients.pop(self.name)
+            log.info('disconnect', 'new connected client size: {clients}', clients=len(clients))
+
+        self.state = 'closed'
+
+
+async def serve(options):
+    """Runs the server until it is interrupted
+
+    Args:
+        options (Namespace): the parsed server options
+    """
+    loop = asyncio.get_running_loop()
+    server = await loop.create_server(
+        lambda: ChatProtocol(options), *ADDR, backlog=options.backlog)
+
+    log.info('startup', 'Will wait for client messages at port {port}',
+             port=server.sockets[0].getsockname()[1])
+
+    stopped = loop.create_future()
+
+    def signalHandler():
+        """Executed when a user press control + c"""
+        log.info('shutdown', 'Interrupt received, shutting down ...')
+
+        disconnectMsg = 'DISCONNECT CHAT/1.0'
+        broadcast('', disconnectMsg)
+        stopped.set_result(None)
+
+    loop.add_signal_handler(signal.SIGINT, signalHandler)
+
+    log.info('startup', 'Waiting for incoming client connections ...')
+
+    async with server:
+        await stopped
+
+        # closing a transport flushes what is buffered for it first
+
+        for protocol in list(connections):
+            protocol.transport.close()
+        for _ in range(100):
+            if not connections:
+                break
+            await asyncio.sleep(0.01)
+
+
+def main(options):
+    """Serves clients with the asyncio engine
+
+    Args:
+        options (Namespace): the parsed server options
+    """
+    log.configure(options.log_level, options.log_format, options.log_sample)
+    asyncio.run(serve(options))
+    log.close()
+
+
+if __name__ == '__main__':
+    main(getArgs())
@@ -0,0 +1,482 @@
+#!/usr/bin/env python3
+
+"""Load generator and latency benchmark for the chat servers
+
+Starts a server, connects N synthetic clients that speak the real
+REGISTER / message / DISCONNECT protocol, lets some of them send messages
+and measures how fast clients register, how many messages and deliveries
+per second get through, and the fan-out latency from send to receipt.
+Every message carries the time it was sent, the clients all live in this
+process, so they share the clock. Results are printed as JSON.
+
+    python3 bench.py --clients 200 --senders 10 --messages 100
+
+runs the benchmark against server.py and Sample Assignment 2/server.py,
+one after the other.
+
+    python3 bench.py --server server.py --idle 100000 --server-args "--max-connections 200000"
+
+holds 100000 registered clients open without sending anything instead, and
+reports how much memory the server process grew by per connection.
+
+    python3 bench.py --server server.py --cluster 3 --clients 300
+
+starts three server.py processes linked into a federated cluster and
+spreads the clients over them, every broadcast has to cross the peer links.
+"""
+
+import subprocess
+import argparse
+import tempfile
+import resource
+import asyncio
+import signal
+import socket
+import json
+import time
+import sys
+import os
+import re
+
+FORMAT = 'utf-8'
+HERE = os.path.dirname(os.path.abspath(__file__))
+SERVERS = ['server.py', os.path.join('Sample Assignment 2', 'server.py')]
+PERCENTILES = {'p50': 0.50, 'p90': 0.90, 'p99': 0.99, 'p999': 0.999}
+IDLE_BATCH = 500    # idle clients connecting at once, below the server's --max-handshakes
+
+
+def getArgs():
+    """Gets and parses the benchmark options
+
+    Returns:
+        [Namespace]: the parsed options
+    """
+    parser = argparse.ArgumentParser(description='Benchmarks chat servers with synthetic clients')
+    parser.add_argument('--server', action='append', dest='servers',
+                        help='server script to start and benchmark, may be repeated '
+                             '(default: server.py and the sample server)')
+    parser.add_argument('--server-args', default='',
+                        help='extra arguments for the server scripts, e.g. "--workers 4"')
+    parser.add_argument('--connect',
+                        help='benchmark a running server at host:port instead of starting one')
+    parser.add_argument('--clients', type=int, default=100,
+                        help='synthetic clients to connect')
+    parser.add_argument('--senders', type=int, default=10,
+                        help='clients that send messages, every client receives')
+    parser.add_argument('--messages', type=int, default=100,
+                        help='messages per sender')
+    parser.add_argument('--rate', type=float, default=50,
+                        help='messages per second per sender, 0 to send as fast as possible')
+    parser.add_argument('--size', type=int, default=64,
+                        help='bytes of text per message')
+    parser.add_argument('--timeout', type=float, default=30,
+                        help='seconds to wait for the deliveries after the last send')
+    parser.add_argument('--idle', type=int, default=0,
+                        help='hold this many idle clients open and measure the server\'s '
+                             'memory per connection instead of sending messages')
+    parser.add_argument('--cluster', type=int, default=1,
+                        help='start this many servers linked into a federated cluster and '
+                             'spread the clients over them')
+    parser.add_argument('--output', help='file to write the JSON results to, default stdout')
+
+    args = parser.parse_args()
+    if not 0 < args.senders <= args.clients:
+        parser.error('--senders must be between 1 and --clients')
+    if args.idle and args.connect:
+        parser.error('--idle measures a server bench.py starts, not --connect')
+    if args.cluster > 1 and (args.connect or args.idle or not args.servers):
+        parser.error('--cluster needs --server, the sample server cannot federate, '
+                     'and does not go with --connect or --idle')
+    return args
+
+
+class BenchClient(asyncio.Protocol):
+    """A synthetic client that registers, sends on request and records latencies"""
+
+    def __init__(self, name, run):
+        self.name = name
+        self.run = run
+        self.transport = None
+        self.inbound = bytearray()
+        self.registered = asyncio.get_running_loop().create_future()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.write(f'REGISTER {self.name} CHAT/1.0\n'.encode(FORMAT))
+
+    def data_received(self, chunk):
+        self.inbound += chunk
+        now = time.monotonic_ns()
+
+        end = self.inbound.find(b'\n')
+        start = 0
+        while end >= 0:
+            self.handleLine(bytes(self.inbound[start:end]).rstrip(b'\r'), now)
+            start = end + 1
+            end = self.inbound.find(b'\n', start)
+        del self.inbound[:start]
+
+    def handleLine(self, line, now):
+        """Handles one line from the server
+
+        Args:
+            line (bytes): the line without its terminator
+            now (int): time.monotonic_ns() when it arrived
+        """
+        if line.startswith(b'PING '):
+            self.transport.write(b'PONG ' + line[5:] + b'\n')
+            return
+
+        if not self.registered.done():
+            if line.startswith(b'200'):
+                self.registered.set_result(now)
+            else:
+                self.registered.set_exception(
+                    ConnectionError(f'{self.name}: {line.decode(FORMAT, "replace")}'))
+            return
+
+        # @sender: <sent at> <padding>
+
+        _, _, text = line.partition(b': ')
+        stamp = text.split(b' ', 1)[0]
+        if stamp.isdigit():
+            self.run.delivered(now - int(stamp))
+
+    def connection_lost(self, exc):
+        if not self.registered.done():
+            self.registered.set_exception(ConnectionError(f'{self.name}: connection lost'))
+
+    def send(self, padding):
+        """Sends a message stamped with the current time
+
+        Args:
+            padding (string): text that brings the message up to its size
+        """
+        stamp = time.monotonic_ns()
+        self.transport.write(f'@{self.name}: {stamp} {padding}\n'.encode(FORMAT))
+
+    def disconnect(self):
+        """Says goodbye the way client.py does and closes the connection"""
+        self.transport.write(f'DISCONNECT {self.name} CHAT/1.0\n'.encode(FORMAT))
+        self.transport.close()
+
+
+class Run:
+    """The measurements of one benchmark run"""
+
+    def __init__(self, expected):
+        self.expected = expected
+        self.latencies = []     # nanoseconds from send to receipt, one per delivery
+        self.lastDelivery = 0
+        self.complete = asyncio.get_running_loop().create_future()
+
+    def delivered(self, latency):
+        """Records a delivery
+
+        Args:
+            latency (int): nanoseconds since the message was sent
+        """
+        self.latencies.append(latency)
+        self.lastDelivery = time.monotonic_ns()
+        if len(self.latencies) >= self.expected and not self.complete.done():
+            self.complete.set_result(None)
+
+
+def percentiles(values):
+    """Summarises latencies in milliseconds
+
+    Args:
+        values (list): latencies in nanoseconds
+
+    Returns:
+        [dict]: the mean, max and PERCENTILES, empty without values
+    """
+    if not values:
+        return {}
+    values = sorted(values)
+    summary = {name: values[min(len(values) - 1, int(len(values) * q))] / 1e6
+               for name, q in PERCENTILES.items()}
+    summary['max'] = values[-1] / 1e6
+    summary['mean'] = sum(values) / len(values) / 1e6
+    return summary
+
+
+async def bench(host, ports, options):
+    """Runs the benchmark against a server that is up
+
+    Args:
+        host (string): the server address
+        ports (list): the server port, or the ports of every server of a cluster
+        options (Namespace): the parsed benchmark options
+
+    Returns:
+        [dict]: the results
+    """
+    loop = asyncio.get_running_loop()
+    run = Run(options.senders * options.messages * (options.clients - 1))
+
+    # connect and register every client at once
+
+    started = time.monotonic_ns()
+    clients = []
+    for n in range(options.clients):
+        _, client = await loop.create_connection(
+            lambda n=n: BenchClient(f'bench{n}', run), host, ports[n % len(ports)])
+        clients.append(client)
+    registeredAt = await asyncio.gather(*(client.registered for client in clients))
+    connectSeconds = (max(registeredAt) - started) / 1e9
+
+    # the first clients send, at a fixed rate each, everybody receives
+
+    padding = 'x' * max(0, options.size - 20)
+    interval = 1 / options.rate if options.rate else 0
+
+    async def sender(client):
+        for _ in range(options.messages):
+            client.send(padding)
+            await asyncio.sleep(interval)
+
+    sendStarted = time.monotonic_ns()
+    await asyncio.gather(*(sender(client) for client in clients[:options.senders]))
+    sendSeconds = (time.monotonic_ns() - sendStarted) / 1e9
+
+    try:
+        await asyncio.wait_for(asyncio.shield(run.complete), options.timeout)
+    except asyncio.TimeoutError:
+        pass
+    deliverySeconds = ((run.lastDelivery or time.monotonic_ns()) - sendStarted) / 1e9
+
+    for client in clients:
+        client.disconnect()
+
+    sent = options.senders * options.messages
+    return {
+        'clients': options.clients,
+        'senders': options.senders,
+        'messageSize': options.size,
+        'rate': options.rate,
+        'connect': {
+            'seconds': connectSeconds,
+            'perSecond': options.clients / connectSeconds if connectSeconds else None,
+        },
+        'messages': {
+            'sent': sent,
+            'seconds': sendSeconds,
+            'perSecond': sent / sendSeconds if sendSeconds else None,
+        },
+        'deliveries': {
+            'expected': run.expected,
+            'received': len(run.latencies),
+            'seconds': deliverySeconds,
+            'perSecond': len(run.latencies) / deliverySeconds if deliverySeconds else None,
+        },
+        'latencyMs': percentiles(run.latencies),
+    }
+
+
+async def idle(host, port, pid, options):
+    """Holds idle clients open and measures what they cost the server
+
+    The clients connect in batches below the server's handshake limit and
+    stay registered without sending anything.
+
+    Args:
+        host (string): the server address
+        port (int): the server port
+        pid (int): the server process
+        options (Namespace): the parsed benchmark options
+
+    Returns:
+        [dict]: the results
+    """
+    loop = asyncio.get_running_loop()
+    run = Run(0)
+
+    before = residentBytes(pid)
+    started = time.monotonic_ns()
+    clients = []
+    for start in range(0, options.idle, IDLE_BATCH):
+        batch = []
+        for n in range(start, min(options.idle, start + IDLE_BATCH)):
+            _, client = await loop.create_connection(
+                lambda n=n: BenchClient(f'idle{n}', run), host, port)
+            batch.append(client)
+        await asyncio.gather(*(client.registered for client in batch))
+        clients.extend(batch)
+    connectSeconds = (time.monotonic_ns() - started) / 1e9
+
+    # let the server settle, then look at it
+
+    await asyncio.sleep(1)
+    after = residentBytes(pid)
+
+    for client in clients:
+        client.disconnect()
+
+    return {
+        'idleClients': options.idle,
+        'connect': {
+            'seconds': connectSeconds,
+            'perSecond': options.idle / connectSeconds if connectSeconds else None,
+        },
+        'serverMemory': {
+            'beforeBytes': before,
+            'afterBytes': after,
+            'perConnectionBytes': (after - before) / options.idle if after is not None else None,
+        },
+    }
+
+
+def residentBytes(pid):
+    """Reads the resident set size of a process from /proc
+
+    Args:
+        pid (int): the process
+
+    Returns:
+        [int]: bytes, None where there is no /proc
+    """
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def startServer(script, extraArgs, announces=(r'at port (\d+)',)):
+    """Starts a server script and waits for the port it announces
+
+    The server's output goes to a temporary file, a pipe nobody reads
+    would stall it once full.
+
+    Args:
+        script (string): path of the server script
+        extraArgs (list): extra command line arguments
+        announces (tuple): patterns of the ports to wait for
+
+    Returns:
+        [Popen]: the server process
+        [int]: the port it listens on, one per pattern in announces
+    """
+    log = tempfile.TemporaryFile('w+')
+    process = subprocess.Popen(
+        [sys.executable, '-u', os.path.basename(script), *extraArgs],
+        cwd=os.path.dirname(os.path.abspath(script)), stdout=log, stderr=subprocess.STDOUT, text=True)
+
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        time.sleep(0.05)
+        log.seek(0)
+        output = log.read()
+        found = [re.search(pattern, output) for pattern in announces]
+        if all(found):
+            return (process, *(int(match.group(1)) for match in found))
+        if process.poll() is not None:
+            break
+
+    process.kill()
+    log.seek(0)
+    raise RuntimeError(f'{script} did not start:\n{log.read()}')
+
+
+def startCluster(script, extraArgs, count):
+    """Starts servers that link to every server started before them
+
+    Args:
+        script (string): path of the server script
+        extraArgs (list): extra command line arguments
+        count (int): how many servers
+
+    Returns:
+        [list]: the server processes
+        [list]: the ports they listen on for clients
+    """
+    host = socket.gethostbyname(socket.gethostname())
+    processes, ports, peerPorts = [], [], []
+    try:
+        for n in range(count):
+            peers = [f'--peer={host}:{peerPort}' for peerPort in peerPorts]
+            process, port, peerPort = startServer(
+                script, [*extraArgs, '--node-name', f'node{n}', '--peer-port', '0', *peers],
+                (r'at port (\d+)', r'peers on port (\d+)'))
+            processes.append(process)
+            ports.append(port)
+            peerPorts.append(peerPort)
+    except RuntimeError:
+        for process in processes:
+            stopServer(process)
+        raise
+
+    # let the last links say HELLO before the clients register
+
+    time.sleep(0.5)
+    return processes, ports
+
+
+def stopServer(process):
+    """Interrupts a server like control + c would, then makes sure it is gone
+
+    Args:
+        process (Popen): the server process
+    """
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def main():
+    options = getArgs()
+
+    # every client takes a file descriptor here and one in the server
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    results = []
+
+    if options.connect:
+        host, _, port = options.connect.rpartition(':')
+        result = asyncio.run(bench(host, [int(port)], options))
+        result['server'] = options.connect
+        results.append(result)
+
+    else:
+        # server.py binds to the address of the host name, the sample server to all of them
+
+        host = socket.gethostbyname(socket.gethostname())
+        for script in options.servers or [os.path.join(HERE, server) for server in SERVERS]:
+            if options.cluster > 1:
+                processes, ports = startCluster(script, options.server_args.split(), options.cluster)
+            else:
+                process, port = startServer(script, options.server_args.split())
+                processes, ports = [process], [port]
+            try:
+                if options.idle:
+                    result = asyncio.run(idle(host, ports[0], processes[0].pid, options))
+                else:
+                    result = asyncio.run(bench(host, ports, options))
+            finally:
+                for process in processes:
+                    stopServer(process)
+            result['server'] = os.path.relpath(script, HERE)
+            if options.cluster > 1:
+                result['cluster'] = options.cluster
+            results.append(result)
+
+    output = json.dumps({'runs': results}, indent=2)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
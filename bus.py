@@ -0,0 +1,235 @@
+"""Local message bus between the worker processes of a multi-process server
+
+Every worker is connected to the parent process through a Unix domain
+socket pair. The parent runs the hub: it owns the cluster-wide set of
+registered nicknames, relays broadcasts from one worker to all the others,
+room messages to the workers that have members in the room and direct
+messages to the worker of the recipient.
+
+Messages on the bus are framed like CHAT/2.0: a one-byte message kind and
+a four-byte payload length, followed by the payload.
+"""
+
+import selectors
+
+from protocol import encode, splitFrames
+
+MAX_MESSAGE_SIZE = 1024 * 1024
+
+# bytes the hub queues for a worker before it drops chat messages for it,
+# and the level the queue has to drain to until it takes them again
+HIGH_WATER_MARK = 4 * 1024 * 1024
+LOW_WATER_MARK = 1024 * 1024
+
+# message kinds
+CLAIM = 1           # worker -> hub: reserve a nickname
+GRANT = 2           # hub -> worker: the nickname is yours
+DENY = 3            # hub -> worker: the nickname is taken
+RELEASE = 4         # worker -> hub: the nickname is free again
+FRAME = 5           # worker -> hub -> workers: deliver a frame to every local client
+SUBSCRIBE = 6       # worker -> hub: the worker has members in a room
+UNSUBSCRIBE = 7     # worker -> hub: the worker's last member left a room
+ROOM_FRAME = 8      # worker -> hub -> subscribed workers: room name, a space, the frame
+DIRECT = 9          # worker -> hub -> worker: recipient, a space, the frame
+NO_RECIPIENT = 10   # hub -> worker: a DIRECT payload whose recipient is not registered
+
+# the frames on the bus are CHAT/2.0 DELIVER bodies, every worker encodes
+# them for the protocol versions of its own clients
+
+CHAT = (FRAME, ROOM_FRAME, DIRECT)  # the kinds a slow worker may miss, the others keep the workers in sync
+
+
+class BusReader:
+    """Splits the byte stream of a bus link into messages.
+
+    Works like server.FrameReader, but frames are length-prefixed instead
+    of newline-terminated so payloads may contain any byte.
+    """
+
+    def __init__(self, size=65536):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.pending = bytearray()
+
+    def fill(self, sock):
+        """Receives whatever the socket has ready with a single syscall.
+
+        Args:
+            sock (socket object): the link to read from
+
+        Returns:
+            [int]: the number of bytes read, 0 when the other side is gone
+        """
+        nbytes = sock.recv_into(self.buffer)
+        self.pending += self.view[:nbytes]
+        return nbytes
+
+    def messages(self):
+        """Removes every complete message from the buffer.
+
+        Returns:
+            [list]: (kind, payload) tuples
+        """
+        return splitFrames(self.pending, MAX_MESSAGE_SIZE)
+
+
+class HubLink:
+    """The hub's end of the link to one worker
+
+    The hub never blocks on a worker. What the link does not take at once
+    waits in the outbox for EVENT_WRITE. A worker whose outbox grows past
+    HIGH_WATER_MARK is a slow consumer, chat messages for it are dropped
+    until the outbox drains below LOW_WATER_MARK, like the clients of a
+    worker. Nickname and room messages are always queued.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.reader = BusReader()
+        self.outbox = bytearray()
+        self.writing = False        # whether EVENT_WRITE is registered
+        self.throttled = False
+
+    def queue(self, message):
+        """Queues an encoded bus message, unless the worker is a slow consumer
+
+        Args:
+            message (bytes): the encoded bus message
+        """
+        if self.throttled and message[0] in CHAT:
+            return
+        self.outbox += message
+        if len(self.outbox) > HIGH_WATER_MARK:
+            self.throttled = True
+
+    def flush(self, sel):
+        """Sends as much of the outbox as the link takes without blocking
+
+        Args:
+            sel (selector): the hub's selector, to wait for EVENT_WRITE with
+        """
+        try:
+            sent = self.sock.send(self.outbox)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            sent = len(self.outbox)     # the worker is gone, reading the link tells
+        del self.outbox[:sent]
+
+        if self.throttled and len(self.outbox) <= LOW_WATER_MARK:
+            self.throttled = False
+
+        writing = bool(self.outbox)
+        if writing != self.writing:
+            self.writing = writing
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if writing else 0)
+            sel.modify(self.sock, events, self)
+
+
+def runHub(links):
+    """Relays bus messages between the workers until all of them are gone
+
+    Args:
+        links (list): the parent ends of the worker socket pairs
+    """
+    sel = selectors.DefaultSelector()
+    owners = dict()  # owners: { Client Name: HubLink }
+    subscribers = dict()  # subscribers: { Room Name: set of HubLinks }
+
+    for link in links:
+        link.setblocking(False)
+        sel.register(link, selectors.EVENT_READ, HubLink(link))
+
+    while sel.get_map():
+        for key, mask in sel.select():
+            hub = key.data
+
+            if mask & selectors.EVENT_WRITE:
+                hub.flush(sel)
+            if not mask & selectors.EVENT_READ:
+                continue
+
+            try:
+                received = hub.reader.fill(hub.sock)
+            except BlockingIOError:
+                continue
+            except ConnectionError:
+                received = 0
+
+            # a worker that went away takes its nicknames with it
+
+            if not received:
+                sel.unregister(hub.sock)
+                hub.sock.close()
+                for name in [name for name, owner in owners.items() if owner is hub]:
+                    del owners[name]
+                for room in list(subscribers):
+                    unsubscribe(subscribers, room, hub)
+                continue
+
+            for kind, payload in hub.reader.messages():
+                if kind == CLAIM:
+                    if payload in owners:
+                        hub.queue(encode(DENY, payload))
+                    else:
+                        owners[payload] = hub
+                        hub.queue(encode(GRANT, payload))
+
+                elif kind == RELEASE:
+                    if owners.get(payload) is hub:
+                        del owners[payload]
+
+                elif kind == SUBSCRIBE:
+                    subscribers.setdefault(payload, set()).add(hub)
+
+                elif kind == UNSUBSCRIBE:
+                    unsubscribe(subscribers, payload, hub)
+
+                elif kind == FRAME:
+                    relay(encode(FRAME, payload), hub,
+                          [key.data for key in sel.get_map().values()])
+
+                elif kind == ROOM_FRAME:
+                    room = payload[:payload.index(b' ')]
+                    relay(encode(ROOM_FRAME, payload), hub, subscribers.get(room, ()))
+
+                elif kind == DIRECT:
+                    owner = owners.get(payload[:payload.index(b' ')])
+                    if owner is None:
+                        hub.queue(encode(NO_RECIPIENT, payload))
+                    else:
+                        owner.queue(encode(DIRECT, payload))
+
+        # everything queued during the pass goes out with one send per worker
+
+        for key in list(sel.get_map().values()):
+            if key.data.outbox and not key.data.writing:
+                key.data.flush(sel)
+
+
+def relay(message, origin, links):
+    """Queues a bus message for every link but the one it came from
+
+    Args:
+        message (bytes): the encoded bus message
+        origin (HubLink): the link the message came from
+        links (iterable): the candidate links
+    """
+    for link in links:
+        if link is not origin:
+            link.queue(message)
+
+
+def unsubscribe(subscribers, room, link):
+    """Removes a worker from the subscribers of a room
+
+    Args:
+        subscribers (dict): { Room Name: set of HubLinks }
+        room (bytes): the room name
+        link (HubLink): the worker link
+    """
+    links = subscribers.get(room)
+    if links is not None:
+        links.discard(link)
+        if not links:
+            del subscribers[room]
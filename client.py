@@ -1,16 +1,34 @@
 #!/usr/bin/env python3
 
 from urllib.parse import urlparse
+from collections import deque
 import selectors
 import argparse
 import socket
+import random
 import signal
 import fcntl
+import stat
+import time
 import sys
 import os
 
+import compression
+import protocol
+
 FORMAT = 'utf-8'
 BUFFER_SIZE = 2048
+RECV_BUFFER_SIZE = 65536    # bytes pulled from the socket per readiness event
+MAX_FRAME_SIZE = 65536
+RENDER_RATE = 1000          # messages per second written to the terminal at most
+PROMPT_INTERVAL = 0.2       # seconds between redraws of the prompt at least
+SKIPPED_INTERVAL = 1.0      # seconds between reports of skipped messages at least
+MAX_INFLATE = 1024 * 1024   # most bytes decompressed at a time, see read
+PIPELINE = 256              # script lines handed to the socket per batch at most
+SCRIPT_BACKLOG = 4096       # script lines read ahead of the socket at most
+LINGER = 5.0                # seconds to wait for the last echoes after the script
+RECONNECT_DELAY = 0.5       # seconds the first reconnect waits at most, doubling per attempt
+RECONNECT_MAX_DELAY = 30.0  # seconds a reconnect waits at most
 
 # create default selector for handling multiple IO
 sel = selectors.DefaultSelector()
@@ -22,9 +40,78 @@ fcntl.fcntl(sys.stdin, fcntl.F_SETFL, origFl | os.O_NONBLOCK)
 # the variable checks whether the client is signed in or not
 signIn = False
 
+# whether we were ever registered, a first registration that fails is final
+registered = False
+
+# reconnecting: the server address, the connection, None while we wait to
+# reconnect, the token that resumes our session, the attempts that failed
+# in a row and when the next one is due
+address = None
+connection = None
+reconnect = True
+resumeToken = None
+attempts = 0
+reconnectAt = 0
+
 # sotres their username globally
 username = None
 
+# the protocol version, CHAT/2.0 clients switch to binary frames once registered
+version = 'CHAT/1.0'
+binary = False
+
+# bytes received from the server that do not form a complete line yet
+inbound = bytearray()
+
+# the compression.Stream of the connection, if --compress was given
+compress = False
+stream = None
+
+# messages waiting for the next write to the terminal, and the ones that
+# did not fit in the render rate and were skipped
+output = []
+skipped = 0
+skippedReported = 0     # when skipped messages were last reported
+
+# the render rate is a token bucket, one token per message written
+renderRate = RENDER_RATE
+tokens = RENDER_RATE
+refilled = 0
+
+# whether the prompt is the last thing on the terminal, and when it was drawn
+promptShown = False
+promptDrawn = 0
+
+# bytes the socket did not take yet, and whether we wait for it to be writable
+outbound = bytearray()
+writing = False
+
+# headless mode (--script): the script file, None when it is a pipe read
+# through the selector, the lines read ahead, and whether the script ended
+headless = False
+script = None
+scriptLines = deque()
+scriptPartial = bytearray()
+scriptEnded = False
+scriptPaused = False
+
+# lines per second sent from the script, 0 to pipeline them, and when the
+# first line went out, when the next one is due and when the last one went
+sendRate = 0
+sent = 0
+started = 0
+nextSend = 0
+lastSent = 0
+
+# --observe: the second connection, which sees our broadcasts the way the
+# other clients do, the send times of the broadcasts it has not seen yet
+# and the round trips of the ones it has
+observer = None
+observerReady = False
+observerInbound = bytearray()
+pending = dict()    # pending: { Message Text: deque of send times }
+roundTrips = []
+
 
 def getArgs():
     """Gets and parses user's concole input
@@ -33,10 +120,32 @@ def getArgs():
         [string]: [the registered name]
         [string]: [the host name]
         [string]: [the port]
+        [string]: [the protocol version]
+        [bool]: [whether to ask for compression]
+        [float]: [messages per second written to the terminal at most]
+        [string]: [the script to send, - for stdin, None to run interactively]
+        [float]: [script lines sent per second, 0 for as fast as possible]
+        [bool]: [whether to measure round trips with an observer connection]
+        [bool]: [whether to reconnect when the connection is lost]
     """
     parser = argparse.ArgumentParser()
     parser.add_argument("name", help="Host name of server")
     parser.add_argument("address", help="Port number of server")
+    parser.add_argument("--protocol", choices=['CHAT/1.0', 'CHAT/2.0'], default='CHAT/1.0',
+                        help="CHAT/2.0 uses binary frames after registration")
+    parser.add_argument("--compress", action="store_true",
+                        help="compress the connection with zlib after registration")
+    parser.add_argument("--render-rate", type=float, default=RENDER_RATE,
+                        help="messages per second shown at most, the rest are counted as skipped")
+    parser.add_argument("--script", metavar="FILE",
+                        help="run headless: send FILE line by line, - for stdin, and exit at its end")
+    parser.add_argument("--send-rate", type=float, default=0,
+                        help="script lines sent per second, 0 to pipeline them as fast as possible")
+    parser.add_argument("--observe", action="store_true",
+                        help="measure the round trip of the script's broadcasts "
+                             "with a second connection named <name>-observer")
+    parser.add_argument("--no-reconnect", action="store_true",
+                        help="exit when the connection is lost instead of reconnecting")
 
     args = parser.parse_args()
     name = args.name
@@ -44,58 +153,232 @@ def getArgs():
 
     parsedURL = urlparse(address)
 
-    return name, parsedURL.hostname, parsedURL.port
+    if args.observe and not args.script:
+        parser.error('--observe needs --script')
+
+    return (name, parsedURL.hostname, parsedURL.port, args.protocol, args.compress,
+            args.render_rate, args.script, args.send_rate, args.observe, not args.no_reconnect)
 
 
 def read(sock):
     """Retrieves server data and print it to console
 
+    Every complete message of the readiness event is written to the
+    terminal with a single write.
+
     Args:
         sock (socket): the current socket/connection
     """
-    msg = sock.recv(BUFFER_SIZE).decode(FORMAT)
+    try:
+        chunk = sock.recv(RECV_BUFFER_SIZE)
+    except ConnectionError:
+        chunk = b''
 
-    if msg:
+    if not chunk:
+        connectionLost(sock, 'Disconnected from server')
+        return
 
-        # When a client opens the app for the first time, the app will send
-        # their entered nickname to the server. The server has three return options:
-        # 1. 200 Registration successful
-        # 2. 401 Client already registered
-        # 3. 400 Invalid registration
-        # The following if-else block checks whether the received message
-        # contains the above control message. If there isn't a control
-        # message, print it out to the console.
+    # CHAT/1.0 terminates every message with a newline, CHAT/2.0 sends
+    # length-prefixed frames after the registration line. A single recv
+    # may hold several messages or only part of one. A compressed
+    # connection is decompressed before any of that, MAX_INFLATE bytes at
+    # a time, and the messages of each step are handled before the next
 
-        if msg == '200 Registration successful':
+    while True:
+        if stream is not None and signIn:
+            try:
+                chunk = stream.decompress(chunk, MAX_INFLATE)
+            except ValueError:
+                connectionLost(sock, 'Invalid compressed data from server')
+                return
+        inbound.extend(chunk)
+
+        # a message may end the connection, the rest of the chunk goes with it
+
+        while not binary and connection is sock:
+            end = inbound.find(b'\n')
+            if end < 0:
+                break
+            line = bytes(inbound[:end]).rstrip(b'\r')
+            del inbound[:end + 1]
+            handleMessage(sock, line.decode(FORMAT, 'replace'))
+
+        if binary and connection is sock:
+            try:
+                frames = protocol.splitFrames(inbound, MAX_FRAME_SIZE)
+            except ValueError:
+                connectionLost(sock, 'Message from server is too long')
+                return
+            for kind, body in frames:
+                if kind == protocol.DELIVER:
+                    sender, target, text = body.split(b'\0', 2)
+                    header = b'@' + sender + (b' ' + target if target else b'')
+                    body = header + b': ' + text
+                handleMessage(sock, body.decode(FORMAT, 'replace'))
+                if connection is not sock:
+                    break
+
+        if connection is not sock or stream is None or not signIn or not stream.tail:
+            break
+        chunk = b''
+
+    flushOutput()
+
+
+def handleMessage(sock, msg):
+    """Handles one message from the server
 
+    Args:
+        sock (socket): the current socket/connection
+        msg (string): the message without its line terminator
+    """
+
+    # When a client opens the app for the first time, the app will send
+    # their entered nickname to the server. The server has five return options:
+    # 1. 200 Registration successful
+    # 2. 401 Client already registered
+    # 3. 400 Invalid registration
+    # 4. 408 Registration timeout
+    # 5. 503 Server busy
+    # A client that asked for a resume token gets 200 Resume <token> next.
+    # Idle clients also get PING <token> <version>, answered with PONG.
+    # The following if-else block checks whether the received message
+    # contains the above control message. If there isn't a control
+    # message, print it out to the console.
+
+    global signIn, binary, registered, attempts, resumeToken
+
+    if msg == '200 Registration successful':
+
+        if registered:
+            msg = 'Reconnected to server.  Ready for messageing!\n'
+        else:
             msg = 'Connection to server established. Sending intro message...\nRegistration successful.  Ready for messageing!\n'
-            print(msg)
+        print(msg)
+
+        # the variable checks whether the client is signed in or not
+        # (registered successfully), since the nickname is available
+        # we turn it to True
 
-            # the variable checks whether the client is signed in or not
-            # (registered successfully), since the nickname is available
-            # we turn it to True
+        signIn = True
+        registered = True
+        attempts = 0
+        binary = version == 'CHAT/2.0'
 
-            global signIn
-            signIn = True
+        # whatever came after the registration answer is compressed already
 
-            # asks client for console input
+        if stream is not None:
+            try:
+                inbound[:] = stream.decompress(bytes(inbound), MAX_INFLATE)
+            except ValueError:
+                connectionLost(sock, 'Invalid compressed data from server')
+                return
+
+        # asks client for console input, or starts on the script
+
+        if not headless:
             sel.register(sys.stdin, selectors.EVENT_READ, getStdinInput)
+        elif script is None and not scriptEnded and not scriptPaused:
+            sel.register(sys.stdin, selectors.EVENT_READ, readScript)
 
-        elif msg in ['401 Client already registered', '400 Invalid registration', 'DISCONNECT CHAT/1.0']:
-            print(f'\n{msg} ... Please try again later ')
-            sel.unregister(sock)
-            sock.close()
-            sys.exit(0)
+    elif msg.startswith('200 Resume '):
 
-        else:
-            print()
-            print(msg)
+        # the token that gets our nickname and missed messages back after
+        # a lost connection
+
+        resumeToken = msg.split()[2]
+
+    elif msg.startswith('PING '):
+
+        # the server checks that we are still here
+
+        token = msg.split()[1]
+        send(sock, [encodeCommand(f'PONG {token} {version}')])
+
+    elif msg in ['401 Client already registered', '400 Invalid registration']:
+        connectionLost(sock, msg, final=True)
+
+    elif msg in ['408 Registration timeout', '503 Server busy', 'DISCONNECT CHAT/1.0']:
+        connectionLost(sock, msg)
 
     else:
-        print('\nDisconnected from server ... exiting!')
-        sel.unregister(sock)
-        sock.close()
-        sys.exit(0)
+        render(msg)
+
+
+def render(msg):
+    """Queues a message for the terminal, or counts it as skipped
+
+    A terminal shows a few thousand lines a second at best. Messages over
+    the render rate are skipped rather than queued, so a busy room never
+    makes the client fall behind the socket.
+
+    Args:
+        msg (string): the message
+    """
+    global skipped, tokens
+
+    if refill() >= 1:
+        tokens -= 1
+        output.append(msg)
+    else:
+        skipped += 1
+
+
+def refill():
+    """Adds the tokens earned since the last call to the render bucket
+
+    Returns:
+        [float]: the tokens available
+    """
+    global tokens, refilled
+
+    now = time.monotonic()
+    tokens = min(renderRate, tokens + (now - refilled) * renderRate)
+    refilled = now
+    return tokens
+
+
+def flushOutput():
+    """Writes the queued messages to the terminal at once"""
+    global skipped, skippedReported, promptShown
+
+    now = time.monotonic()
+    if skipped and now - skippedReported >= SKIPPED_INTERVAL:
+        output.append(f'... {skipped} messages skipped')
+        skipped = 0
+        skippedReported = now
+
+    if not output:
+        return
+
+    # the prompt is on the last line, start below it
+
+    sys.stdout.write(('\n' if promptShown else '') + '\n'.join(output) + '\n')
+    sys.stdout.flush()
+    output.clear()
+    promptShown = False
+
+
+def drawPrompt():
+    """Redraws the prompt, at most once per PROMPT_INTERVAL
+
+    Returns:
+        [float]: seconds until the prompt may be drawn, None if it is up
+    """
+    global promptShown, promptDrawn
+
+    if not signIn or promptShown or headless:
+        return None
+
+    now = time.monotonic()
+    if now - promptDrawn < PROMPT_INTERVAL:
+        return promptDrawn + PROMPT_INTERVAL - now
+
+    sys.stdout.write('> ')
+    sys.stdout.flush()
+    promptShown = True
+    promptDrawn = now
+    return None
 
 
 def getStdinInput(stdin, conn):
@@ -105,51 +388,538 @@ def getStdinInput(stdin, conn):
         stdin (sys.stdin): standard input object
         conn (the socket): the socket
     """
-    line = stdin.read()
-    formattedMsg = f'@{username}: {line}'
-    conn.send(formattedMsg.rstrip().encode(FORMAT))
+    text = stdin.read()
+
+    # every line typed is its own message, the server splits on newlines
+
+    global promptShown
+
+    # the user pressed enter, the cursor is on a fresh line
+
+    promptShown = False
+
+    messages = [formatInput(line.rstrip()) for line in text.splitlines() if line.strip()]
+    if messages:
+        send(conn, messages)
+
+
+def send(conn, messages):
+    """Sends encoded messages to the server, compressed if negotiated
+
+    The socket is non-blocking, what it does not take right away waits in
+    the outbound buffer until it is writable again.
+
+    Args:
+        conn (the socket): the socket
+        messages (list): the encoded messages, compressed as one batch
+    """
+    if stream is not None:
+        outbound.extend(stream.compress(messages))
+    else:
+        outbound.extend(b''.join(messages))
+    flushOutbound(conn)
+
+
+def flushOutbound(conn, wait=False):
+    """Writes as much of the outbound buffer as the socket takes
+
+    Args:
+        conn (the socket): the socket
+        wait (bool): block until everything is written, before exiting
+    """
+    global writing
+
+    if wait:
+        conn.setblocking(True)
+        conn.sendall(outbound)
+        outbound.clear()
+        return
+
+    try:
+        written = conn.send(outbound) if outbound else 0
+    except BlockingIOError:
+        written = 0
+    except ConnectionError:
+        connectionLost(conn, 'Disconnected from server')
+        return
+    del outbound[:written]
+
+    # only ask for writability while there is something left to write
+
+    if bool(outbound) != writing:
+        writing = bool(outbound)
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if writing else 0)
+        sel.modify(conn, events, read)
+
+
+def connect():
+    """Connects to the server and registers, with our resume token if we have one
+
+    Raises:
+        OSError: if the server cannot be reached
+    """
+    global connection, stream, signIn, binary, writing
+
+    sock = socket.create_connection(address, timeout=RECONNECT_MAX_DELAY)
+    sock.setblocking(False)
+
+    # nothing of the last connection carries over, compression starts afresh
+
+    inbound.clear()
+    outbound.clear()
+    signIn = binary = writing = False
+    registrationMsg = f'REGISTER {username} {version}'
+    if compress:
+        stream = compression.Stream()
+        registrationMsg += ' compress=zlib'
+    if reconnect:
+        registrationMsg += f' resume={resumeToken or "new"}'
+    sock.sendall(f'{registrationMsg}\n'.encode(FORMAT))
+
+    sel.register(sock, selectors.EVENT_READ, read)
+    connection = sock
+
+
+def connectionLost(sock, reason, final=False):
+    """Closes a connection that ended, and exits or waits to reconnect
+
+    Args:
+        sock (socket): the connection
+        reason (string): why it ended
+        final (bool): whether the server refused us for good
+    """
+    global connection, signIn
+
+    flushOutput()
+    sel.unregister(sock)
+    sock.close()
+    connection = None
+    signIn = False
+    if sys.stdin in sel.get_map():
+        sel.unregister(sys.stdin)
+
+    if final or not reconnect or not registered:
+        print(f'\n{reason} ... exiting!')
+        if headless:
+            reportScript()
+        reportCompression()
+        sys.exit(0)
+
+    scheduleReconnect(reason)
+
+
+def scheduleReconnect(reason):
+    """Picks the time of the next reconnect attempt
+
+    The delay is drawn at random up to a limit that doubles with every
+    failed attempt, so clients that lost the same server do not all come
+    back at the same moment.
+
+    Args:
+        reason (string): why we are not connected
+    """
+    global attempts, reconnectAt
+
+    attempts += 1
+    delay = random.uniform(0, min(RECONNECT_MAX_DELAY, RECONNECT_DELAY * 2 ** attempts))
+    reconnectAt = time.monotonic() + delay
+    print(f'\n{reason} ... reconnecting in {delay:.1f} seconds')
+
+
+def reconnectDue():
+    """Reconnects once the delay is up
+
+    Returns:
+        [float]: seconds until the next attempt, None while connected
+    """
+    if connection is not None:
+        return None
+
+    now = time.monotonic()
+    if now < reconnectAt:
+        return reconnectAt - now
+
+    try:
+        connect()
+    except OSError as e:
+        scheduleReconnect(f'Could not reconnect: {e.strerror or e}')
+        return max(0, reconnectAt - time.monotonic())
+    return None
+
+
+def reportCompression():
+    """Prints how much compression saved and what it cost"""
+    if stream is not None:
+        print(f'Compression: {stream.counters.summary()}')
+
+
+def formatInput(line):
+    """Turns a typed line into a protocol message
+
+    /join room and /leave room enter and leave a room, /history n asks
+    for the last n broadcasts and /history since s for those after
+    sequence number s, /search word for broadcasts containing the word and
+    /stats for the server's statistics.
+    A line starting with #room goes to that room only,
+    a line starting with @name goes to that user only, anything else goes
+    to everyone.
+
+    Args:
+        line (string): the typed line
+
+    Returns:
+        [bytes]: the encoded message
+    """
+    command, _, rest = line.partition(' ')
+
+    if command in ['/join', '/leave'] and rest.strip():
+        room = rest.strip()
+        if not room.startswith('#'):
+            room = f'#{room}'
+        return encodeCommand(f'{command[1:].upper()} {room} {version}')
+
+    if command == '/history':
+        words = rest.split()
+        if len(words) == 2 and words[0] == 'since' and words[1].isdigit():
+            return encodeCommand(f'HISTORY SINCE {words[1]} {version}')
+        if len(words) == 1 and words[0].isdigit():
+            return encodeCommand(f'HISTORY LAST {words[0]} {version}')
+        if not words:
+            return encodeCommand(f'HISTORY LAST 20 {version}')
+
+    if command == '/stats' and not rest.strip():
+        return encodeCommand(f'STATS {version}')
+
+    if command == '/search' and len(rest.split()) == 1:
+        return encodeCommand(f'HISTORY SEARCH {rest.strip()} {version}')
+
+    if command[:1] in ['#', '@'] and len(command) > 1 and rest:
+        return encodeMessage(command, rest)
+
+    return encodeMessage('', line)
+
+
+def encodeMessage(target, text):
+    """Encodes a chat message in the negotiated protocol version
+
+    Args:
+        target (string): empty for everyone, #room or @nickname
+        text (string): the message
+
+    Returns:
+        [bytes]: the encoded message
+    """
+    if binary:
+        return protocol.encode(protocol.SEND, f'{target}\0{text}'.encode(FORMAT))
+
+    header = f'@{username} {target}' if target else f'@{username}'
+    return f'{header}: {text}\n'.encode(FORMAT)
+
+
+def encodeCommand(command):
+    """Encodes a command line in the negotiated protocol version
+
+    Args:
+        command (string): the command, e.g. JOIN #room CHAT/1.0
+
+    Returns:
+        [bytes]: the encoded command
+    """
+    if binary:
+        return protocol.encode(protocol.COMMAND, command.encode(FORMAT))
+    return f'{command}\n'.encode(FORMAT)
+
+
+def readScript(stdin, conn):
+    """Reads script lines from a pipe on stdin as they arrive
+
+    Reading stops while SCRIPT_BACKLOG lines wait to be sent, so a fast
+    producer is held back by the pipe instead of filling our memory.
+
+    Args:
+        stdin (sys.stdin): standard input object
+        conn (the socket): the socket
+    """
+    global scriptEnded, scriptPaused
+
+    try:
+        chunk = os.read(stdin.fileno(), RECV_BUFFER_SIZE)
+    except BlockingIOError:
+        return
+
+    if not chunk:
+        scriptEnded = True
+        sel.unregister(stdin)
+        chunk = b'\n'
+
+    scriptPartial.extend(chunk)
+    end = scriptPartial.rfind(b'\n')
+    if end >= 0:
+        for line in scriptPartial[:end].decode(FORMAT).splitlines():
+            if line.strip():
+                scriptLines.append(line.rstrip())
+        del scriptPartial[:end + 1]
+
+    if not scriptEnded and len(scriptLines) >= SCRIPT_BACKLOG:
+        sel.unregister(stdin)
+        scriptPaused = True
+
+
+def nextLine():
+    """Takes the next line of the script
+
+    Returns:
+        [string]: the line, None if none is available right now
+    """
+    global scriptEnded, scriptPaused
+
+    while not scriptLines and script is not None and not scriptEnded:
+        line = script.readline()
+        if not line:
+            scriptEnded = True
+        elif line.strip():
+            scriptLines.append(line.rstrip())
+
+    if scriptPaused and len(scriptLines) < SCRIPT_BACKLOG // 2:
+        sel.register(sys.stdin, selectors.EVENT_READ, readScript)
+        scriptPaused = False
+
+    return scriptLines.popleft() if scriptLines else None
+
+
+def sendScript(conn):
+    """Sends the script lines that are due
+
+    With a send rate every line has its time slot, without one the lines
+    go out in batches of PIPELINE whenever the socket took the previous
+    batch, without waiting for any answer.
+
+    Args:
+        conn (the socket): the socket
+
+    Returns:
+        [float]: seconds until the next line is due, None to wait for the
+        socket or the script
+    """
+    global sent, started, nextSend, lastSent
+
+    if not signIn or (observer is not None and not observerReady) or writing:
+        return None
+
+    now = time.monotonic()
+    if not started:
+        started = nextSend = now
+
+    messages = []
+    while len(messages) < PIPELINE and (not sendRate or nextSend <= now):
+        line = nextLine()
+        if line is None:
+            break
+        message = formatInput(line)
+        messages.append(message)
+
+        # only broadcasts come back to the observer
+
+        if observer is not None and message == encodeMessage('', line):
+            pending.setdefault(line.encode(FORMAT), deque()).append(now)
+        if sendRate:
+            nextSend += 1 / sendRate
+
+    if messages:
+        send(conn, messages)
+        sent += len(messages)
+        lastSent = now
+
+    if writing or not (scriptLines or script is not None and not scriptEnded):
+        return None
+    return max(0, nextSend - time.monotonic()) if sendRate else 0
+
+
+def readObserver(sock):
+    """Reads what the observer connection receives and times our broadcasts
+
+    The server never echoes a broadcast to its sender, the observer gets it
+    the way every other client does. A broadcast is matched to the oldest
+    send of the same text.
+
+    Args:
+        sock (socket): the observer connection
+    """
+    global observer, observerReady
+
+    chunk = sock.recv(RECV_BUFFER_SIZE)
+    if not chunk:
+        print('\nObserver disconnected from server')
+        sel.unregister(sock)
+        sock.close()
+        observer = None
+        return
+
+    now = time.monotonic()
+    observerInbound.extend(chunk)
+    prefix = f'@{username}: '.encode(FORMAT)
+
+    start = 0
+    end = observerInbound.find(b'\n')
+    while end >= 0:
+        line = bytes(observerInbound[start:end]).rstrip(b'\r')
+        start = end + 1
+        end = observerInbound.find(b'\n', start)
+
+        if line.startswith(prefix):
+            text = line[len(prefix):]
+            sends = pending.get(text)
+            if sends:
+                roundTrip = now - sends.popleft()
+                if not sends:
+                    del pending[text]
+                roundTrips.append(roundTrip)
+                render(f'RTT {roundTrip * 1000:.2f} ms: {text.decode(FORMAT, "replace")}')
+
+        elif line == b'200 Registration successful':
+            observerReady = True
+
+        elif line.startswith(b'PING '):
+            token = line.split()[1].decode(FORMAT, 'replace')
+            sock.sendall(f'PONG {token} CHAT/1.0\n'.encode(FORMAT))
+
+        elif not observerReady:
+            print(f'\nObserver: {line.decode(FORMAT, "replace")} ... exiting!')
+            sys.exit(1)
+
+    del observerInbound[:start]
+    flushOutput()
+
+
+def scriptDone():
+    """Checks whether the whole script was sent and the last echoes are in
+
+    Returns:
+        [bool]: whether the headless client can say goodbye
+    """
+    if not scriptEnded or scriptLines or outbound:
+        return False
+    return observer is None or not pending or time.monotonic() - lastSent >= LINGER
+
+
+def reportScript():
+    """Prints how fast the script went out and the round trips of its broadcasts"""
+    seconds = (lastSent - started) if sent > 1 else 0
+    summary = f'Sent {sent} messages in {seconds:.3f} s'
+    if seconds:
+        summary += f' ({sent / seconds:.0f} per second)'
+    print(summary)
+
+    if observer is None and not roundTrips:
+        return
+    lost = sum(len(sends) for sends in pending.values())
+    summary = f'Round trips: {len(roundTrips)} echoed, {lost} not seen'
+    if roundTrips:
+        ordered = sorted(roundTrips)
+        at = lambda q: ordered[min(len(ordered) - 1, int(len(ordered) * q))] * 1000
+        summary += (f', p50 {at(0.50):.2f} ms, p99 {at(0.99):.2f} ms,'
+                    f' max {ordered[-1] * 1000:.2f} ms')
+    print(summary)
+
+
+def finishScript(conn):
+    """Says goodbye on both connections once the script is done
+
+    Args:
+        conn (the socket): the socket, None if we are waiting to reconnect
+    """
+    flushOutput()
+    reportScript()
+    if conn is not None:
+        send(conn, [encodeCommand(f'DISCONNECT {username} {version}')])
+        flushOutbound(conn, wait=True)
+    if observer is not None:
+        observer.sendall(f'DISCONNECT {username}-observer CHAT/1.0\n'.encode(FORMAT))
+    reportCompression()
+    sys.exit(0)
 
 
 def main():
 
     # retrieves the arguments from the console
 
-    NAME, HOST, PORT = getArgs()
+    NAME, HOST, PORT, VERSION, COMPRESS, RATE, SCRIPT, SEND_RATE, OBSERVE, RECONNECT = getArgs()
     ADDR = (HOST, PORT)
 
-    global username
+    global username, version, compress, renderRate, tokens
+    global headless, script, sendRate, observer, address, reconnect
     username = NAME
+    version = VERSION
+    compress = COMPRESS
+    renderRate = tokens = RATE
+    address = ADDR
+    reconnect = RECONNECT
+
+    # a script given as - is a pipe read through the selector, unless stdin
+    # is redirected from a file, which never blocks and cannot be selected
 
-    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    client.connect(ADDR)
-    client.setblocking(False)
+    if SCRIPT is not None:
+        headless = True
+        sendRate = SEND_RATE
+        if SCRIPT != '-':
+            script = open(SCRIPT, encoding=FORMAT)
+        elif stat.S_ISREG(os.fstat(sys.stdin.fileno()).st_mode):
+            script = sys.stdin
+
+    connect()
 
     # Register our signal handler for shutting down.
     def signalHandler(sig, frame):
         """Executed when a user press control + c"""
-        formattedMsg = f'DISCONNECT {username} CHAT/1.0'
-        client.sendall(formattedMsg.encode(FORMAT))
+        if connection is not None:
+            send(connection, [encodeCommand(f'DISCONNECT {username} {version}')])
+            flushOutbound(connection, wait=True)
         print('Interrupt received, shutting down ...')
+        if headless:
+            reportScript()
+        reportCompression()
         sys.exit(0)
 
     signal.signal(signal.SIGINT, signalHandler)
 
-    registrationMsg = f'REGISTER {NAME} CHAT/1.0'
-    client.sendall(registrationMsg.encode(FORMAT))
-
     print('Connecting to server ...')
 
-    sel.register(client, selectors.EVENT_READ, read)
+    # the observer is a plain CHAT/1.0 client that only listens
+
+    if OBSERVE:
+        observer = socket.create_connection(ADDR)
+        observer.sendall(f'REGISTER {NAME}-observer CHAT/1.0\n'.encode(FORMAT))
+        observer.setblocking(False)
+        sel.register(observer, selectors.EVENT_READ, readObserver)
 
     while True:
 
-        # prompts (displays '>' sign) client input only if they are registered
+        # prompts (displays '>' sign) client input only if they are registered,
+        # and wakes up in time to report skipped messages
+
+        timeout = drawPrompt()
+        if skipped:
+            timeout = min(timeout or SKIPPED_INTERVAL, SKIPPED_INTERVAL)
+
+        # a headless client sends what is due, and wakes up for the next
+        # line or to give up on echoes that never come
 
-        if signIn:
-            sys.stdout.write('> ')
-            sys.stdout.flush()
+        if headless:
+            due = sendScript(connection)
+            if scriptDone():
+                finishScript(connection)
+            if scriptEnded and pending:
+                due = max(0, lastSent + LINGER - time.monotonic())
+            if due is not None:
+                timeout = due if timeout is None else min(timeout, due)
 
-        for k, _ in sel.select(timeout=None):
+        # a lost connection is retried once its backoff delay is up
+
+        due = reconnectDue()
+        if due is not None:
+            timeout = due if timeout is None else min(timeout, due)
+
+        for k, mask in sel.select(timeout=timeout):
 
             # notice that k.data here is a function,
             # since in Python, functions are first-class citizens
@@ -157,11 +927,24 @@ def main():
 
             callback = k.data
 
-            if callback == getStdinInput:
-                callback(k.fileobj, client)
+            # events of a connection that was lost earlier in this pass
+
+            if callback is read and k.fileobj is not connection:
+                continue
+
+            if mask & selectors.EVENT_WRITE:
+                flushOutbound(k.fileobj)
+            if not mask & selectors.EVENT_READ or callback is read and k.fileobj is not connection:
+                continue
+
+            if callback in [getStdinInput, readScript]:
+                callback(k.fileobj, connection)
             else:
                 callback(k.fileobj)
 
+        if skipped:
+            flushOutput()
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,190 @@
+"""Structured logging that stays off the event loop's hot path
+
+A record is a level, an event name, a message template and the fields that
+fill it in. Logging a record only compares the level, applies the sampling
+and puts the record on a bounded queue. A background thread formats
+whatever piled up and writes it with a single write, so a slow terminal or
+pipe never stalls the event loop. When the queue is full the record is
+dropped and counted instead.
+
+    log.debug('message', 'Received message from user {name}: {text}',
+              name='luca', text=b'hello')
+
+Bytes fields are decoded by the writer thread, not by the caller.
+"""
+
+import threading
+import queue
+import json
+import time
+import sys
+import os
+
+import metrics
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+NAMES = {level: name for name, level in LEVELS.items()}
+FORMATS = ('text', 'json')
+
+QUEUE_SIZE = 65536      # records waiting for the writer thread at most
+BATCH_SIZE = 1024       # records written per write call at most
+CLOSE_TIMEOUT = 5.0     # seconds close waits for the writer thread at most
+
+
+class EventLog:
+    """Levels, sampling and a writer thread in front of an output stream"""
+
+    def __init__(self, output=None, queueSize=QUEUE_SIZE):
+        """Creates the log and starts its writer thread
+
+        Args:
+            output (file): where the records go, sys.stdout if None
+            queueSize (int): records that may wait for the writer thread
+        """
+        self.output = output
+        self.queueSize = queueSize
+        self.level = INFO
+        self.format = 'text'
+        self.sample = dict()    # sample: { Event Name: keep one record in n }
+        self.seen = dict()      # seen: { Event Name: records of the event so far }
+        self.dropped = metrics.Counter()
+        self.start()
+
+        # a forked child only inherits the thread that forked, not the writer
+
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self.start)
+
+    def start(self):
+        """Starts the writer thread with an empty queue"""
+        self.queue = queue.Queue(self.queueSize)
+        self.thread = threading.Thread(target=self.run, name='event-log', daemon=True)
+        self.thread.start()
+
+    def configure(self, level='info', format='text', sample=None):
+        """Sets what is logged and how
+
+        Args:
+            level (string): the lowest level written, a key of LEVELS
+            format (string): 'text' for the message alone, 'json' for one
+                object per record with the level, event and fields
+            sample (dict): { event name: n } to keep one record in n of an event
+        """
+        self.level = LEVELS[level]
+        self.format = format
+        self.sample = dict(sample or {})
+        self.seen = dict()
+
+    def log(self, level, event, template, **fields):
+        """Queues a record for the writer thread, never blocks
+
+        Args:
+            level (int): DEBUG, INFO, WARNING or ERROR
+            event (string): what happened, the name sampling goes by
+            template (string): the message, str.format'ed with the fields
+            fields: the values of the record
+        """
+        if level < self.level:
+            return
+
+        every = self.sample.get(event) if self.sample else None
+        if every:
+            seen = self.seen.get(event, 0)
+            self.seen[event] = seen + 1
+            if seen % every:
+                return
+
+        try:
+            self.queue.put_nowait((time.time(), level, event, template, fields))
+        except queue.Full:
+            self.dropped.value += 1
+
+    def debug(self, event, template, **fields):
+        """Logs at DEBUG level, see log"""
+        if self.level <= DEBUG:
+            self.log(DEBUG, event, template, **fields)
+
+    def info(self, event, template, **fields):
+        """Logs at INFO level, see log"""
+        if self.level <= INFO:
+            self.log(INFO, event, template, **fields)
+
+    def warning(self, event, template, **fields):
+        """Logs at WARNING level, see log"""
+        if self.level <= WARNING:
+            self.log(WARNING, event, template, **fields)
+
+    def error(self, event, template, **fields):
+        """Logs at ERROR level, see log"""
+        self.log(ERROR, event, template, **fields)
+
+    def close(self):
+        """Writes what is still queued and stops the writer thread
+
+        A writer stuck on an output nobody reads is given up on after a few
+        seconds, the process is about to exit anyway.
+        """
+        deadline = time.monotonic() + CLOSE_TIMEOUT
+        try:
+            self.queue.put(None, timeout=CLOSE_TIMEOUT)
+        except queue.Full:
+            return  # the queue did not drain in time, the writer is stuck
+        self.thread.join(max(0, deadline - time.monotonic()))
+        if self.dropped.value and not self.thread.is_alive():
+            self.write([f'{self.dropped.value} log records dropped, the log queue was full'])
+
+    def run(self):
+        """The writer thread: formats and writes the queued records in batches"""
+        while True:
+            records = [self.queue.get()]
+            while records[-1] is not None and len(records) < BATCH_SIZE:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stopping = records[-1] is None
+            if stopping:
+                records.pop()
+            if records:
+                self.write([self.render(record) for record in records])
+            if stopping:
+                return
+
+    def render(self, record):
+        """Formats a record
+
+        Args:
+            record (tuple): (time, level, event, template, fields)
+
+        Returns:
+            [string]: the line, without the line terminator
+        """
+        stamp, level, event, template, fields = record
+        for name, value in fields.items():
+            if isinstance(value, bytes):
+                fields[name] = value.decode('utf-8', 'replace')
+        message = template.format(**fields) if fields else template
+
+        if self.format == 'text':
+            return message
+        return json.dumps({'time': round(stamp, 6), 'level': NAMES[level], 'event': event,
+                           'message': message, **fields}, default=str)
+
+    def write(self, lines):
+        """Writes lines to the output with one write and flushes it
+
+        Args:
+            lines (list): the formatted records
+        """
+        output = self.output or sys.stdout
+        try:
+            output.write('\n'.join(lines) + '\n')
+            output.flush()
+        except (OSError, ValueError):
+            pass    # the output went away, e.g. a closed pipe
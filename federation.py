@@ -0,0 +1,117 @@
+"""Server-to-server links between the nodes of a federated cluster
+
+Every server of a cluster has a unique node name and links to one or more
+of the others. A link is a TCP connection framed like the bus: a one-byte
+message kind and a four-byte payload length, followed by the payload. Both
+ends start with HELLO and their node name, then each tells the other every
+nickname it knows of with KNOWN.
+
+Nicknames, broadcasts and room messages are flooded: a node sends them to
+every link once, whoever has remote clients behind that link, and every
+node passes what it did not see before on to its other links. A flooded
+payload starts with the node it came from and a sequence number,
+
+    origin NUL seq NUL body
+
+and a node drops what it already saw from that origin, so the messages
+stop even where the links form a loop. Direct messages are not flooded,
+they follow the link the recipient's nickname was announced over.
+
+A nickname registered at two nodes at about the same time is kept by the
+node whose name sorts first, the other one disconnects its client.
+
+A lost link does not mean the nodes behind it are gone, there may be
+another way to them. The nodes at both ends flood RESYNC and every node
+announces its nicknames again. An announcement from the node a nickname is
+registered at came over working links, so it sets the way to the nickname.
+The nicknames whose way still leads over a lost link RESYNC_TIMEOUT later
+cannot be reached any more and are released.
+"""
+
+import time
+
+CONNECT_TIMEOUT = 2.0       # seconds to wait for a peer to accept a link
+RETRY_INTERVAL = 2.0        # seconds before a lost or refused link is tried again
+RESYNC_TIMEOUT = 2.0        # seconds the nodes have to announce again after a link is lost
+
+# message kinds
+HELLO = 1           # both ways, first on every link: the sender's node name
+KNOWN = 2           # both ways, after HELLO: a nickname, NUL, the node it is registered at
+ANNOUNCE = 3        # flooded: a nickname, NUL, the node it was registered at
+RELEASE = 4         # flooded: a nickname, NUL, the node that gave it up
+FRAME = 5           # flooded: a CHAT/2.0 DELIVER body, for everyone or for the #room in it
+DIRECT = 6          # towards the recipient's node: a CHAT/2.0 DELIVER body for @name
+NO_RECIPIENT = 7    # back towards the sender's node: a DIRECT body nobody took
+RESYNC = 8          # flooded, empty: a link was lost, every node announces its nicknames again
+
+FLOODED = (ANNOUNCE, RELEASE, FRAME, RESYNC)
+NAMES = {HELLO: 'hello', KNOWN: 'known', ANNOUNCE: 'announce', RELEASE: 'release',
+         FRAME: 'frame', DIRECT: 'direct', NO_RECIPIENT: 'no_recipient', RESYNC: 'resync'}
+
+
+class Flood:
+    """Numbers the messages a node floods and spots the ones it saw already.
+
+    A link is a TCP stream and every node passes a message on before the
+    ones it receives after it, so the messages of one origin reach a node
+    in the order they were sent along every path. The newest sequence
+    number seen per origin is all there is to remember. Sequence numbers
+    start at the clock, so a node that restarts is not taken for a replay
+    of itself.
+    """
+
+    def __init__(self, node):
+        self.node = node
+        self.seq = time.time_ns()
+        self.seen = dict()  # seen: { Node Name: newest sequence number }
+
+    def stamp(self, body):
+        """Wraps a message this node floods
+
+        Args:
+            body (bytes): the message
+
+        Returns:
+            [bytes]: the payload, origin and sequence number in front
+        """
+        self.seq += 1
+        return b'%s\0%d\0%s' % (self.node.encode('utf-8'), self.seq, body)
+
+    def accept(self, payload):
+        """Unwraps a flooded message, unless it was seen before
+
+        Args:
+            payload (bytes): the payload as received
+
+        Raises:
+            ValueError: if the payload has no origin and sequence number
+
+        Returns:
+            [tuple]: the node it came from and the message, None if this
+            node sent or saw it already
+        """
+        origin, seq, body = payload.split(b'\0', 2)
+        origin = origin.decode('utf-8')
+        seq = int(seq)
+        if origin == self.node or seq <= self.seen.get(origin, 0):
+            return None
+        self.seen[origin] = seq
+        return origin, body
+
+
+def parseAddress(text):
+    """Parses the address of a peer
+
+    Args:
+        text (string): host:port
+
+    Raises:
+        ValueError: if there is no port
+
+    Returns:
+        [tuple]: the host and the port
+    """
+    host, _, port = text.rpartition(':')
+    if not host:
+        raise ValueError(f'{text} is not host:port')
+    return host, int(port)
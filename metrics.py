@@ -0,0 +1,158 @@
+"""Counters, gauges and histograms, rendered in the Prometheus text format
+
+Updating a metric on the hot path is an attribute increment, or a bisect
+and two additions for a histogram, so the instrumentation stays on all the
+time. Gauges are functions that are only called when the metrics are read.
+"""
+
+import bisect
+
+# bucket upper bounds in seconds, from 10 microseconds to 1 second
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                   0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+class Counter:
+    """A number that only goes up, increment value directly"""
+
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+
+class LabeledCounter:
+    """Counters that share a name and differ in the value of one label"""
+
+    def __init__(self, label):
+        self.label = label
+        self.children = dict()  # children: { Label Value: Counter }
+
+    def labels(self, value):
+        """Returns the counter for a label value, e.g. a status code
+
+        Args:
+            value (string): the label value
+
+        Returns:
+            [Counter]: the counter, created on first use
+        """
+        counter = self.children.get(value)
+        if counter is None:
+            counter = self.children[value] = Counter()
+        return counter
+
+
+class Histogram:
+    """Counts observations in buckets with fixed upper bounds"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.bounds = tuple(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """Records an observation
+
+        Args:
+            value (float): the observed value, e.g. a duration in seconds
+        """
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Estimates a quantile as the upper bound of the bucket it falls in
+
+        Args:
+            q (float): the quantile, e.g. 0.99
+
+        Returns:
+            [float]: the estimate, None without observations, inf past the last bucket
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class Registry:
+    """The metrics of a process, in the order they were defined"""
+
+    def __init__(self):
+        self.metrics = []   # (name, help, type, metric) tuples
+
+    def counter(self, name, help, label=None):
+        """Defines a counter
+
+        Args:
+            name (string): the metric name, ending in _total
+            help (string): what it counts
+            label (string): a label name to get a LabeledCounter instead
+
+        Returns:
+            [Counter]: the counter
+        """
+        counter = LabeledCounter(label) if label else Counter()
+        self.metrics.append((name, help, 'counter', counter))
+        return counter
+
+    def gauge(self, name, help, read):
+        """Defines a gauge
+
+        Args:
+            name (string): the metric name
+            help (string): what it measures
+            read (function): returns the current value
+        """
+        self.metrics.append((name, help, 'gauge', read))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        """Defines a histogram
+
+        Args:
+            name (string): the metric name
+            help (string): what it measures
+            buckets (tuple): the bucket upper bounds, ascending
+
+        Returns:
+            [Histogram]: the histogram
+        """
+        histogram = Histogram(buckets)
+        self.metrics.append((name, help, 'histogram', histogram))
+        return histogram
+
+    def render(self):
+        """Renders every metric in the Prometheus text exposition format
+
+        Returns:
+            [string]: the exposition, one sample per line
+        """
+        lines = []
+        for name, help, kind, metric in self.metrics:
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+
+            if kind == 'gauge':
+                lines.append(f'{name} {metric()}')
+            elif kind == 'histogram':
+                seen = 0
+                for bound, count in zip(metric.bounds, metric.counts):
+                    seen += count
+                    lines.append(f'{name}_bucket{{le="{bound}"}} {seen}')
+                lines.append(f'{name}_bucket{{le="+Inf"}} {metric.count}')
+                lines.append(f'{name}_sum {metric.sum}')
+                lines.append(f'{name}_count {metric.count}')
+            elif isinstance(metric, LabeledCounter):
+                for value, counter in sorted(metric.children.items()):
+                    lines.append(f'{name}{{{metric.label}="{value}"}} {counter.value}')
+            else:
+                lines.append(f'{name} {metric.value}')
+
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,79 @@
+"""CHAT/2.0 framing, shared by server.py and client.py
+
+A client that registers with REGISTER <name> CHAT/2.0 gets the usual text
+status line back. Once registration succeeded, both sides switch to
+length-prefixed binary frames: a one-byte frame type and a four-byte body
+length, followed by the body. Nicknames and targets never contain a NUL
+byte, so NUL separates the fields of a body.
+"""
+
+import struct
+
+HEADER = struct.Struct('!BI')
+
+# frame types
+SEND = 1        # client -> server: target, NUL, text. The target is empty, #room or @name
+DELIVER = 2     # server -> client: sender, NUL, target, NUL, text
+COMMAND = 3     # client -> server: a command line, e.g. JOIN #room CHAT/2.0
+STATUS = 4      # server -> client: a status line, e.g. 200 Joined #room
+
+
+def encode(kind, body):
+    """Builds a frame
+
+    Args:
+        kind (int): the frame type
+        body (bytes): the frame body
+
+    Returns:
+        [bytes]: the header followed by the body
+    """
+    return HEADER.pack(kind, len(body)) + body
+
+
+def readFrames(buffer, maxSize):
+    """Reads every complete frame from the start of a buffer, without consuming it
+
+    Args:
+        buffer (memoryview): the received bytes
+        maxSize (int): the longest body accepted
+
+    Raises:
+        ValueError: if a frame announces a body longer than maxSize
+
+    Returns:
+        [list]: (frame type, body) tuples
+        [int]: the bytes the complete frames take up
+    """
+    frames = []
+    start = 0
+    while len(buffer) - start >= HEADER.size:
+        kind, length = HEADER.unpack_from(buffer, start)
+        if length > maxSize:
+            raise ValueError('frame exceeds the maximum size')
+        end = start + HEADER.size + length
+        if end > len(buffer):
+            break
+        frames.append((kind, bytes(buffer[start + HEADER.size:end])))
+        start = end
+    return frames, start
+
+
+def splitFrames(pending, maxSize):
+    """Removes every complete frame from the start of a buffer
+
+    Args:
+        pending (bytearray): the received bytes, consumed in place
+        maxSize (int): the longest body accepted
+
+    Raises:
+        ValueError: if a frame announces a body longer than maxSize
+
+    Returns:
+        [list]: (frame type, body) tuples
+    """
+    with memoryview(pending) as view:
+        frames, start = readFrames(view, maxSize)
+    if start:
+        del pending[:start]
+    return frames
@@ -0,0 +1,346 @@
+"""Durable, append-only log of broadcasts, used by server.py --log-dir
+
+The log is a directory of segments. A segment is a pair of files named
+after the sequence number of its first record:
+
+    00000000000000000001.log    the records, one after another
+    00000000000000000001.idx    where each record ends, memory-mapped
+
+A record is a RECORD header (sequence number, body length, CRC-32 of the
+body) followed by the body, a CHAT/2.0 DELIVER body. The index is
+preallocated to INDEX_ENTRIES end offsets, so it is mapped once and record
+n of a segment is found with two lookups and a single pread, without
+reading the rest of the segment.
+
+Appending only puts the record on a queue. A background thread writes
+whatever piled up with one write call, fills in the index, fsyncs
+according to the policy, starts a new segment when the current one is
+full and deletes the oldest segments beyond the retention limits. With an
+age limit it also wakes up every so often to delete expired segments, so
+a log nobody writes to still shrinks.
+"""
+
+import bisect
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+
+RECORD = struct.Struct('!QII')
+OFFSET = struct.Struct('!Q')
+INDEX_ENTRIES = 65536       # records per segment at most
+BATCH_SIZE = 1024           # records written per write call at most
+RETAIN_INTERVAL = 60.0      # seconds between age checks of an idle log at most
+
+FSYNC_POLICIES = ('always', 'interval', 'never')
+
+
+class Segment:
+    """One segment file and its memory-mapped index"""
+
+    def __init__(self, directory, base):
+        self.base = base
+        self.path = os.path.join(directory, f'{base:020d}.log')
+        self.indexPath = os.path.join(directory, f'{base:020d}.idx')
+
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.indexFd = os.open(self.indexPath, os.O_RDWR | os.O_CREAT, 0o644)
+        os.ftruncate(self.indexFd, INDEX_ENTRIES * OFFSET.size)
+        self.index = mmap.mmap(self.indexFd, INDEX_ENTRIES * OFFSET.size)
+
+        self.count = 0  # records written, the index entries after them are zero
+        self.size = 0   # bytes of the complete records
+        self.recover()
+
+    def recover(self):
+        """Finds the records that made it to disk before the last shutdown
+
+        The index may lag behind the records, or a crash may have left a
+        partial record at the end. The index is trusted as far as it agrees
+        with the file, the rest of the file is rescanned and a torn tail is
+        cut off.
+        """
+        fileSize = os.fstat(self.fd).st_size
+
+        low, high = 0, INDEX_ENTRIES
+        while low < high:
+            middle = (low + high) // 2
+            if OFFSET.unpack_from(self.index, middle * OFFSET.size)[0]:
+                low = middle + 1
+            else:
+                high = middle
+        while low and self.end(low - 1) > fileSize:
+            low -= 1
+        self.count = low
+        self.size = self.end(low - 1) if low else 0
+
+        while self.count < INDEX_ENTRIES:
+            header = os.pread(self.fd, RECORD.size, self.size)
+            if len(header) < RECORD.size:
+                break
+            seq, length, crc = RECORD.unpack(header)
+            body = os.pread(self.fd, length, self.size + RECORD.size)
+            if seq != self.base + self.count or len(body) < length or zlib.crc32(body) != crc:
+                break
+            self.size += RECORD.size + length
+            OFFSET.pack_into(self.index, self.count * OFFSET.size, self.size)
+            self.count += 1
+
+        if fileSize > self.size:
+            os.ftruncate(self.fd, self.size)
+        self.index[self.count * OFFSET.size:] = bytes(len(self.index) - self.count * OFFSET.size)
+
+    def end(self, n):
+        """Returns the offset right after record n of this segment"""
+        return OFFSET.unpack_from(self.index, n * OFFSET.size)[0]
+
+    def append(self, records):
+        """Writes records at the end of the segment, called by the writer thread only
+
+        Args:
+            records (list): (sequence number, body) pairs, numbered after the last record
+        """
+        chunks = []
+        for seq, body in records:
+            chunks.append(RECORD.pack(seq, len(body), zlib.crc32(body)))
+            chunks.append(body)
+        view = memoryview(b''.join(chunks))
+        while view:
+            view = view[os.write(self.fd, view):]
+
+        # readers only look at entries below count, so count goes up last
+
+        offset = self.size
+        for n, (_, body) in enumerate(records, self.count):
+            offset += RECORD.size + len(body)
+            OFFSET.pack_into(self.index, n * OFFSET.size, offset)
+        self.size = offset
+        self.count += len(records)
+
+    def read(self, seq):
+        """Reads a single record
+
+        Args:
+            seq (int): its sequence number
+
+        Returns:
+            [bytes]: the body, None if the segment does not hold the record
+        """
+        n = seq - self.base
+        if not 0 <= n < self.count:
+            return None
+        start = self.end(n - 1) if n else 0
+        record = os.pread(self.fd, self.end(n) - start, start)
+        return record[RECORD.size:]
+
+    def full(self, maxSize):
+        """Checks whether the next record belongs in a new segment
+
+        Args:
+            maxSize (int): the size at which a segment is rotated
+
+        Returns:
+            [bool]: whether the segment is full
+        """
+        return self.count >= INDEX_ENTRIES or self.size >= maxSize
+
+    def age(self, now):
+        """Returns the seconds since the segment was last written to"""
+        return now - os.fstat(self.fd).st_mtime
+
+    def close(self):
+        """Unmaps the index and closes both files"""
+        self.index.close()
+        os.close(self.indexFd)
+        os.close(self.fd)
+
+    def remove(self):
+        """Closes and deletes both files"""
+        self.close()
+        os.unlink(self.path)
+        os.unlink(self.indexPath)
+
+
+class MessageLog:
+    """The segments of a log directory and the thread that writes them"""
+
+    def __init__(self, directory, segmentSize=64 * 1024 * 1024,
+                 retainSize=1024 * 1024 * 1024, retainAge=0,
+                 fsync='interval', fsyncInterval=1.0):
+        """Opens, or creates, a log
+
+        Args:
+            directory (string): where the segment files live
+            segmentSize (int): bytes at which a segment is rotated
+            retainSize (int): bytes kept over all segments, the oldest go first
+            retainAge (float): seconds a finished segment is kept, 0 for no limit
+            fsync (string): 'always' after every write, 'interval' every
+                fsyncInterval seconds, or 'never', leaving it to the OS
+            fsyncInterval (float): seconds between fsyncs with the interval policy
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segmentSize = segmentSize
+        self.retainSize = retainSize
+        self.retainAge = retainAge
+        self.fsync = fsync
+        self.fsyncInterval = fsyncInterval
+
+        bases = sorted(int(name[:-4]) for name in os.listdir(directory)
+                       if name.endswith('.log') and name[:-4].isdigit())
+        self.segments = [Segment(directory, base) for base in bases]
+        self.bases = bases
+        self.lock = threading.Lock()    # guards segments and bases
+
+        # sequence number of the newest record on disk, readers may go up to it
+        last = self.segments[-1] if self.segments else None
+        self.last = last.base + last.count - 1 if last else 0
+
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self.run, name='message-log', daemon=True)
+        self.thread.start()
+
+    def append(self, seq, body):
+        """Hands a broadcast to the writer thread, never blocks
+
+        Args:
+            seq (int): its sequence number
+            body (bytes): the CHAT/2.0 DELIVER body
+        """
+        self.queue.put((seq, body))
+
+    def first(self):
+        """Returns the sequence number of the oldest record kept"""
+        with self.lock:
+            return self.bases[0] if self.bases else self.last + 1
+
+    def read(self, seq):
+        """Reads a broadcast back through the index
+
+        Args:
+            seq (int): its sequence number
+
+        Returns:
+            [bytes]: the DELIVER body, None if it is not (or no longer) in the log
+        """
+        if seq > self.last:
+            return None
+        with self.lock:
+            n = bisect.bisect_right(self.bases, seq) - 1
+            return self.segments[n].read(seq) if n >= 0 else None
+
+    def close(self):
+        """Writes and syncs what is still queued, then closes the files"""
+        self.queue.put(None)
+        self.thread.join()
+        with self.lock:
+            for segment in self.segments:
+                segment.close()
+            self.segments, self.bases = [], []
+
+    def run(self):
+        """The writer thread: writes the queued records in batches"""
+        synced = retained = time.monotonic()
+        unsynced = False
+        retainInterval = min(RETAIN_INTERVAL, self.retainAge)
+
+        while True:
+            timeout = None
+            if unsynced and self.fsync == 'interval':
+                timeout = max(0, synced + self.fsyncInterval - time.monotonic())
+            if retainInterval:
+                untilRetain = max(0, retained + retainInterval - time.monotonic())
+                timeout = untilRetain if timeout is None else min(timeout, untilRetain)
+            try:
+                batch = [self.queue.get(timeout=timeout)]
+            except queue.Empty:
+                batch = []
+            while batch and batch[-1] is not None and len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stopping = bool(batch) and batch[-1] is None
+            if stopping:
+                batch.pop()
+            if batch:
+                self.write(batch)
+                unsynced = True
+
+            if unsynced and self.segments and (
+                    stopping or self.fsync == 'always' or
+                    (self.fsync == 'interval' and
+                     time.monotonic() - synced >= self.fsyncInterval)):
+                os.fsync(self.segments[-1].fd)
+                synced = time.monotonic()
+                unsynced = False
+            if stopping:
+                return
+
+            if retainInterval and time.monotonic() - retained >= retainInterval:
+                self.retain()
+                retained = time.monotonic()
+
+    def write(self, batch):
+        """Appends records, rotating to a new segment where needed
+
+        Args:
+            batch (list): (sequence number, body) pairs in order
+        """
+        batch = [record for record in batch if record[0] > self.last]
+
+        while batch:
+            seq = batch[0][0]
+            segment = self.segments[-1] if self.segments else None
+            if (segment is None or segment.full(self.segmentSize) or
+                    seq != segment.base + segment.count):
+                segment = self.rotate(seq)
+
+            # the records that follow on without a gap, as many as the index has room for
+
+            take = 1
+            limit = min(len(batch), INDEX_ENTRIES - segment.count)
+            while take < limit and batch[take][0] == seq + take:
+                take += 1
+
+            segment.append(batch[:take])
+            self.last = batch[take - 1][0]
+            batch = batch[take:]
+
+    def rotate(self, base):
+        """Starts a new segment and applies the retention limits
+
+        Args:
+            base (int): the sequence number of the first record in it
+
+        Returns:
+            [Segment]: the new segment
+        """
+        if self.segments:
+            os.fsync(self.segments[-1].fd)
+
+        segment = Segment(self.directory, base)
+        with self.lock:
+            self.segments.append(segment)
+            self.bases.append(base)
+        self.retain()
+        return segment
+
+    def retain(self):
+        """Deletes the oldest finished segments beyond the retention limits"""
+        now = time.time()
+        total = sum(segment.size for segment in self.segments)
+        while len(self.segments) > 1:
+            oldest = self.segments[0]
+            if total <= self.retainSize and not (
+                    self.retainAge and oldest.age(now) > self.retainAge):
+                break
+            total -= oldest.size
+            with self.lock:
+                del self.segments[0]
+                del self.bases[0]
+                oldest.remove()
@@ -1,170 +1,3222 @@
 #!/usr/bin/env python3
 
+from collections import deque
+from itertools import islice
+import subprocess
 import selectors
+import argparse
+import secrets
+import base64
+import json
 import socket
 import signal
+import errno
 import types
+import time
 import sys
+import os
+
+import compression
+import eventlog
+import metrics
+import timerwheel
+import segmentlog
+import protocol
+import federation
+import upgrade
+import bus
 
 PORT = 0
 SERVER = socket.gethostbyname(socket.gethostname())  # get the IP by name
 ADDR = (SERVER, PORT)
 
-FORMAT = 'utf-8'
-BUFFER_SIZE = 2048
+FORMAT = 'utf-8'
+BUFFER_SIZE = 2048
+RECV_BUFFER_SIZE = 65536    # bytes pulled from a socket per readiness event
+MAX_FRAME_SIZE = 65536      # longest message we are willing to buffer
+
+VERSIONS = ('CHAT/1.0', 'CHAT/2.0')  # CHAT/2.0 is the binary framing in protocol.py
+COMMANDS = (b'DISCONNECT ', b'JOIN ', b'LEAVE ', b'HISTORY ', b'STATS ', b'PONG ')  # CHAT/1.0 lines that are not chat messages
+EXTENSIONS = {'compress': compression.METHODS, 'resume': None}  # key=value options of a registration line, None for any value
+MAX_INFLATE = RECV_BUFFER_SIZE  # most bytes decompressed at a time, see FrameReader.inflate
+
+# outbound queue limits per client, see queueMessage
+HIGH_WATER_MARK = 1024 * 1024
+LOW_WATER_MARK = 256 * 1024
+SLOW_CONSUMER_GRACE = 5.0   # seconds a client may stay above the high water mark
+HANDSHAKE_TIMEOUT = 10.0    # seconds a new connection has to register
+HEARTBEAT_INTERVAL = 30.0   # seconds of silence before a client gets a PING
+IDLE_TIMEOUT = 90.0         # seconds of silence before a client is disconnected
+UPGRADE_TIMEOUT = 10.0      # seconds the processes of a hot upgrade wait for each other
+RESUME_GRACE = 60.0         # seconds a lost client's nickname is kept for it to resume
+RESUME_HELD = 1000          # room and direct messages held for a lost client at most
+
+# what happens to chat messages over a client's rate limit
+RATE_POLICIES = ('drop', 'delay', 'disconnect')
+
+# broadcasts kept for HISTORY, whichever limit is hit first
+HISTORY_SIZE = 1000
+HISTORY_BYTES = 1024 * 1024
+REPLAY_BUDGET = 256         # broadcasts a replay or search looks at per loop pass
+SEARCH_RESULTS = 100        # matches a search returns at most
+
+# durable log, see segmentlog.py
+LOG_SEGMENT_SIZE = 64 * 1024 * 1024
+LOG_RETAIN_SIZE = 1024 * 1024 * 1024
+
+# admission control, see acceptClient
+LISTEN_BACKLOG = socket.SOMAXCONN
+ACCEPT_BUDGET = 64          # connections accepted per readiness event
+MAX_CONNECTIONS = 10000
+MAX_HANDSHAKES = 1000
+
+# most buffers a single sendmsg call accepts
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16
+
+sel = selectors.DefaultSelector()
+
+# events are printed by a background thread, main() sets the level from --log-level
+log = eventlog.EventLog()
+
+rooms = dict()  # rooms: { Room Name: set of Connection records }, members of this process
+
+# (connection, data) pairs with frames queued since the last flushPending
+dirty = []
+
+# handshake timeouts, heartbeats and idle timeouts
+wheel = timerwheel.TimerWheel(time.monotonic())
+
+# connections with a HISTORY replay in progress { Client Connection: Selector Data }
+replays = dict()
+
+# the segmentlog.MessageLog broadcasts are written to, with --log-dir
+messageLog = None
+
+# the listening socket of the admin endpoint, with --admin-port or --admin-socket
+adminServer = None
+
+# hot upgrade: the link to the new server process while it starts, and the process
+upgradeLink = None
+upgradeProcess = None
+
+# multi-process mode: the link to the bus hub, and the nicknames this
+# worker asked the hub for { Client Name: (Client Connection, Selector Data) }
+busLink = None
+busData = None
+claims = dict()
+
+# resume sessions of the clients that registered with resume=, kept for
+# --resume-grace seconds after their connection is lost
+sessions = dict()  # sessions: { Resume Token: SimpleNamespace }
+reserved = dict()  # nicknames kept for a lost client: { Client Name: session }
+away = dict()  # rooms of lost clients: { Room Name: { Resume Token: session } }, their messages are held
+
+# federation: the Flood of this node, the links to its peer servers
+# { Peer Connection: address to dial again, None for links the peer dialed },
+# and the nicknames registered at other nodes { Client Name: (Node Name, Peer Connection) }
+peerFlood = None
+peerServer = None
+peerLinks = dict()
+remoteClients = dict()
+
+# compression counters of the connections that already closed
+compressionTotals = compression.Counters()
+
+
+def getArgs(argv=None):
+    """Gets and parses the server options
+
+    Args:
+        argv (list): the arguments to parse, defaults to the command line
+
+    Returns:
+        [Namespace]: the parsed options
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--engine', choices=['selectors', 'asyncio'], default='selectors',
+                        help='event loop implementation to serve clients with')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='worker processes sharing the port through SO_REUSEPORT')
+    parser.add_argument('--high-water', type=int, default=HIGH_WATER_MARK,
+                        help='queued bytes at which a client counts as a slow consumer')
+    parser.add_argument('--low-water', type=int, default=LOW_WATER_MARK,
+                        help='queued bytes at which a slow consumer recovers')
+    parser.add_argument('--slow-consumer', choices=['drop', 'evict'], default='evict',
+                        help='drop messages for slow consumers or disconnect them')
+    parser.add_argument('--slow-consumer-grace', type=float, default=SLOW_CONSUMER_GRACE,
+                        help='seconds a slow consumer is tolerated before eviction')
+    parser.add_argument('--handshake-timeout', type=float, default=HANDSHAKE_TIMEOUT,
+                        help='seconds a new connection has to send its registration')
+    parser.add_argument('--heartbeat', type=float, default=HEARTBEAT_INTERVAL,
+                        help='seconds of silence before a client is sent a PING, 0 for never')
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT,
+                        help='seconds of silence before a client is disconnected, 0 for never')
+    parser.add_argument('--backlog', type=int, default=LISTEN_BACKLOG,
+                        help='length of the listen queue')
+    parser.add_argument('--accept-budget', type=int, default=ACCEPT_BUDGET,
+                        help='connections accepted per readiness event')
+    parser.add_argument('--max-connections', type=int, default=MAX_CONNECTIONS,
+                        help='connections, registered or not, before new ones get 503')
+    parser.add_argument('--max-handshakes', type=int, default=MAX_HANDSHAKES,
+                        help='unregistered connections before new ones get 503')
+    parser.add_argument('--history', type=int, default=HISTORY_SIZE,
+                        help='broadcasts kept for clients that ask for HISTORY')
+    parser.add_argument('--history-bytes', type=int, default=HISTORY_BYTES,
+                        help='most bytes the kept broadcasts may take up')
+    parser.add_argument('--log-dir',
+                        help='keep every broadcast in a durable log in this directory')
+    parser.add_argument('--log-segment-size', type=int, default=LOG_SEGMENT_SIZE,
+                        help='bytes at which the log starts a new segment file')
+    parser.add_argument('--log-retain-size', type=int, default=LOG_RETAIN_SIZE,
+                        help='bytes of log kept, the oldest segments are deleted first')
+    parser.add_argument('--log-retain-age', type=float, default=0,
+                        help='seconds a finished log segment is kept, 0 for no limit')
+    parser.add_argument('--log-fsync', choices=segmentlog.FSYNC_POLICIES, default='interval',
+                        help='fsync the log after every write, every interval, or never')
+    parser.add_argument('--log-fsync-interval', type=float, default=1.0,
+                        help='seconds between fsyncs with --log-fsync interval')
+    parser.add_argument('--log-level', choices=eventlog.LEVELS, default='info',
+                        help='lowest level of the events printed, debug includes every message')
+    parser.add_argument('--log-format', choices=eventlog.FORMATS, default='text',
+                        help='print events as plain text or as one JSON object per line')
+    parser.add_argument('--log-sample', action='append', default=[], metavar='EVENT=N',
+                        help='print only one in N events of a kind, e.g. message=100, may be repeated')
+    parser.add_argument('--admin-port', type=int,
+                        help='serve metrics in the Prometheus text format on this local port')
+    parser.add_argument('--admin-socket',
+                        help='serve metrics in the Prometheus text format on this Unix socket')
+    parser.add_argument('--rate-limit', type=float, default=0,
+                        help='chat messages per second a client may send, 0 for no limit')
+    parser.add_argument('--rate-burst', type=float,
+                        help='chat messages a client may send at once, default one second worth')
+    parser.add_argument('--byte-limit', type=float, default=0,
+                        help='bytes of chat messages per second a client may send, 0 for no limit')
+    parser.add_argument('--byte-burst', type=float,
+                        help='bytes of chat messages a client may send at once, default one second worth')
+    parser.add_argument('--rate-policy', choices=RATE_POLICIES, default='drop',
+                        help='drop messages over the limit, delay them by not reading the '
+                             'client, or disconnect the client')
+    parser.add_argument('--resume-grace', type=float, default=RESUME_GRACE,
+                        help='seconds a lost client may come back with its resume token, 0 for never')
+    parser.add_argument('--node-name',
+                        help='this server\'s name in a federated cluster, unique, '
+                             'default host:port of the client port')
+    parser.add_argument('--peer-port', type=int,
+                        help='listen for peer servers of a federated cluster on this port, '
+                             '0 for any free one')
+    parser.add_argument('--peer', action='append', default=[], metavar='HOST:PORT',
+                        type=federation.parseAddress,
+                        help='link to the peer server listening there, may be repeated')
+    parser.add_argument('--upgrade-fd', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--compress-level', type=int, default=-1, choices=range(-1, 10),
+                        metavar='{0..9}', help='zlib level for clients that ask for compression')
+
+    args = parser.parse_args(argv)
+
+    samples = dict()
+    for sample in args.log_sample:
+        event, _, every = sample.partition('=')
+        if not event or not every.isdigit() or int(every) < 1:
+            parser.error(f'--log-sample needs EVENT=N, got {sample}')
+        samples[event] = int(every)
+    args.log_sample = samples
+
+    if args.rate_burst is None:
+        args.rate_burst = max(1.0, args.rate_limit)
+    if args.byte_burst is None:
+        args.byte_burst = args.byte_limit
+    if args.workers > 1 and args.engine != 'selectors':
+        parser.error('--workers needs the selectors engine')
+    if args.workers > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+        parser.error('--workers needs SO_REUSEPORT, which this platform lacks')
+    if (args.peer or args.peer_port is not None) and (args.workers > 1 or args.engine != 'selectors'):
+        parser.error('--peer and --peer-port need the selectors engine in a single process')
+    return args
+
+
+options = getArgs([])   # defaults until main() parses the command line
+
+# metrics, served by the admin endpoint and summarised by STATS
+
+registry = metrics.Registry()
+registrations = registry.counter(
+    'chat_registrations_total', 'Registrations answered, by status code', label='status')
+messagesIn = registry.counter(
+    'chat_messages_received_total', 'Chat messages received from clients')
+messagesOut = registry.counter(
+    'chat_messages_sent_total', 'Messages and status lines queued for clients')
+messagesDropped = registry.counter(
+    'chat_messages_dropped_total', 'Messages dropped for slow consumers')
+bytesIn = registry.counter(
+    'chat_bytes_received_total', 'Bytes received from clients')
+bytesOut = registry.counter(
+    'chat_bytes_sent_total', 'Bytes sent to clients')
+registry.gauge('chat_connections', 'Client connections, registered or not',
+               lambda: len(connections))
+registry.gauge('chat_clients', 'Registered clients', lambda: len(clients))
+registry.gauge('chat_handshakes', 'Connections that have not registered yet',
+               lambda: len(handshakes))
+registry.gauge('chat_rooms', 'Rooms with members', lambda: len(rooms))
+registry.gauge('chat_queued_bytes', 'Bytes queued for all clients',
+               lambda: sum(data.queued for data in connections.values()))
+registry.gauge('chat_max_queued_bytes', 'Bytes queued for the client with the longest queue',
+               lambda: max((data.queued for data in connections.values()), default=0))
+registry.gauge('chat_slow_consumers', 'Clients above the high water mark',
+               lambda: sum(1 for data in connections.values() if data.throttled))
+loopSeconds = registry.histogram(
+    'chat_loop_seconds', 'Time spent handling the events of one selector loop pass')
+fanoutSeconds = registry.histogram(
+    'chat_fanout_seconds', 'Time spent queueing one message for its recipients')
+reaped = registry.counter(
+    'chat_idle_reaped_total', 'Clients disconnected after the idle timeout')
+pingSeconds = registry.histogram(
+    'chat_ping_rtt_seconds', 'Round-trip time from PING to PONG')
+log.dropped = registry.counter(
+    'chat_log_dropped_total', 'Log records dropped because the log queue was full')
+registry.gauge('chat_log_queued', 'Log records waiting to be printed',
+               lambda: log.queue.qsize())
+rateLimited = registry.counter(
+    'chat_rate_limited_total', 'Chat messages over a client rate limit, by policy', label='policy')
+registry.gauge('chat_paused_clients', 'Clients not read from until their rate limit allows',
+               lambda: sum(1 for data in connections.values() if data.paused))
+resumes = registry.counter(
+    'chat_resumes_total', 'Clients that came back with their resume token')
+registry.gauge('chat_away_clients', 'Lost clients whose nickname is kept for them to resume',
+               lambda: len(reserved))
+registry.gauge('chat_peer_links', 'Links to peer servers that said HELLO',
+               lambda: sum(1 for link in peerLinks if link.name is not None))
+registry.gauge('chat_remote_clients', 'Clients registered at the other nodes of the cluster',
+               lambda: len(remoteClients))
+peerMessages = registry.counter(
+    'chat_peer_messages_total', 'Messages sent to peer links, by kind', label='kind')
+
+
+# every connection of this process receives into the same preallocated
+# buffer. The event loop handles one readiness event at a time, and a reader
+# is done with the buffer before the next recv: complete messages are copied
+# out of it once, an incomplete trailing message is kept by the reader
+receiveBuffer = bytearray(RECV_BUFFER_SIZE)
+
+
+class FrameReader:
+    """Splits the byte stream of one connection into messages.
+
+    TCP does not preserve message boundaries: a single recv may return half
+    a message or several messages at once. The reader receives into the
+    shared receiveBuffer and keeps an incomplete trailing frame around until
+    the rest of it arrives. Messages are newline-terminated lines, or
+    CHAT/2.0 frames once lengthPrefixed is set, and decompressed first
+    once the connection negotiated compression.
+
+    While nothing is kept, the messages are sliced straight out of the
+    receive buffer, which leaves it with one copy per message. Whoever
+    fills the reader calls frames(), line() or keep() before the next recv.
+    """
+
+    __slots__ = ('buffer', 'pending', 'fresh', 'lengthPrefixed', 'compression')
+
+    def __init__(self):
+        self.buffer = receiveBuffer
+        self.pending = bytearray()
+        self.fresh = 0              # bytes at the start of the buffer not looked at yet
+        self.lengthPrefixed = False
+        self.compression = None     # the connection's compression.Stream
+
+    def fill(self, sock):
+        """Receives whatever the socket has ready with a single syscall.
+
+        Args:
+            sock (socket object): the connection to read from
+
+        Returns:
+            [int]: the number of bytes read, 0 when the peer closed the connection
+        """
+        return self.received(sock.recv_into(self.buffer))
+
+    def received(self, nbytes):
+        """Takes note of the bytes that were just written into the buffer.
+
+        Args:
+            nbytes (int): how many bytes at the start of the buffer are new
+
+        Raises:
+            ValueError: if compressed bytes are invalid
+
+        Returns:
+            [int]: nbytes
+        """
+        if self.compression is not None:
+            with memoryview(self.buffer) as view:
+                self.pending += self.compression.decompress(view[:nbytes], MAX_INFLATE)
+        elif self.pending:
+            with memoryview(self.buffer) as view:
+                self.pending += view[:nbytes]
+        else:
+            self.fresh = nbytes
+        return nbytes
+
+    def inflate(self):
+        """Decompresses the next MAX_INFLATE bytes of what was received.
+
+        received() decompresses no more than that either, the rest of the
+        input waits in the stream until the messages decompressed so far
+        were handled, so a small chunk that expands a thousandfold never
+        sits in pending all at once.
+
+        Raises:
+            ValueError: if compressed bytes are invalid
+
+        Returns:
+            [bool]: False if everything received was decompressed already
+        """
+        stream = self.compression
+        if stream is None or not stream.tail:
+            return False
+        self.pending += stream.decompress(b'', MAX_INFLATE)
+        return True
+
+    def keep(self):
+        """Copies the bytes not looked at yet out of the shared buffer"""
+        if self.fresh:
+            with memoryview(self.buffer) as view:
+                self.pending += view[:self.fresh]
+            self.fresh = 0
+
+    def decompressFrom(self, stream):
+        """Decompresses everything after the registration line from now on
+
+        Args:
+            stream (compression.Stream): the connection's compression streams
+
+        Raises:
+            ValueError: if the bytes already received are not a valid stream
+        """
+        self.keep()
+        self.compression = stream
+        if self.pending:
+            self.pending = bytearray(stream.decompress(bytes(self.pending), MAX_INFLATE))
+
+    def line(self):
+        """Removes the first complete line from the buffer, and nothing else.
+
+        Used for the registration line, the protocol may change after it.
+
+        Raises:
+            ValueError: if the peer sent more than MAX_FRAME_SIZE bytes without a newline
+
+        Returns:
+            [bytes]: the line without its terminator, None if it is incomplete
+        """
+        self.keep()
+        pending = self.pending
+        end = pending.find(b'\n')
+        if end < 0:
+            if len(pending) > MAX_FRAME_SIZE:
+                raise ValueError('frame exceeds MAX_FRAME_SIZE')
+            return None
+        line = bytes(pending[:end]).rstrip(b'\r')
+        del pending[:end + 1]
+        return line
+
+    def frames(self):
+        """Removes every complete message from the buffer.
+
+        Raises:
+            ValueError: if a message is longer than MAX_FRAME_SIZE
+
+        Returns:
+            [list]: the complete lines as bytes without the line terminator,
+            or (frame type, body) tuples in length-prefixed mode
+        """
+        fresh = self.fresh
+        self.fresh = 0
+        buffer = self.buffer if fresh else self.pending
+        length = fresh or len(buffer)
+
+        with memoryview(buffer) as view:
+            if self.lengthPrefixed:
+                frames, start = protocol.readFrames(view[:length], MAX_FRAME_SIZE)
+            else:
+                frames = []
+                start = 0
+                end = buffer.find(b'\n', 0, length)
+                while end >= 0:
+                    stop = end - 1 if end > start and buffer[end - 1] == 13 else end
+                    frames.append(bytes(view[start:stop]))
+                    start = end + 1
+                    end = buffer.find(b'\n', start, length)
+
+            # only an incomplete trailing message is kept
+
+            if fresh:
+                self.pending += view[start:length]
+
+        if start and not fresh:
+            del self.pending[:start]
+        if not self.lengthPrefixed and len(self.pending) > MAX_FRAME_SIZE:
+            raise ValueError('frame exceeds MAX_FRAME_SIZE')
+        return frames
+
+
+NO_ROOMS = frozenset()     # the rooms of a client that never joined one, shared
+
+
+class Connection:
+    """Everything the server keeps about one client connection.
+
+    The record is registered with the selector as the connection's data and
+    indexed by the registry. It has __slots__ and starts out with shared
+    empty values wherever it can, so an idle connection costs a few hundred
+    bytes here, see Capacity in the README.
+    """
+
+    __slots__ = ('conn', 'fd', 'addr', 'name', 'state', 'version', 'binary', 'timer',
+                 'lastSeen', 'ping', 'pingSent', 'reader', 'outbox', 'queued', 'writing',
+                 'paused', 'dirty', 'throttled', 'dropped', 'tokens', 'byteTokens',
+                 'refilled', 'limited', 'held', 'resume', 'rooms', 'compression', 'replay',
+                 'token', 'delivered', 'packed', 'closing', 'closed')
+
+    def __init__(self, conn, addr):
+        now = time.monotonic()
+        self.conn = conn
+        self.fd = conn.fileno()     # kept, the socket forgets it once closed
+        self.addr = addr
+        self.name = None
+        self.state = 'handshaking'
+        self.version = None
+        self.binary = False         # whether the client speaks CHAT/2.0
+        self.timer = None           # the timerwheel.Timer of the handshake or idle timeout
+        self.lastSeen = now         # when the client last sent anything
+        self.ping = 0               # token of the last PING sent
+        self.pingSent = 0           # when it was sent
+
+        # inbound and outbound buffers
+
+        self.reader = FrameReader()
+        self.outbox = []            # frames waiting for the socket to be writable
+        self.queued = 0             # bytes in outbox
+        self.packed = 0             # frames at the front of outbox that are compressed already
+        self.held = ()              # frames read but delayed by the rate limit
+        self.compression = None     # compression.Stream, if the client asked for it
+        self.replay = None          # (broadcasts to replay, closing status) of a HISTORY request
+
+        # event loop flags
+
+        self.writing = False        # whether EVENT_WRITE is registered
+        self.paused = False         # whether EVENT_READ is not, see --rate-policy delay
+        self.dirty = False          # whether the connection is waiting in dirty
+        self.closing = False        # close once the outbox is flushed
+        self.closed = False
+
+        # limits and stats
+
+        self.throttled = 0          # time the client became a slow consumer
+        self.dropped = 0            # messages dropped while it was one
+        self.tokens = options.rate_burst    # the rate limit buckets
+        self.byteTokens = options.byte_burst
+        self.refilled = now
+        self.limited = False        # whether the client was told it is over the limit
+        self.resume = None          # the timerwheel.Timer that resumes reading
+
+        self.rooms = NO_ROOMS       # the rooms the client joined, a set once it joins one
+        self.token = None           # the resume token, if the client asked for one
+        self.delivered = 0          # the newest broadcast sent before the outbox last ran empty
+
+
+class ConnectionRegistry:
+    """The client connections of this process, by file descriptor and by nickname
+
+    Every connection is in byFd from accept until it closes, in handshaking
+    until its registration line arrived, and in byName once it registered.
+    """
+
+    def __init__(self):
+        self.byFd = dict()          # { File Descriptor: Connection }
+        self.byName = dict()        # { Client Name: Connection }, registered clients only
+        self.handshaking = dict()   # { File Descriptor: Connection }, not registered yet
+
+    def __len__(self):
+        return len(self.byFd)
+
+    def add(self, data):
+        """Indexes a connection by its file descriptor
+
+        Args:
+            data (Connection): the connection record
+        """
+        self.byFd[data.fd] = data
+        if data.state == 'handshaking':
+            self.handshaking[data.fd] = data
+
+    def register(self, data):
+        """Indexes a connection by the nickname it registered
+
+        Args:
+            data (Connection): the connection record, data.name is set
+        """
+        self.handshaking.pop(data.fd, None)
+        self.byName[data.name] = data
+
+    def remove(self, data):
+        """Forgets a connection that closes
+
+        Args:
+            data (Connection): the connection record
+        """
+        self.byFd.pop(data.fd, None)
+        self.handshaking.pop(data.fd, None)
+        if data.name is not None and self.byName.get(data.name) is data:
+            del self.byName[data.name]
+
+
+connectionRegistry = ConnectionRegistry()
+clients = connectionRegistry.byName
+connections = connectionRegistry.byFd
+handshakes = connectionRegistry.handshaking
+
+
+class History:
+    """The most recent broadcasts, numbered in the order they were sent.
+
+    A ring buffer capped by options.history messages and by
+    options.history_bytes bytes, the oldest messages are forgotten first.
+    Sequence numbers keep counting up, so a client can ask for everything
+    after the last message it saw. In multi-process mode every worker
+    numbers the broadcasts it delivered on its own.
+    """
+
+    def __init__(self):
+        self.entries = deque()  # (sequence number, frames) pairs, oldest first
+        self.size = 0           # bytes held by the frames
+        self.last = 0           # sequence number of the newest broadcast
+
+    def append(self, frames):
+        """Keeps a broadcast, forgetting the oldest ones if over a limit
+
+        Args:
+            frames (tuple): the message encoded for each protocol version
+
+        Returns:
+            [int]: the sequence number of the broadcast
+        """
+        self.last += 1
+        self.entries.append((self.last, frames))
+        self.size += len(frames[0]) + len(frames[1])
+
+        while self.entries and (len(self.entries) > options.history or
+                                self.size > options.history_bytes):
+            _, old = self.entries.popleft()
+            self.size -= len(old[0]) + len(old[1])
+
+        return self.last
+
+    def first(self):
+        """Returns the sequence number of the oldest broadcast still kept"""
+        return self.last - len(self.entries) + 1
+
+    def get(self, seq):
+        """Looks up a broadcast
+
+        Args:
+            seq (int): its sequence number, at least first()
+
+        Returns:
+            [tuple]: the message encoded for each protocol version
+        """
+        return self.entries[seq - self.first()][1]
+
+
+history = History()
+
+
+def recordBroadcast(body, frames):
+    """Keeps a broadcast for HISTORY, and in the durable log if there is one
+
+    Args:
+        body (bytes): sender, NUL, target, NUL, text
+        frames (tuple): the message encoded for each protocol version
+    """
+    seq = history.append(frames)
+    if messageLog is not None:
+        messageLog.append(seq, body)
+
+
+def keptBroadcast(seq):
+    """Looks a broadcast up in the history, or else in the durable log
+
+    Args:
+        seq (int): its sequence number
+
+    Returns:
+        [tuple]: the message encoded for each protocol version, None if forgotten
+    """
+    if seq >= history.first():
+        return history.get(seq)
+    if messageLog is not None:
+        body = messageLog.read(seq)
+        if body is not None:
+            return encodeMessage(body)
+    return None
+
+
+def oldestBroadcast():
+    """Returns the sequence number of the oldest broadcast still kept somewhere"""
+    if messageLog is not None:
+        return min(messageLog.first(), history.first())
+    return history.first()
+
+
+def encodeMessage(body):
+    """Encodes a chat message once for each protocol version
+
+    Args:
+        body (bytes): sender, NUL, target, NUL, text, as in a CHAT/2.0 DELIVER frame
+
+    Returns:
+        [tuple]: the CHAT/1.0 line and the CHAT/2.0 frame, indexed by data.binary
+    """
+    sender, target, text = body.split(b'\0', 2)
+    if target:
+        line = b'@%s %s: %s\n' % (sender, target, text)
+    else:
+        line = b'@%s: %s\n' % (sender, text)
+    return line, protocol.encode(protocol.DELIVER, body)
+
+
+def encodeStatus(status):
+    """Encodes a status line once for each protocol version
+
+    Args:
+        status (string): the status line, e.g. 200 Joined #room
+
+    Returns:
+        [tuple]: the CHAT/1.0 line and the CHAT/2.0 frame, indexed by data.binary
+    """
+    status = status.encode(FORMAT)
+    return status + b'\n', protocol.encode(protocol.STATUS, status)
+
+
+def queueStatus(conn, data, status):
+    """Queues a status line for a client in its protocol version
+
+    Args:
+        conn (socket object): the client connection
+        data (Connection): the data registered with the selector
+        status (string): the status line
+    """
+    queueMessage(conn, data, encodeStatus(status)[data.binary])
+
+
+def broadcast(clientName, message):
+    """Broadcasts the message to all clients except for the sender
+
+    The message is encoded once per protocol version and every recipient
+    queue references the same bytes objects. In multi-process mode the
+    message is also handed to the bus, once, for the clients of the other
+    workers, and in a federated cluster it goes to every peer link once.
+
+    Args:
+        clientName (string): the registered nickname 
+        message (bytes): the sent message
+    """
+    body = b'%s\0\0%s' % (clientName.encode(FORMAT), message)
+    if busLink is not None:
+        sendBus(bus.FRAME, body)
+    if peerFlood is not None:
+        floodPeers(federation.FRAME, peerFlood.stamp(body))
+
+    frames = encodeMessage(body)
+    recordBroadcast(body, frames)
+    deliverLocal(clientName, frames)
+
+
+def broadcastStatus(status):
+    """Sends a status line to every client, e.g. when shutting down
+
+    Args:
+        status (string): the status line
+    """
+    deliverLocal(None, encodeStatus(status))
+
+
+def deliverLocal(clientName, frames):
+    """Queues an encoded message for every client of this process but the sender
+
+    Args:
+        clientName (string): the registered nickname of the sender
+        frames (tuple): the message encoded for each protocol version
+    """
+    started = time.perf_counter()
+    sender = clients.get(clientName)
+    for data in list(clients.values()):
+        if data is not sender:
+            queueMessage(data.conn, data, frames[data.binary])
+    fanoutSeconds.observe(time.perf_counter() - started)
+
+
+def queueMessage(conn, data, frame):
+    """Queues a frame for a client
+
+    Nothing is written here, flushPending sends everything queued during a
+    loop iteration with one call per client.
+
+    A client whose queue grows past the high water mark is a slow consumer.
+    New frames for it are dropped until its queue drains below the low water
+    mark, and with the evict policy it is disconnected if it does not recover
+    within the grace period.
+
+    Args:
+        conn (socket object): the client connection
+        data (Connection): the data registered with the selector
+        frame (bytes): the encoded message
+    """
+    if data.throttled:
+        data.dropped += 1
+        messagesDropped.value += 1
+        if (options.slow_consumer == 'evict' and
+                time.monotonic() - data.throttled > options.slow_consumer_grace):
+            log.warning('slow-consumer', 'Evicting slow consumer {name}, {queued} bytes queued',
+                        name=data.name, queued=data.queued)
+            disconnectClient(conn, data)
+        return
+
+    data.outbox.append(frame)
+    data.queued += len(frame)
+    messagesOut.value += 1
+
+    if not data.dirty and not data.writing:
+        data.dirty = True
+        dirty.append((conn, data))
+
+    if data.queued > options.high_water:
+        log.warning('slow-consumer', 'User {name} is a slow consumer, {queued} bytes queued',
+                    name=data.name, queued=data.queued)
+        data.throttled = time.monotonic()
+
+
+def flushPending():
+    """Flushes every connection that had frames queued since the last call"""
+    while dirty:
+        conn, data = dirty.pop()
+        data.dirty = False
+        flushClient(conn, data)
+
+
+def flushClient(conn, data):
+    """Writes the queued frames with a single scatter-gather send
+
+    Whatever the socket does not accept stays queued, and the connection
+    waits for EVENT_WRITE to send the rest.
+
+    For a compressed connection the frames queued since the last flush are
+    compressed together first, one pass and one sync flush for the batch.
+
+    Args:
+        conn (socket object): the client connection
+        data (Connection): the data registered with the selector
+    """
+    if data.closed:
+        return
+
+    outbox = data.outbox
+    if data.compression is not None and len(outbox) > data.packed:
+        compressQueued(data)
+
+    try:
+        if len(outbox) == 1:
+            sent = conn.send(outbox[0])
+        else:
+            sent = conn.sendmsg(islice(outbox, IOV_MAX))
+    except BlockingIOError:
+        sent = 0
+    except OSError:
+        disconnectClient(conn, data)
+        return
+
+    bytesOut.value += sent
+
+    # drop the frames that went out completely, keep the unsent tail of the last one
+
+    if sent == data.queued:
+        outbox.clear()
+        data.queued = 0
+        if data.replay is None:
+            data.delivered = history.last
+    else:
+        data.queued -= sent
+        done = 0
+        while sent:
+            frame = outbox[done]
+            if sent < len(frame):
+                outbox[done] = memoryview(frame)[sent:]
+                break
+            sent -= len(frame)
+            done += 1
+        del outbox[:done]
+
+    if data.compression is not None:
+        data.packed = len(outbox)
+
+    if data.throttled and data.queued <= options.low_water:
+        log.info('slow-consumer', 'User {name} recovered, {dropped} messages dropped',
+                 name=data.name, dropped=data.dropped)
+        data.throttled = 0
+
+    if not outbox and data.closing:
+        disconnectClient(conn, data)
+        return
+
+    # only ask for writability while there is something left to write
+
+    if bool(outbox) != data.writing:
+        data.writing = bool(outbox)
+        watchEvents(conn, data)
+
+
+def watchEvents(conn, data):
+    """Registers the events a connection waits for with the selector
+
+    A connection waits for EVENT_READ unless reading it is paused by the
+    rate limit, and for EVENT_WRITE while frames wait for the socket. One
+    that waits for neither is taken out of the selector until it does.
+
+    Args:
+        conn (socket object): the client connection
+        data (Connection): the data registered with the selector
+    """
+    events = ((0 if data.paused else selectors.EVENT_READ) |
+              (selectors.EVENT_WRITE if data.writing else 0))
+    key = sel.get_map().get(conn)
+
+    if key is None:
+        if events:
+            sel.register(conn, events, data)
+    elif not events:
+        sel.unregister(conn)
+    elif key.events != events:
+        sel.modify(conn, events, data)
+
+
+def compressQueued(data):
+    """Replaces the frames queued after the compressed ones by their compressed batch
+
+    The streams are per connection, so a broadcast is compressed once per
+    compressed recipient, but everything a recipient got during a loop
+    iteration shares a single pass.
+
+    Args:
+        data (Connection): the data registered with the selector
+    """
+    outbox = data.outbox
+    fresh = outbox[data.packed:]
+    del outbox[data.packed:]
+
+    wire = data.compression.compress(fresh)
+    outbox.append(wire)
+    data.queued += len(wire) - sum(map(len, fresh))
+
+
+def acceptClient(sock):
+    """Accepts the connections waiting in the listen queue
+
+    Up to the accept budget connections are accepted per readiness event,
+    so a reconnect storm does not cost one select round-trip each.
+    Connections over the admission limits are answered with 503 and closed
+    right away instead of holding a file descriptor.
+
+    Args:
+        sock (socket object): the socket
+    """
+    for _ in range(options.accept_budget):
+
+        # accept connection
+        try:
+            conn, addr = sock.accept()
+        except BlockingIOError:
+            break
+        except OSError as e:
+            log.error('accept', 'Accept failed: {error}', error=e)    # e.g. out of file descriptors
+            break
+
+        conn.setblocking(False)
+
+        if (len(connections) >= options.max_connections or
+                len(handshakes) >= options.max_handshakes):
+            rejectClient(conn, addr)
+        else:
+            startHandshake(conn, addr)
+
+
+def rejectClient(conn, addr):
+    """Turns away a connection the server has no room for
+
+    Args:
+        conn (socket object): the client connection
+        addr (tuple): the client address
+    """
+    log.warning('busy', 'Server busy, rejecting client address: {addr}', addr=addr)
+    registrations.labels('503').value += 1
+    try:
+        conn.send(encodeStatus('503 Server busy')[0])
+    except OSError:
+        pass
+    conn.close()
+
+
+def startHandshake(conn, addr):
+    """Waits for the registration line of a new connection
+
+    The connection is registered with the selector in the handshaking state,
+    registerClient finishes the registration once the whole line arrived.
+    Connections that do not register within the handshake timeout are
+    answered with 408 and closed by a timer.
+
+    Args:
+        conn (socket object): the client connection
+        addr (tuple): the client address
+    """
+    log.debug('accept', 'Accepted connection from client address: {addr}', addr=addr)
+
+    data = Connection(conn, addr)
+    sel.register(conn, selectors.EVENT_READ, data=data)
+    connectionRegistry.add(data)
+    data.timer = wheel.schedule(options.handshake_timeout, expireHandshake, conn, data)
+
+
+def parseRegistration(message, registered, versions=VERSIONS, extensions=EXTENSIONS):
+    """Checks a registration line and extracts the nickname
+
+    Args:
+        message (string): the line, e.g. REGISTER luca CHAT/1.0 compress=zlib
+        registered (dict): the nicknames already taken
+        versions (tuple): the protocol versions the server speaks
+        extensions (dict): the options the server understands and their values,
+            None for an option that takes any value
+
+    Returns:
+        [string]: the control message to answer with
+        [string]: the nickname, None when the registration is invalid
+        [string]: the protocol version
+        [dict]: the options after the version, e.g. { 'compress': 'zlib' }
+    """
+    parts = message.split()
+
+    # checks whether the entered nickname is valid
+    # checks whether the entered nickname already exists
+
+    if len(parts) < 3 or parts[0] != 'REGISTER' or parts[2] not in versions:
+        return '400 Invalid registration', None, None, None
+
+    requested = dict()
+    for option in parts[3:]:
+        key, _, value = option.partition('=')
+        allowed = extensions.get(key, ())
+        if not value or key in requested or (allowed is not None and value not in allowed):
+            return '400 Invalid registration', None, None, None
+        requested[key] = value
+
+    if parts[1] in registered:
+        return '401 Client already registered', None, None, None
+    return '200 Registration successful', parts[1], parts[2], requested
+
+
+def registerClient(conn, data, line):
+    """Completes the handshake of a connection with its registration line
+
+    In multi-process mode another worker may hold the nickname, so it is
+    claimed from the bus hub first and the client waits in the claiming
+    state until the hub answers.
+
+    A registration with the resume token of a session of the same nickname
+    takes the nickname over, from a lost connection or from a stale one the
+    server did not notice was gone yet.
+
+    Args:
+        conn (socket object): the client connection
+        data (Connection): the data registered with the selector
+        line (bytes): the registration line
+
+    Returns:
+        [bool]: whether the client is now registered
+    """
+    handshakes.pop(data.fd, None)
+    wheel.cancel(data.timer)
+
+    try:
+        message = line.decode(FORMAT)
+    except UnicodeDecodeError:
+        rejectRegistration(conn, data, '400 Invalid registration')
+        return False
+
+    session = findSession(message)
+    controlMsg, username, version, requested = parseRegistration(
+        message, clients if session is None else ())
+    if session is None and (username in claims or username in reserved or
+                            username in remoteClients):
+        controlMsg, username = '401 Client already registered', None
+
+    if username is None:
+        rejectRegistration(conn, data, controlMsg)
+        return False
+
+    data.version = version
+    if 'compress' in requested:
+        data.compression = compression.Stream(options.compress_level)
+
+    if busLink is None:
+        if session is not None:
+            takeSession(session)
+        admitClient(conn, data, username, 'resume' in requested, session)
+        return True
+
+    data.name = username
+    data.state = 'claiming'
+    claims[username] = (conn, data)
+    sendBus(bus.CLAIM, username.encode(FORMAT))
+    return False
+
+
+def rejectRegistration(conn, data, controlMsg):
+    """Answers a failed registration and closes the connection afterwards
+
+    Args:
+        conn (socket object): the client connection
+        data (Connection): the data registered with the selector
+        controlMsg (string): the status line to answer with
+    """
+    log.info('register', '{status} from client address: {addr}', status=controlMsg, addr=data.addr)
+    registrations.labels(controlMsg[:3]).value += 1
+    data.compression = None     # the answer is not compressed, and nothing follows it
+    queueStatus(conn, data, controlMsg)
+    data.state = 'rejected'
+    data.closing = True
+
+
+def admitClient(conn, data, username, resumable=False, session=None):
+    """Adds a client to the registry once its nickname is known to be free
+
+    The answer to the registration is always an uncompressed text line,
+    a CHAT/2.0 client switches to binary frames after it and a client that
+    asked for compression compresses everything after its registration line.
+
+    Args:
+        conn (socket object): the client connection
+        data (Connection): the data registered with the selector
+        username (string): the registered nickname
+        resumable (bool): whether the client asked for a resume token
+        session (SimpleNamespace): the session the client resumes, if any
+    """
+    queueStatus(conn, data, '200 Registration successful')
+    registrations.labels('200').value += 1
+    data.packed = len(data.outbox)
+
+    log.info('register', 'Connection to client estatblished, waiting to reveive messages '
+             'from user "{name}" ... ', name=username)
+
+    data.name = username
+    data.state = 'registered'
+    data.binary = data.version == 'CHAT/2.0'
+    data.reader.lengthPrefixed = data.binary
+    connectionRegistry.register(data)
+    data.delivered = history.last
+    announceClient(federation.ANNOUNCE, username)
+
+    log.info('register', 'Number of connected client:  {clients}', clients=len(clients))
+
+    if resumable and busLink is None and options.resume_grace > 0:
+        openSession(conn, data, session)
+
+    data.lastSeen = time.monotonic()
+    scheduleHeartbeat(conn, data)
+
+    if data.compression is not None:
+        try:
+            data.reader.decompressFrom(data.compression)
+        except ValueError:
+            log.warning('compression', 'Invalid compressed data from user {name}', name=username)
+            data.closing = True
+            return
+
+    # messages that arrived together with the registration, or while
+    # the nickname was being claimed
+
+    processFrames(conn, data)
+
+
+def findSession(message):
+    """Looks up the session a registration line asks to resume
+
+    Args:
+        message (string): the line, e.g. REGISTER luca CHAT/1.0 resume=<token>
+
+    Returns:
+        [SimpleNamespace]: the session, None if the line does not name one
+        that is still kept for the same nickname
+    """
+    parts = message.split()
+    for option in parts[3:]:
+        key, _, token = option.partition('=')
+        session = sessions.get(token) if key == 'resume' else None
+        if session is not None and session.name == parts[1]:
+            return session
+    return None
+
+
+def newSession(name, token):
+    """Creates the session of a registered client
+
+    Args:
+        name (string): the registered nickname
+        token (string): the resume token
+
+    Returns:
+        [SimpleNamespace]: the session, attached to no connection yet
+    """
+    return types.SimpleNamespace(
+        name=name,
+        token=token,
+        client=None,        # the Connection record, None while the client is lost
+        seq=0,              # the newest broadcast the client was sent
+        rooms=set(),        # the rooms the client was in when it was lost
+        missed=deque(maxlen=RESUME_HELD),   # room and direct messages held for it
+        expires=0,          # when the nickname is given up, time.monotonic()
+        timer=None
+    )
+
+
+def openSession(conn, data, session):
+    """Gives a registered client a resume token, and resumes its session
+
+    The token is new for every connection. A resuming client is put back
+    into its rooms, gets the room and direct messages held for it, and a
+    replay of the broadcasts after the last one it was sent, which ends
+    with 200 History through <seq>.
+
+    Args:
+        conn (socket object): the client connection
+        data (Connection): the data registered with the selector
+        session (SimpleNamespace): the session to resume, None for a new one
+    """
+    token = secrets.token_hex(16)
+    resumed = session is not None
+    if not resumed:
+        session = newSession(data.name, token)
+    session.token = token
+    session.client = data
+    sessions[token] = session
+    data.token = token
+
+    queueStatus(conn, data, f'200 Resume {token}')
+    if not resumed:
+        return
+
+    log.info('resume', 'User {name} resumed after broadcast {seq}, {held} messages held',
+             name=data.name, seq=session.seq, held=len(session.missed))
+    resumes.value += 1
+
+    for room in session.rooms:
+        addMembership(data, room)
+    for frames in session.missed:
+        queueMessage(conn, data, frames[data.binary])
+    session.missed.clear()
+    startReplay(conn, data, *replayRange(session.seq + 1))
+    data.delivered = session.seq
+
+
+def takeSession(session):
+    """Frees the nickname of a session for the connection that resumes it
+
+    A connection still registered with the session is stale, the client
+    would not have come back otherwise, and is closed.
+
+    Args:
+        session (SimpleNamespace): the session
+    """
+    endSession(session)
+    stale = session.client
+    if stale is None:
+        return
+
+    log.info('resume', 'User {name} came back, closing its stale connection', name=stale.name)
+    stale.token = None
+    session.seq = stale.delivered
+    session.rooms = set(stale.rooms)
+    disconnectClient(stale.conn, stale)
+
+
+def detachSession(data):
+    """Keeps the nickname and the messages of a lost client for it to resume
+
+    Args:
+        data (Connection): the data of the lost connection
+    """
+    session = sessions[data.token]
+    session.client = None
+    session.seq = data.delivered
+    session.rooms = set(data.rooms)
+    reserveSession(session, options.resume_grace)
+
+
+def reserveSession(session, grace):
+    """Keeps the nickname of a session and holds the messages of its rooms
+
+    Args:
+        session (SimpleNamespace): the session of a lost client
+        grace (float): seconds until the nickname is given up
+    """
+    session.expires = time.monotonic() + grace
+    session.timer = wheel.schedule(grace, expireSession, session)
+    reserved[session.name] = session
+    for room in session.rooms:
+        away.setdefault(room, dict())[session.token] = session
+
+
+def endSession(session):
+    """Forgets a session, and gives its nickname up if it was kept
+
+    Args:
+        session (SimpleNamespace): the session
+    """
+    sessions.pop(session.token, None)
+    wheel.cancel(session.timer)
+    session.timer = None
+    if reserved.get(session.name) is session:
+        del reserved[session.name]
+    for room in session.rooms:
+        members = away.get(room)
+        if members is not None:
+            members.pop(session.token, None)
+            if not members:
+                del away[room]
+
+
+def expireSession(session):
+    """Gives up on a lost client that did not come back in time
+
+    Args:
+        session (SimpleNamespace): the session
+    """
+    log.info('resume', 'User {name} did not come back, giving up the nickname', name=session.name)
+    endSession(session)
+    announceClient(federation.RELEASE, session.name)
+
+
+def expireHandshake(conn, data):
+    """Closes a connection whose registration did not arrive in time
+
+    Args:
+        conn (socket object): the client connection
+        data (Connection): the data registered with the selector
+    """
+    if data.state != 'handshaking' or data.closed:
+        return
+    log.info('register', 'Registration timed out for client address: {addr}', addr=data.addr)
+    registrations.labels('408').value += 1
+    handshakes.pop(data.fd)
+    queueStatus(conn, data, '408 Registration timeout')
+    data.closing = True
+
+
+def scheduleHeartbeat(conn, data):
+    """Schedules the next look at a registered client's silence
+
+    The timer is not moved on every message. It fires when the client
+    could have been silent long enough, and checkIdle looks at lastSeen.
+
+    Args:
+        conn (socket object): the client connection
+        data (Connection): the data registered with the selector
+    """
+    now = time.monotonic()
+    due = []
+    if options.idle_timeout > 0:
+        due.append(data.lastSeen + options.idle_timeout)
+    if options.heartbeat > 0:
+        due.append(max(data.lastSeen, data.pingSent) + options.heartbeat)
+    if due:
+        data.timer = wheel.schedule(min(due) - now, checkIdle, conn, data)
+
+
+def checkIdle(conn, data):
+    """Pings a client that went silent and disconnects one that stays silent
+
+    A silent client is pinged once per heartbeat interval until it answers
+    or the idle timeout is up.
+
+    Args:
+        conn (socket object): the client connection
+        data (Connection): the data registered with the selector
+    """
+    if data.closed or data.state != 'registered':
+        return
+
+    now = time.monotonic()
+    silent = now - data.lastSeen
+
+    if 0 < options.idle_timeout <= silent:
+        log.info('idle', 'Reaping idle client {name}, silent for {silent:.0f} seconds',
+                 name=data.name, silent=silent)
+        reaped.value += 1
+        disconnectClient(conn, data)
+        return
+
+    if 0 < options.heartbeat <= min(silent, now - data.pingSent):
+        data.ping += 1
+        data.pingSent = now
+        queueStatus(conn, data, f'PING {data.ping} {data.version}')
+
+    scheduleHeartbeat(conn, data)
+
+
+def disconnectClient(conn, data):
+    """Removes a client from the registry and closes its connection
+
+    A worker cut off from the bus would go on serving its clients out of
+    touch with the other workers, so losing the bus link shuts it down.
+
+    Args:
+        conn (socket object): the client connection
+        data (Connection): the data registered with the selector
+    """
+    if data.closed:
+        return
+
+    if data.state == 'bus':
+        data.closed = True
+        log.error('bus', 'Lost the connection to the bus, shutting down ...')
+        shutdown()
+
+    connectionRegistry.remove(data)
+    replays.pop(conn, None)
+    wheel.cancel(data.timer)
+    wheel.cancel(data.resume)
+    if sel.get_map().get(conn) is not None:
+        sel.unregister(conn)
+    conn.close()
+    data.closed = True
+
+    if data.token is not None and data.state == 'registered':
+        detachSession(data)
+
+    for room in list(data.rooms):
+        dropMembership(conn, data, room)
+
+    if data.compression is not None:
+        log.info('compression', 'Compression for client address {addr}: {summary}',
+                 addr=data.addr, summary=data.compression.counters.summary())
+        compressionTotals.add(data.compression.counters)
+
+    if data.state == 'registered':
+        log.info('disconnect', 'Disconnecting user {name}', name=data.name)
+        log.info('disconnect', 'new connected client size: {clients}', clients=len(clients))
+        if busLink is not None:
+            sendBus(bus.RELEASE, data.name.encode(FORMAT))
+        elif data.name not in reserved:
+            announceClient(federation.RELEASE, data.name)
+
+    if data.state == 'peer':
+        peerLost(data)
+
+
+def handleMessage(conn, data, message):
+    """Handles a single CHAT/1.0 line from a registered client
+
+    Args:
+        conn (socket object): the client connection
+        data (Connection): the data registered with the selector
+        message (bytes): the message without its line terminator
+
+    Returns:
+        [bool]: False if the client disconnected
+    """
+
+    # checked once here, so that neither the command, the target nor the
+    # text relayed to other clients can fail to decode further on
+
+    if not isText(message):
+        queueStatus(conn, data, '400 Invalid UTF-8')
+        return True
+
+    if message.startswith(COMMANDS):
+        return handleCommand(conn, data, message.decode(FORMAT))
+
+    # the header is @sender, @sender #room for a room message
+    # or @sender @recipient for a direct message
+    # everthing after the ': ' is the actual message
+
+    end = message.find(b': ')
+    if end < 0:
+        queueStatus(conn, data, '400 Malformed message')
+        return True
+
+    target = b''
+    if message.find(b' ', 0, end) >= 0:
+        words = message[:end].split()
+        if len(words) > 1:
+            target = words[1]
+
+    return routeMessage(conn, data, target, message[end + 2:])
+
+
+def isText(message):
+    """Checks that a message is valid UTF-8, without decoding plain ASCII
+
+    Args:
+        message (bytes): the message
+
+    Returns:
+        [bool]: whether it decodes
+    """
+    if message.isascii():
+        return True
+    try:
+        message.decode(FORMAT)
+    except UnicodeDecodeError:
+        return False
+    return True
+
+
+def handleBinaryFrame(conn, data, kind, body):
+    """Handles a single CHAT/2.0 frame from a registered client
+
+    Args:
+        conn (socket object): the client connection
+        data (Connection): the data registered with the selector
+        kind (int): the frame type
+        body (bytes): the frame body
+
+    Returns:
+        [bool]: False if the client disconnected
+    """
+    if kind == protocol.SEND:
+        if not isText(body):
+            queueStatus(conn, data, '400 Invalid UTF-8')
+            return True
+        target, separator, line = body.partition(b'\0')
+        if not separator:
+            queueStatus(conn, data, '400 Malformed message')
+            return True
+        return routeMessage(conn, data, target, line)
+
+    if kind == protocol.COMMAND:
+        if not isText(body):
+            queueStatus(conn, data, '400 Invalid UTF-8')
+            return True
+        return handleCommand(conn, data, body.decode(FORMAT))
+
+    queueStatus(conn, data, '400 Invalid frame')
+    return True
+
+
+def handleCommand(conn, data, command):
+    """Handles DISCONNECT, JOIN, LEAVE, HISTORY, STATS and PONG
+
+    Args:
+        conn (socket object): the client connection
+        data (Connection): the data registered with the selector
+        command (string): the command line
+
+    Returns:
+        [bool]: False if the client disconnected
+    """
+    parts = command.split()
+    if not parts:
+        queueStatus(conn, data, '400 Unknown command')
+        return True
+
+    # heartbeats are not worth a line in the log
+
+    if parts[0] == 'PONG':
+        if len(parts) == 3 and parts[1] == str(data.ping):
+            pingSeconds.observe(time.monotonic() - data.pingSent)
+        return True
+
+    log.debug('command', 'Received message from user {name}: {text}', name=data.name, text=command)
+
+    if parts[0] == 'DISCONNECT':
+        if data.token is not None:
+            endSession(sessions[data.token])
+            data.token = None
+        disconnectClient(conn, data)
+        return False
+
+    if parts[0] in ['JOIN', 'LEAVE']:
+        if len(parts) != 3 or parts[2] not in VERSIONS or not isRoomName(parts[1]):
+            queueStatus(conn, data, '400 Invalid room name')
+        elif parts[0] == 'JOIN':
+            joinRoom(conn, data, parts[1])
+        else:
+            leaveRoom(conn, data, parts[1])
+        return True
+
+    if parts[0] == 'HISTORY':
+        if (len(parts) != 4 or parts[3] not in VERSIONS or
+                parts[1] not in ['LAST', 'SINCE', 'SEARCH'] or
+                (parts[1] != 'SEARCH' and not parts[2].isdigit())):
+            queueStatus(conn, data, '400 Invalid history request')
+        elif parts[1] == 'LAST':
+            startReplay(conn, data, *replayRange(history.last - int(parts[2]) + 1))
+        elif parts[1] == 'SINCE':
+            startReplay(conn, data, *replayRange(int(parts[2]) + 1))
+        else:
+            startReplay(conn, data, searchBroadcasts(parts[2].encode(FORMAT)),
+                        '200 Search done')
+        return True
+
+    if parts[0] == 'STATS' and parts[1:] and parts[-1] in VERSIONS:
+        queueStatus(conn, data, statsLine())
+        return True
+
+    queueStatus(conn, data, '400 Unknown command')
+    return True
+
+
+def routeMessage(conn, data, target, message):
+    """Sends a chat message to everyone, a room or a single user
+
+    The text is never decoded, it is forwarded as it arrived.
+
+    Args:
+        conn (socket object): the client connection
+        data (Connection): the data registered with the selector
+        target (bytes): empty for everyone, #room or @nickname
+        message (bytes): the sent message
+
+    Returns:
+        [bool]: True, the client stays connected
+    """
+    if log.level <= eventlog.DEBUG:
+        log.debug('message', 'Received message from user {name}: {text}', name=data.name, text=message)
+    messagesIn.value += 1
+
+    # broadcast the message to everyone except self
+
+    if not target:
+        broadcast(data.name, message)
+        return True
+
+    if target.startswith(b'@'):
+        sendDirect(conn, data, target[1:].decode(FORMAT), message)
+        return True
+
+    room = target.decode(FORMAT)
+    if isRoomName(room):
+        if room in data.rooms:
+            broadcastRoom(data.name, room, message)
+        else:
+            queueStatus(conn, data, f'403 Not a member of {room}')
+        return True
+
+    # neither a room nor a nickname, the old header carried something else
+
+    broadcast(data.name, message)
+    return True
+
+
+def sendDirect(conn, data, recipient, message):
+    """Sends a message to a single user, found by nickname in O(1)
+
+    In multi-process mode a recipient that is not connected to this worker
+    is looked up by the bus hub, which forwards the message to its worker.
+    A recipient at another node of a federated cluster is sent the message
+    over the peer link its nickname was announced on.
+
+    Args:
+        conn (socket object): the sender's connection
+        data (Connection): the sender's selector data
+        recipient (string): the recipient's nickname
+        message (bytes): the sent message
+    """
+    body = f'{data.name}\0@{recipient}\0'.encode(FORMAT) + message
+    target = clients.get(recipient)
+
+    if target is not None:
+        queueMessage(target.conn, target, encodeMessage(body)[target.binary])
+    elif recipient in remoteClients:
+        sendPeer(remoteClients[recipient][1], federation.DIRECT, body)
+    elif busLink is not None:
+        sendBus(bus.DIRECT, recipient.encode(FORMAT) + b' ' + body)
+    elif recipient in reserved:
+        reserved[recipient].missed.append(encodeMessage(body))
+    else:
+        unknownRecipient(conn, data, recipient)
+
+
+def unknownRecipient(conn, data, recipient):
+    """Tells a sender that a direct message had nobody to go to
+
+    Args:
+        conn (socket object): the sender's connection
+        data (Connection): the sender's selector data
+        recipient (string): the nickname that is not registered
+    """
+    queueStatus(conn, data, f'404 Unknown recipient {recipient}')
+
+
+def startReplay(conn, data, broadcasts, status):
+    """Replays kept broadcasts to a client
+
+    Nothing is queued here, continueReplays feeds the replay into the
+    outbound queue as the client drains it. Broadcasts sent meanwhile are
+    delivered live, possibly ahead of the end of the replay. A new request
+    replaces a replay that is still in progress.
+
+    Args:
+        conn (socket object): the client connection
+        data (Connection): the data registered with the selector
+        broadcasts (iterator): yields the frames to replay, or None for a
+            broadcast that was looked at but is not sent
+        status (string): the status line that marks the end of the replay
+    """
+    data.replay = (broadcasts, status)
+    replays[conn] = data
+
+
+def replayRange(start):
+    """Prepares a replay of the broadcasts from a sequence number on
+
+    Args:
+        start (int): the first sequence number wanted, older ones are gone
+
+    Returns:
+        [iterator]: the broadcasts up to the newest one so far
+        [string]: 200 History through <seq>, the number to ask for
+        HISTORY SINCE next time
+    """
+    last = history.last
+    start = max(start, oldestBroadcast())
+    broadcasts = (keptBroadcast(seq) for seq in range(start, last + 1))
+    return broadcasts, f'200 History through {last}'
+
+
+def searchBroadcasts(text):
+    """Looks for kept broadcasts that contain a word, newest first
+
+    Args:
+        text (bytes): the word to look for
+
+    Yields:
+        [tuple]: the frames of a match, or None for every broadcast that is not one
+    """
+    found = 0
+    for seq in range(history.last, oldestBroadcast() - 1, -1):
+        frames = keptBroadcast(seq)
+        if frames is not None and text in frames[0]:
+            found += 1
+            yield frames
+            if found == SEARCH_RESULTS:
+                return
+        else:
+            yield None
+
+
+def continueReplays():
+    """Queues the next part of every replay in progress
+
+    A replay only tops up the client's queue to the low water mark, so it
+    goes out at the pace the client reads and never makes it a slow
+    consumer. It also looks at no more than REPLAY_BUDGET broadcasts per
+    loop pass, which bounds the time a search through the log takes away
+    from everyone else.
+    """
+    for conn, data in list(replays.items()):
+        broadcasts, status = data.replay
+
+        for _ in range(REPLAY_BUDGET):
+            if data.queued >= options.low_water or data.closed:
+                break
+            frames = next(broadcasts, False)
+            if frames is False:
+                del replays[conn]
+                data.replay = None
+                queueStatus(conn, data, status)
+                break
+            if frames is not None:
+                queueMessage(conn, data, frames[data.binary])
+
+
+def isRoomName(word):
+    """Checks whether a word names a room, e.g. #general
+
+    Args:
+        word (string): the word to check
+
+    Returns:
+        [bool]: whether it is a room name
+    """
+    return len(word) > 1 and word[0] == '#' and ':' not in word
+
+
+def joinRoom(conn, data, room):
+    """Adds a client to a room
+
+    Args:
+        conn (socket object): the client connection
+        data (Connection): the data registered with the selector
+        room (string): the room name
+    """
+    if room not in data.rooms:
+        addMembership(data, room)
+
+    queueStatus(conn, data, f'200 Joined {room}')
+
+
+def leaveRoom(conn, data, room):
+    """Removes a client from a room, answering 403 if it was not a member
+
+    Args:
+        conn (socket object): the client connection
+        data (Connection): the data registered with the selector
+        room (string): the room name
+    """
+    if room not in data.rooms:
+        queueStatus(conn, data, f'403 Not a member of {room}')
+        return
+
+    dropMembership(conn, data, room)
+    queueStatus(conn, data, f'200 Left {room}')
+
+
+def addMembership(data, room):
+    """Adds a client to the room index and the room to the client
+
+    Args:
+        data (Connection): the connection record
+        room (string): the room name
+    """
+    if not data.rooms:
+        data.rooms = set()
+    data.rooms.add(room)
+    members = rooms.get(room)
+    if members is None:
+        members = rooms[room] = set()
+        if busLink is not None:
+            sendBus(bus.SUBSCRIBE, room.encode(FORMAT))
+    members.add(data)
+
+
+def dropMembership(conn, data, room):
+    """Removes a client from the room index and the room from the client
+
+    Args:
+        conn (socket object): the client connection
+        data (Connection): the data registered with the selector
+        room (string): the room name
+    """
+    data.rooms.discard(room)
+    if not data.rooms:
+        data.rooms = NO_ROOMS
+    members = rooms[room]
+    members.discard(data)
+    if not members:
+        del rooms[room]
+        if busLink is not None:
+            sendBus(bus.UNSUBSCRIBE, room.encode(FORMAT))
+
+
+def broadcastRoom(clientName, room, message):
+    """Sends the message to the other members of a room
+
+    Only the room's members are visited, not every connected client. In
+    multi-process mode the hub forwards the message to the workers that
+    have members in the room. A federated cluster floods it to every node.
+
+    Args:
+        clientName (string): the registered nickname of the sender
+        room (string): the room name
+        message (bytes): the sent message
+    """
+    body = f'{clientName}\0{room}\0'.encode(FORMAT) + message
+    if busLink is not None:
+        sendBus(bus.ROOM_FRAME, room.encode(FORMAT) + b' ' + body)
+    if peerFlood is not None:
+        floodPeers(federation.FRAME, peerFlood.stamp(body))
+    deliverRoom(clientName, room, encodeMessage(body))
+
+
+def deliverRoom(clientName, room, frames):
+    """Queues an encoded message for the members of a room in this process
+
+    Args:
+        clientName (string): the registered nickname of the sender
+        room (string): the room name
+        frames (tuple): the message encoded for each protocol version
+    """
+    started = time.perf_counter()
+    for data in list(rooms.get(room, ())):
+        if data.name != clientName:
+            queueMessage(data.conn, data, frames[data.binary])
+    for session in away.get(room, {}).values():
+        session.missed.append(frames)
+    fanoutSeconds.observe(time.perf_counter() - started)
+
+
+def performService(key):
+    """Retrieve and broadcast every complete message from the client,
+    the first message of a new connection is its registration
+
+    Args:
+        key (events): the event key
+    """
+
+    conn = key.fileobj
+    data = key.data
+
+    try:
+        received = data.reader.fill(conn)
+    except BlockingIOError:
+        return
+    except ConnectionError:
+        received = 0
+    except ValueError:
+        log.warning('compression', 'Invalid compressed data from user {name}', name=data.name)
+        disconnectClient(conn, data)
+        return
+
+    if not received:
+        if data.state == 'registered':
+            log.info('disconnect', 'Received message from user {name}: DISCONNECT {name} CHAT/1.0',
+                     name=data.name)
+        disconnectClient(conn, data)
+        return
+
+    bytesIn.value += received
+    data.lastSeen = time.monotonic()
+
+    if data.state == 'handshaking':
+        try:
+            line = data.reader.line()
+        except ValueError:
+            line = None
+            log.warning('too-long', 'Message from client address {addr} is too long', addr=data.addr)
+            disconnectClient(conn, data)
+        if line is None:
+            return
+        registerClient(conn, data, line)
+
+    # while claiming a nickname the messages wait in the reader, as much
+    # of them as a single message may be long
+
+    if data.state == 'registered':
+        processFrames(conn, data)
+    else:
+        data.reader.keep()
+        if len(data.reader.pending) > MAX_FRAME_SIZE:
+            log.warning('too-long', 'Message from client address {addr} is too long', addr=data.addr)
+            disconnectClient(conn, data)
+
+
+def processFrames(conn, data):
+    """Handles every complete message the client sent so far
+
+    Args:
+        conn (socket object): the client connection
+        data (Connection): the data registered with the selector
+    """
+    reader = data.reader
+    limited = options.rate_limit > 0 or options.byte_limit > 0
+
+    while True:
+        try:
+            frames = reader.frames()
+        except ValueError:
+            log.warning('too-long', 'Message from user {name} is too long', name=data.name)
+            disconnectClient(conn, data)
+            return
+
+        if data.held:
+            frames = data.held + frames
+            data.held = ()
+
+        # every complete message of this readiness event goes out in one pass
+
+        for n, frame in enumerate(frames):
+
+            # chat messages are checked against the rate limit before they fan out
+
+            if limited and data.state == 'registered':
+                if data.binary:
+                    chat, size = frame[0] == protocol.SEND, len(frame[1])
+                else:
+                    chat, size = not frame.startswith(COMMANDS), len(frame)
+                wait = chat and takeTokens(data, size)
+                if wait:
+                    overLimit(conn, data)
+                    if options.rate_policy == 'drop':
+                        continue
+                    if options.rate_policy == 'delay':
+                        pauseReading(conn, data, frames[n:], wait)
+                    break
+
+            if data.binary:
+                connected = handleBinaryFrame(conn, data, *frame)
+            else:
+                connected = handleMessage(conn, data, frame)
+            if not connected:
+                break
+
+        # a compressed chunk is decompressed a step at a time, the next step
+        # once the messages of this one went out; resumeReading goes on with it
+
+        if data.closing or data.closed or data.paused or data.state != 'registered':
+            return
+        try:
+            if not reader.inflate():
+                return
+        except ValueError:
+            log.warning('compression', 'Invalid compressed data from user {name}', name=data.name)
+            disconnectClient(conn, data)
+            return
+
+
+def takeTokens(data, size):
+    """Takes a chat message out of the client's token buckets
+
+    The buckets fill up at --rate-limit messages and --byte-limit bytes per
+    second, up to their burst size. A message larger than the byte burst
+    costs the whole burst, so it goes out once the bucket is full.
+
+    Args:
+        data (Connection): the data registered with the selector
+        size (int): the message length in bytes
+
+    Returns:
+        [float]: 0 if the message may go out, otherwise the seconds until it may
+    """
+    now = time.monotonic()
+    elapsed = now - data.refilled
+    data.refilled = now
+    wait = 0
+    full = True
+
+    if options.rate_limit > 0:
+        data.tokens = min(options.rate_burst, data.tokens + elapsed * options.rate_limit)
+        full = data.tokens >= options.rate_burst
+        if data.tokens < 1:
+            wait = (1 - data.tokens) / options.rate_limit
+
+    cost = min(size, options.byte_burst)
+    if options.byte_limit > 0:
+        data.byteTokens = min(options.byte_burst, data.byteTokens + elapsed * options.byte_limit)
+        full = full and data.byteTokens >= options.byte_burst
+        if data.byteTokens < cost:
+            wait = max(wait, (cost - data.byteTokens) / options.byte_limit)
+
+    # a client that let its buckets fill up is told again next time it goes over
+
+    if full:
+        data.limited = False
+    if wait:
+        return wait
+
+    data.tokens -= 1
+    data.byteTokens -= cost
+    return 0
+
+
+def overLimit(conn, data):
+    """Counts a message over the rate limit and tells the client about it
+
+    The client gets a 429 once, not for every message, until it kept within
+    its limits long enough for the buckets to fill up again. With the
+    disconnect policy the 429 is the last thing it gets.
+
+    Args:
+        conn (socket object): the client connection
+        data (Connection): the data registered with the selector
+    """
+    rateLimited.labels(options.rate_policy).value += 1
+
+    if options.rate_policy == 'disconnect':
+        log.warning('rate-limit', 'Disconnecting user {name}, over the rate limit', name=data.name)
+        queueStatus(conn, data, '429 Rate limit exceeded')
+        data.closing = True
+        data.paused = True
+        watchEvents(conn, data)
+    elif not data.limited:
+        log.warning('rate-limit', 'User {name} is over the rate limit', name=data.name)
+        queueStatus(conn, data, '429 Rate limit exceeded')
+        data.limited = True
+
+
+def pauseReading(conn, data, frames, wait):
+    """Stops reading a client until its rate limit lets the next message out
+
+    The messages already read wait in data.held. Whatever the client sends
+    meanwhile waits in the socket buffers, so a client that keeps sending
+    is slowed down by TCP flow control instead of filling our memory.
+
+    Args:
+        conn (socket object): the client connection
+        data (Connection): the data registered with the selector
+        frames (list): the messages read but not handled yet
+        wait (float): seconds until the first of them may go out
+    """
+    data.held = frames
+    data.paused = True
+    watchEvents(conn, data)
+    data.resume = wheel.schedule(wait, resumeReading, conn, data)
+
+
+def resumeReading(conn, data):
+    """Handles the delayed messages and reads the client again
+
+    Args:
+        conn (socket object): the client connection
+        data (Connection): the data registered with the selector
+    """
+    if data.closed:
+        return
+    data.resume = None
+    data.paused = False
+    watchEvents(conn, data)
+    processFrames(conn, data)
+
+
+def writeService(key):
+    """Sends queued frames once the client socket is writable again
+
+    Args:
+        key (events): the event key
+    """
+    flushClient(key.fileobj, key.data)
+
+
+def statsLine():
+    """Summarises the metrics in one status line, the answer to STATS
+
+    Returns:
+        [string]: e.g. 200 Stats clients=2 connections=2 received=10 ...
+    """
+    def milliseconds(histogram):
+        seconds = histogram.quantile(0.99)
+        return f'{seconds * 1000:g}' if seconds is not None else '0'
+
+    return (f'200 Stats clients={len(clients)} connections={len(connections)} '
+            f'received={messagesIn.value} sent={messagesOut.value} '
+            f'dropped={messagesDropped.value} '
+            f'rate_limited={sum(c.value for c in rateLimited.children.values())} '
+            f'bytes_in={bytesIn.value} bytes_out={bytesOut.value} '
+            f'loop_p99_ms={milliseconds(loopSeconds)} '
+            f'fanout_p99_ms={milliseconds(fanoutSeconds)}')
+
+
+def openAdmin(number=None):
+    """Starts listening for metrics scrapes on the admin port or Unix socket
+
+    In multi-process mode worker n serves its own metrics on the admin
+    port plus n, or on the admin socket path followed by .n.
+
+    Args:
+        number (int): the worker's number in multi-process mode
+    """
+    global adminServer
+
+    if options.admin_socket:
+        path = options.admin_socket if number is None else f'{options.admin_socket}.{number}'
+        if os.path.exists(path):
+            os.unlink(path)
+        adminServer = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        adminServer.bind(path)
+        where = path
+    else:
+        port = options.admin_port + (number or 0)
+        adminServer = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        adminServer.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        adminServer.bind(('127.0.0.1', port))
+        where = f'127.0.0.1:{port}'
+
+    adminServer.listen()
+    adminServer.setblocking(False)
+    sel.register(adminServer, selectors.EVENT_READ)
+
+    log.info('startup', 'Serving metrics at {where}', where=where)
+
+
+def acceptAdmin():
+    """Accepts a metrics scrape, it is served like a client but never registers"""
+    try:
+        conn, addr = adminServer.accept()
+    except OSError:
+        return
+    conn.setblocking(False)
+
+    data = Connection(conn, addr)
+    data.state = 'admin'
+    sel.register(conn, selectors.EVENT_READ, data=data)
+    data.timer = wheel.schedule(options.handshake_timeout, expireAdmin, conn, data)
+
+
+def expireAdmin(conn, data):
+    """Closes a metrics scrape that was not done in time
+
+    A scraper gets as long as a client has to register, to send its request
+    and read the answer.
+
+    Args:
+        conn (socket object): the scrape connection
+        data (Connection): the data registered with the selector
+    """
+    if data.closed:
+        return
+    log.info('idle', 'Metrics scrape from {addr} timed out', addr=data.addr)
+    disconnectClient(conn, data)
+
+
+def adminService(key):
+    """Answers an HTTP request on the admin endpoint with the metrics
+
+    Any path is answered, once the request headers are complete.
+
+    Args:
+        key (events): the event key
+    """
+    conn = key.fileobj
+    data = key.data
+
+    try:
+        received = data.reader.fill(conn)
+    except BlockingIOError:
+        return
+    except OSError:
+        received = 0
 
-sel = selectors.DefaultSelector()
+    data.reader.keep()
+    pending = data.reader.pending
+    if not received or len(pending) > MAX_FRAME_SIZE:
+        disconnectClient(conn, data)
+        return
+    if data.closing or (b'\r\n\r\n' not in pending and b'\n\n' not in pending):
+        return
 
-clients = dict()  # clients: { Client Name: Client Connection }
+    body = registry.render().encode(FORMAT)
+    header = (f'HTTP/1.0 200 OK\r\n'
+              f'Content-Type: text/plain; version=0.0.4\r\n'
+              f'Content-Length: {len(body)}\r\n'
+              f'Connection: close\r\n\r\n').encode(FORMAT)
+    queueMessage(conn, data, header + body)
+    data.closing = True
 
 
-def broadcast(clientName, message):
-    """Broadcasts the message to all clients except for the sender
+def sendBus(kind, payload):
+    """Queues a message for the bus hub
+
+    The hub is a consumer like any client: once its queue grows past
+    bus.HIGH_WATER_MARK the chat messages for it are dropped until the
+    queue drains below the low water mark. Nickname and room messages are
+    always queued, they keep the workers in sync.
 
     Args:
-        clientName (string): the registered nickname 
-        message (string): the sent message
+        kind (int): the bus message kind
+        payload (bytes): the message body
     """
-    for name, conn in clients.items():
-        formatedMessage = f'@{clientName}: {message}'
-        if clientName == '':
-            conn.sendall(message.encode(FORMAT))
-        elif name != clientName:
-            conn.sendall(formatedMessage.encode(FORMAT))
+    if busData.throttled and kind in bus.CHAT:
+        busData.dropped += 1
+        messagesDropped.value += 1
+        return
 
+    busData.outbox.append(bus.encode(kind, payload))
+    busData.queued += len(busData.outbox[-1])
+    if not busData.dirty and not busData.writing:
+        busData.dirty = True
+        dirty.append((busLink, busData))
+
+    if busData.queued > bus.HIGH_WATER_MARK and not busData.throttled:
+        log.warning('slow-consumer', 'The bus hub is a slow consumer, {queued} bytes queued',
+                    queued=busData.queued)
+        busData.throttled = time.monotonic()
 
-def acceptClient(sock):
-    """Sign the user up through:
-    1. retrieve registered user name from 
+
+def busService(key):
+    """Handles the messages the bus hub sent to this worker
 
     Args:
-        sock (socket object): the socket
+        key (events): the event key
+    """
+    try:
+        received = busData.reader.fill(busLink)
+    except BlockingIOError:
+        return
+    except ConnectionError:
+        received = 0
+
+    if not received:
+        disconnectClient(busLink, busData)
+
+    for kind, payload in busData.reader.messages():
+        if kind == bus.FRAME:
+            frames = encodeMessage(payload)
+            recordBroadcast(payload, frames)
+            deliverLocal(None, frames)
+
+        elif kind == bus.ROOM_FRAME:
+            room, _, body = payload.partition(b' ')
+            deliverRoom(None, room.decode(FORMAT), encodeMessage(body))
+
+        elif kind == bus.DIRECT:
+            recipient, _, body = payload.partition(b' ')
+            target = clients.get(recipient.decode(FORMAT))
+            if target is not None:
+                queueMessage(target.conn, target, encodeMessage(body)[target.binary])
+
+        elif kind == bus.NO_RECIPIENT:
+            recipient, _, body = payload.partition(b' ')
+            sender = clients.get(body[:body.index(b'\0')].decode(FORMAT))
+            if sender is not None:
+                unknownRecipient(sender.conn, sender, recipient.decode(FORMAT))
+
+        elif kind in (bus.GRANT, bus.DENY):
+            username = payload.decode(FORMAT)
+            conn, data = claims.pop(username)
+
+            if kind == bus.GRANT and data.closed:
+                sendBus(bus.RELEASE, payload)
+            elif kind == bus.GRANT:
+                admitClient(conn, data, username)
+            elif not data.closed:
+                rejectRegistration(conn, data, '401 Client already registered')
+
+
+def openPeering(server):
+    """Joins the federated cluster, with --peer-port or --peer
+
+    Args:
+        server (socket object): the listening socket for clients, its
+        address is the default node name
     """
+    global peerFlood, peerServer
+
+    host, port = server.getsockname()[:2]
+    peerFlood = federation.Flood(options.node_name or f'{host}:{port}')
 
-    # accept connection
-    conn, addr = sock.accept()
+    if options.peer_port is not None:
+        peerServer = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        peerServer.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        peerServer.bind((host, options.peer_port))
+        peerServer.listen()
+        peerServer.setblocking(False)
+        sel.register(peerServer, selectors.EVENT_READ)
+        log.info('startup', 'Node {node} listening for peers on port {port}',
+                 node=peerFlood.node, port=peerServer.getsockname()[1])
 
+    for address in options.peer:
+        dialPeer(address)
+
+
+def acceptPeer():
+    """Accepts a link from a peer server"""
+    try:
+        conn, addr = peerServer.accept()
+    except OSError:
+        return
     conn.setblocking(False)
+    startPeer(conn, addr, None)
 
-    print(f'Accepted connection from client address: {addr}')
-    
-    # retrieves the username from the client
-    msg = conn.recv(BUFFER_SIZE).decode(FORMAT)
-    username = msg.lstrip('REGISTER ').rstrip(' CHAT/1.0')
 
-    # checks whether the entered nickname is valid
-    # checks whether the entered nickname already exists
+def dialPeer(address):
+    """Starts linking to a peer server without waiting for it
 
-    validRegistration = True
-    controlMsg = '200 Registration successful'
-    if 'REGISTER ' not in msg or ' CHAT/1.0' not in msg:
-        controlMsg = '400 Invalid registration'
-        validRegistration = False
-    elif username in clients:
-        controlMsg = '401 Client already registered'
-        validRegistration = False
+    The connection completes in the background, the event loop calls
+    peerDialed once the socket turns writable.
 
-    conn.sendall(controlMsg.encode(FORMAT))
+    Args:
+        address (tuple): the host and the port the peer listens for peers on
+    """
+    conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    conn.setblocking(False)
+    error = conn.connect_ex(address)
+    if error not in (0, errno.EINPROGRESS):
+        conn.close()
+        dialFailed(address, OSError(error, os.strerror(error)))
+        return
 
-    if validRegistration:
+    data = Connection(conn, address)
+    data.state = 'dialing'
+    data.timer = wheel.schedule(federation.CONNECT_TIMEOUT, dialTimedOut, data)
+    sel.register(conn, selectors.EVENT_WRITE, data=data)
+
+
+def peerDialed(data):
+    """Finishes a link dialPeer started, once its socket is writable
+
+    Args:
+        data (Connection): the dialing connection
+    """
+    wheel.cancel(data.timer)
+    sel.unregister(data.conn)
+    error = data.conn.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+    if error:
+        data.conn.close()
+        dialFailed(data.addr, OSError(error, os.strerror(error)))
+        return
+    startPeer(data.conn, data.addr, data.addr)
 
-        print(
-            f'Connection to client estatblished, waiting to reveive messages from user "{username}" ... ')
 
-        clients[username] = conn    # add client to the dicitonary
+def dialTimedOut(data):
+    """Gives up on a peer that did not accept the link within CONNECT_TIMEOUT
 
-        # selectors module allows us store data
-        # the following code creates the data and stores it
-        # using the register method
+    Args:
+        data (Connection): the dialing connection
+    """
+    sel.unregister(data.conn)
+    data.conn.close()
+    dialFailed(data.addr, TimeoutError('timed out'))
 
-        data = types.SimpleNamespace(
-            name=username
-        )
 
-        sel.register(conn, selectors.EVENT_READ, data=data)
+def dialFailed(address, error):
+    """Tries to link to a peer again later
 
-        print('Number of connected client: ', len(clients))
+    Args:
+        address (tuple): the host and the port the peer listens for peers on
+        error (OSError): why the link failed
+    """
+    log.warning('peer', 'Could not link to peer {addr}: {error}', addr=address, error=error)
+    wheel.schedule(federation.RETRY_INTERVAL, dialPeer, address)
 
 
-def performService(key):
-    """Retrieve and broadcast the message from the client
+def startPeer(conn, addr, address):
+    """Says HELLO on a new peer link
 
     Args:
-        key (events): the event key
+        conn (socket object): the link
+        addr (tuple): the peer address
+        address (tuple): where to dial the peer again once the link is lost,
+        None if the peer dialed us
+    """
+    data = Connection(conn, addr)
+    data.state = 'peer'
+    data.reader = bus.BusReader()
+    sel.register(conn, selectors.EVENT_READ, data=data)
+    peerLinks[data] = address
+    sendPeer(data, federation.HELLO, peerFlood.node.encode(FORMAT))
+
+
+def sendPeer(data, kind, payload):
+    """Queues a message for a peer link
+
+    Peer links are never throttled, like the bus.
+
+    Args:
+        data (Connection): the link
+        kind (int): the federation message kind
+        payload (bytes): the message
+    """
+    frame = protocol.encode(kind, payload)
+    data.outbox.append(frame)
+    data.queued += len(frame)
+    peerMessages.labels(federation.NAMES[kind]).value += 1
+    if not data.dirty and not data.writing:
+        data.dirty = True
+        dirty.append((data.conn, data))
+
+
+def floodPeers(kind, payload, origin=None):
+    """Sends a flooded message to every peer link but the one it came from
+
+    Args:
+        kind (int): the federation message kind
+        payload (bytes): the message, its origin and sequence number in front
+        origin (Connection): the link it came from, None if this node sent it
+    """
+    for data in peerLinks:
+        if data is not origin and data.name is not None and not data.closed:
+            sendPeer(data, kind, payload)
+
+
+def announceClient(kind, name):
+    """Tells the cluster this node registered or gave up a nickname
+
+    Args:
+        kind (int): federation.ANNOUNCE or federation.RELEASE
+        name (string): the nickname
     """
+    if peerFlood is not None:
+        floodPeers(kind, peerFlood.stamp(f'{name}\0{peerFlood.node}'.encode(FORMAT)))
+
 
+def peerService(key):
+    """Handles the messages a peer server sent over its link
+
+    Args:
+        key (events): the event key
+    """
     conn = key.fileobj
     data = key.data
 
-    message = conn.recv(BUFFER_SIZE).decode(FORMAT)
+    try:
+        received = data.reader.fill(conn)
+    except BlockingIOError:
+        return
+    except OSError:
+        received = 0
+
+    if not received:
+        disconnectClient(conn, data)
+        return
+
+    try:
+        for kind, payload in data.reader.messages():
+            handlePeerMessage(data, kind, payload)
+            if data.closed:
+                return
+    except ValueError:
+        log.warning('peer', 'Invalid message from node {node}', node=data.name)
+        disconnectClient(conn, data)
+
+
+def handlePeerMessage(data, kind, payload):
+    """Handles a single message from a peer link
+
+    Args:
+        data (Connection): the link
+        kind (int): the federation message kind
+        payload (bytes): the message
+
+    Raises:
+        ValueError: if the message is malformed
+    """
+    if kind == federation.HELLO:
+        node = payload.decode(FORMAT)
+        if node == peerFlood.node:
+            log.error('peer', 'Peer {addr} is this node, or has the same --node-name',
+                      addr=data.addr)
+            peerLinks[data] = None
+            disconnectClient(data.conn, data)
+            return
+        data.name = node
+        log.info('peer', 'Linked to node {node} at {addr}', node=node, addr=data.addr)
+
+        # everything this node knows of, the peer passes on what is new to it
+
+        for name in list(clients) + list(reserved):
+            sendPeer(data, federation.KNOWN, f'{name}\0{peerFlood.node}'.encode(FORMAT))
+        for name, (owner, _) in remoteClients.items():
+            sendPeer(data, federation.KNOWN, f'{name}\0{owner}'.encode(FORMAT))
+        return
+
+    if data.name is None:
+        raise ValueError('message before HELLO')
+
+    if kind == federation.KNOWN:
+        name, owner = payload.decode(FORMAT).split('\0')
+        if learnClient(name, owner, data, owner == data.name):
+            floodPeers(federation.ANNOUNCE, peerFlood.stamp(payload), data)
+        return
+
+    if kind in federation.FLOODED:
+        accepted = peerFlood.accept(payload)
+        if accepted is None:
+            return
+        origin, body = accepted
+
+        if kind == federation.ANNOUNCE:
+            name, owner = body.decode(FORMAT).split('\0')
+
+            # the owner's own announcements go everywhere, they set the way to it
+
+            if learnClient(name, owner, data, origin == owner) or origin == owner:
+                floodPeers(kind, payload, data)
+
+        elif kind == federation.RELEASE:
+            name, owner = body.decode(FORMAT).split('\0')
+            if remoteClients.get(name, (None,))[0] == owner:
+                del remoteClients[name]
+                floodPeers(kind, payload, data)
+
+        elif kind == federation.RESYNC:
+            floodPeers(kind, payload, data)
+            announceAll()
+
+        else:
+            floodPeers(kind, payload, data)
+            frames = encodeMessage(body)
+            room = body.split(b'\0', 2)[1].decode(FORMAT)
+            if room:
+                deliverRoom(None, room, frames)
+            else:
+                recordBroadcast(body, frames)
+                deliverLocal(None, frames)
+
+    elif kind == federation.DIRECT:
+        recipient = payload.split(b'\0', 2)[1][1:].decode(FORMAT)
+        target = clients.get(recipient)
+        if target is not None:
+            queueMessage(target.conn, target, encodeMessage(payload)[target.binary])
+        elif recipient in reserved:
+            reserved[recipient].missed.append(encodeMessage(payload))
+        elif recipient in remoteClients and remoteClients[recipient][1] is not data:
+            sendPeer(remoteClients[recipient][1], kind, payload)
+        else:
+            sendPeer(data, federation.NO_RECIPIENT, payload)
+
+    elif kind == federation.NO_RECIPIENT:
+        sender, target, _ = payload.decode(FORMAT, 'replace').split('\0', 2)
+        local = clients.get(sender)
+        if local is not None:
+            unknownRecipient(local.conn, local, target[1:])
+        elif sender in remoteClients and remoteClients[sender][1] is not data:
+            sendPeer(remoteClients[sender][1], kind, payload)
+
+
+def learnClient(name, owner, link, fromOwner=False):
+    """Takes note of a nickname registered at another node
+
+    A nickname registered at two nodes is kept by the node whose name sorts
+    first. If that is this node, the other one is told again; if it is the
+    other one, the client here is disconnected.
+
+    Args:
+        name (string): the nickname
+        owner (string): the node it is registered at
+        link (Connection): the peer link the news came over, and the way to the owner
+        fromOwner (bool): whether the owner itself sent the news, so the link
+            is a working way to it even if the nickname is known already
+
+    Returns:
+        [bool]: whether it was news, to be passed on to the other links
+    """
+    if owner == peerFlood.node:
+        return False
+
+    local = clients.get(name)
+    if local is not None or name in reserved:
+        if peerFlood.node < owner:
+            announceClient(federation.ANNOUNCE, name)
+            return False
+        log.warning('peer', 'User {name} registered at node {node} too, disconnecting it here',
+                    name=name, node=owner)
+        if name in reserved:
+            endSession(reserved[name])
+        if local is not None:
+            if local.token is not None:
+                endSession(sessions[local.token])
+                local.token = None
+            queueStatus(local.conn, local, '401 Client already registered')
+            local.closing = True
+            clients.pop(name)
+
+    known = remoteClients.get(name)
+    if known is not None and (known[0] < owner or (known[0] == owner and not fromOwner)):
+        return False
+    remoteClients[name] = (owner, link)
+    return known is None or known[0] != owner
+
+
+def announceAll():
+    """Announces every nickname of this node again, after a link was lost somewhere"""
+    for name in list(clients) + list(reserved):
+        announceClient(federation.ANNOUNCE, name)
+
+
+def peerLost(data):
+    """Looks for another way to the nicknames behind a lost peer link, and dials it again
+
+    Args:
+        data (Connection): the link
+    """
+    address = peerLinks.pop(data, None)
+    behind = sum(1 for _, link in remoteClients.values() if link is data)
+    log.warning('peer', 'Lost the link to node {node}, {count} remote clients behind it',
+                node=data.name or data.addr, count=behind)
+
+    if data.name is not None:
+        floodPeers(federation.RESYNC, peerFlood.stamp(b''))
+        announceAll()
+        wheel.schedule(federation.RESYNC_TIMEOUT, releaseUnreachable)
+    if address is not None:
+        wheel.schedule(federation.RETRY_INTERVAL, dialPeer, address)
+
+
+def releaseUnreachable():
+    """Releases the nicknames whose way still leads over a lost link"""
+    gone = [name for name, (_, link) in remoteClients.items() if link.closed]
+    for name in gone:
+        owner, _ = remoteClients.pop(name)
+        floodPeers(federation.RELEASE, peerFlood.stamp(f'{name}\0{owner}'.encode(FORMAT)))
+    if gone:
+        log.warning('peer', '{count} remote clients gone, their nodes cannot be reached',
+                    count=len(gone))
+
+
+# the connection fields a hot upgrade carries over as they are
+HANDED_OVER = ('name', 'state', 'version', 'binary', 'lastSeen', 'ping', 'pingSent',
+               'throttled', 'dropped', 'tokens', 'byteTokens', 'refilled', 'limited', 'closing',
+               'token', 'delivered')
+
+
+def startUpgrade():
+    """Starts a new server process to hand every connection over to, on SIGUSR2
+
+    The new process runs the same command line, so it picks up whatever
+    server.py is on disk now. It gets one end of a Unix socket pair and says
+    READY on it once it is up, the old process keeps serving until then.
+    """
+    global upgradeLink, upgradeProcess
+
+    if upgradeLink is not None:
+        return
+    if busLink is not None:
+        log.warning('upgrade', 'Hot upgrade is not supported with --workers')
+        return
+    if peerFlood is not None:
+        log.warning('upgrade', 'Hot upgrade is not supported in a federated cluster')
+        return
+
+    parentEnd, childEnd = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    argv = list(sys.argv)
+    if '--upgrade-fd' in argv:
+        at = argv.index('--upgrade-fd')
+        del argv[at:at + 2]
+    upgradeProcess = subprocess.Popen(
+        [sys.executable, *argv, '--upgrade-fd', str(childEnd.fileno())],
+        pass_fds=[childEnd.fileno()])
+    childEnd.close()
+
+    log.info('upgrade', 'Starting process {pid} to hand over to', pid=upgradeProcess.pid)
+    upgradeLink = parentEnd
+    upgradeLink.settimeout(UPGRADE_TIMEOUT)
+    sel.register(upgradeLink, selectors.EVENT_READ)
+
+
+def abandonUpgrade(reason):
+    """Gives up on a hot upgrade and carries on serving
+
+    Args:
+        reason (string): what went wrong
+    """
+    global upgradeLink, upgradeProcess
+
+    log.error('upgrade', 'Hot upgrade failed, {reason}, carrying on', reason=reason)
+    sel.unregister(upgradeLink)
+    upgradeLink.close()
+    upgradeLink = None
+    if upgradeProcess.poll() is None:
+        upgradeProcess.kill()
+    upgradeProcess = None
+
+    if options.log_dir and messageLog is None:
+        openLog(options.log_dir)
+
+
+def upgradeService(server):
+    """Hands over once the new process says it is ready
+
+    Args:
+        server (socket object): the listening socket
+    """
+    try:
+        kind, _, _ = upgrade.receiveMessage(upgradeLink)
+    except (OSError, ValueError):
+        kind = None
+    if kind != upgrade.READY:
+        abandonUpgrade('the new process did not start')
+        return
+    handOver(server)
+
+
+def handOver(server):
+    """Sends the listening sockets, every connection and the history to the new process
+
+    Everything queued is flushed first and replays in progress are queued
+    in full, what the sockets did not take yet travels with them. Compressed
+    connections cannot travel, the state of their zlib streams stays in this
+    process, so they are told DISCONNECT CHAT/1.0 like on shutdown. Once the
+    new process took everything, this one closes its copies of the sockets,
+    which the clients do not notice, and exits.
+
+    Args:
+        server (socket object): the listening socket
+    """
+    global messageLog
 
-    if message and 'DISCONNECT' not in message:
+    for conn, data in list(replays.items()):
+        broadcasts, status = data.replay
+        for frames in broadcasts:
+            if frames is not None:
+                data.outbox.append(frames[data.binary])
+                data.queued += len(frames[data.binary])
+        queueStatus(conn, data, status)
+        data.replay = None
+    replays.clear()
 
-        # retrieves the name from the message
+    for data in list(connections.values()):
+        if data.compression is not None:
+            queueStatus(data.conn, data, 'DISCONNECT CHAT/1.0')
+            flushClient(data.conn, data)
+            disconnectClient(data.conn, data)
+    flushPending()
 
-        nickname = message.split(':')[0]
-        nickname = nickname.lstrip('@')
+    # the durable log is reopened by the new process
 
-        # everthing after the ': ' is the actual message
+    if messageLog is not None:
+        messageLog.close()
+        messageLog = None
 
-        line = message[message.index(': ') + 1:]
+    listeners = [server] + ([adminServer] if adminServer is not None else [])
+    state = {
+        'pid': os.getpid(),
+        'last': history.last,
+        'history': [encodeBytes(frames[1][protocol.HEADER.size:])
+                    for _, frames in history.entries],
+        'admin': adminServer is not None,
+        'sessions': [describeSession(session) for session in reserved.values()],
+    }
+    handed = list(connections.values())
 
-        print(f'Received message from user {data.name}: {line}')
+    try:
+        upgrade.sendMessage(upgradeLink, upgrade.STATE, json.dumps(state).encode(FORMAT),
+                            [listener.fileno() for listener in listeners])
+        for start in range(0, len(handed), upgrade.FDS_PER_MESSAGE):
+            batch = handed[start:start + upgrade.FDS_PER_MESSAGE]
+            records = [describeConnection(data) for data in batch]
+            upgrade.sendMessage(upgradeLink, upgrade.CONNECTIONS,
+                                json.dumps(records).encode(FORMAT),
+                                [data.fd for data in batch])
+        upgrade.sendMessage(upgradeLink, upgrade.DONE)
+        kind, _, _ = upgrade.receiveMessage(upgradeLink)
+    except (OSError, ValueError) as e:
+        kind = None
+        reason = str(e)
+    if kind != upgrade.TAKEN:
+        abandonUpgrade(reason if kind is None else 'the new process did not take over')
+        return
 
-        # broadcast the message to everyone except self
-        broadcast(data.name, line)
+    log.info('upgrade', 'Handed {count} connections over to process {pid}, exiting',
+             count=len(handed), pid=upgradeProcess.pid)
+    for data in handed:
+        data.conn.close()
+    for listener in listeners:
+        listener.close()
+    log.close()
+    sys.exit(0)
 
+
+def describeConnection(data):
+    """Describes a connection for the process that takes it over
+
+    Args:
+        data (Connection): the data registered with the selector
+
+    Returns:
+        [dict]: the fields in HANDED_OVER, the rooms, and the bytes received
+        but not handled and queued but not sent
+    """
+    record = {field: getattr(data, field) for field in HANDED_OVER}
+    record['addr'] = list(data.addr)
+    record['rooms'] = sorted(data.rooms)
+
+    # messages held back by the rate limit go back in front of the unread bytes
+
+    if data.reader.lengthPrefixed:
+        held = b''.join(protocol.encode(kind, body) for kind, body in data.held)
     else:
-        print(
-            f'Received message from user {data.name}: DISCONNECT {data.name} CHAT/1.0')
-        print('Disconnecting user', data.name)
-        clients.pop(data.name, None)
-        print(f'new connected client size: {len(clients)}')
-        sel.unregister(conn)
-        conn.close()
+        held = b''.join(frame + b'\n' for frame in data.held)
+    record['unread'] = encodeBytes(held + bytes(data.reader.pending))
+    record['outbox'] = encodeBytes(b''.join(data.outbox))
+    return record
 
 
-def main():
+def describeSession(session):
+    """Describes the session of a lost client for the process that takes it over
 
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.bind(ADDR)
+    Args:
+        session (SimpleNamespace): the session
+
+    Returns:
+        [dict]: the nickname, token, rooms and held messages, and the
+        seconds left to resume it
+    """
+    return {
+        'name': session.name,
+        'token': session.token,
+        'seq': session.seq,
+        'rooms': sorted(session.rooms),
+        'missed': [encodeBytes(frames[1][protocol.HEADER.size:]) for frames in session.missed],
+        'grace': max(0, session.expires - time.monotonic()),
+    }
+
+
+def encodeBytes(raw):
+    """Turns bytes into a JSON string
+
+    Args:
+        raw (bytes): the bytes
+
+    Returns:
+        [string]: base64
+    """
+    return base64.b64encode(raw).decode('ascii')
+
+
+def takeOver(fd):
+    """Takes the sockets and the history over from the server that started us
+
+    Args:
+        fd (int): our end of the upgrade link
+
+    Raises:
+        ConnectionError: if the old process went away before it was done
+
+    Returns:
+        [socket object]: the listening socket
+    """
+    global adminServer
+
+    link = socket.socket(fileno=fd)
+    link.settimeout(UPGRADE_TIMEOUT)
+    upgrade.sendMessage(link, upgrade.READY)
+
+    server = None
+    while True:
+        kind, payload, fds = upgrade.receiveMessage(link)
+
+        if kind == upgrade.STATE:
+            state = json.loads(payload)
+            server = socket.socket(fileno=fds[0])
+            if state['admin']:
+                adminServer = socket.socket(fileno=fds[1])
+                adminServer.setblocking(False)
+                sel.register(adminServer, selectors.EVENT_READ)
+            history.last = state['last'] - len(state['history'])
+            for body in state['history']:
+                history.append(encodeMessage(base64.b64decode(body)))
+            for record in state['sessions']:
+                adoptSession(record)
+
+        elif kind == upgrade.CONNECTIONS:
+            for record, connFd in zip(json.loads(payload), fds):
+                adoptConnection(socket.socket(fileno=connFd), record)
+
+        elif kind == upgrade.DONE:
+            break
+
+    upgrade.sendMessage(link, upgrade.TAKEN)
+    link.close()
+
+    log.info('upgrade', 'Took over {count} connections from process {pid}',
+             count=len(connections), pid=state['pid'])
+    return server
+
+
+def adoptConnection(conn, record):
+    """Serves a connection handed over by the old process from where it left off
+
+    Args:
+        conn (socket object): the client connection
+        record (dict): what describeConnection said about it
+    """
+    conn.setblocking(False)
+
+    data = Connection(conn, tuple(record['addr']))
+    for field in HANDED_OVER:
+        setattr(data, field, record[field])
+    data.reader.lengthPrefixed = data.binary and data.state == 'registered'
+    data.reader.pending = bytearray(base64.b64decode(record['unread']))
+
+    sel.register(conn, selectors.EVENT_READ, data=data)
+    connectionRegistry.add(data)
+
+    if data.state == 'handshaking':
+        data.timer = wheel.schedule(options.handshake_timeout, expireHandshake, conn, data)
+    elif data.state == 'registered':
+        connectionRegistry.register(data)
+        for room in record['rooms']:
+            addMembership(data, room)
+        scheduleHeartbeat(conn, data)
+        if data.token is not None:
+            session = sessions[data.token] = newSession(data.name, data.token)
+            session.client = data
+
+    outbox = base64.b64decode(record['outbox'])
+    if outbox:
+        data.outbox.append(outbox)
+        data.queued = len(outbox)
+        data.dirty = True
+        dirty.append((conn, data))
+
+
+def adoptSession(record):
+    """Keeps the nickname of a client the old process lost, for what is left of its grace
+
+    Args:
+        record (dict): what describeSession said about it
+    """
+    session = sessions[record['token']] = newSession(record['name'], record['token'])
+    session.seq = record['seq']
+    session.rooms = set(record['rooms'])
+    session.missed.extend(encodeMessage(base64.b64decode(body)) for body in record['missed'])
+    reserveSession(session, record['grace'])
+
+
+def serveAdopted():
+    """Handles the messages the old process received but did not get to"""
+    for data in list(connections.values()):
+        if data.state == 'handshaking' and b'\n' in data.reader.pending:
+            registerClient(data.conn, data, data.reader.line())
+        if data.state == 'registered' and not data.closed:
+            processFrames(data.conn, data)
+    flushPending()
+
+
+def shutdown():
+    """Tells every client that the server goes away and exits"""
+    disconnectMsg = 'DISCONNECT CHAT/1.0'
+    broadcastStatus(disconnectMsg)
+    flushPending()
+
+    for data in list(connections.values()):
+        if data.compression is not None:
+            compressionTotals.add(data.compression.counters)
+    if compressionTotals.rawOut or compressionTotals.rawIn:
+        log.info('compression', 'Compression totals: {summary}', summary=compressionTotals.summary())
+
+    if messageLog is not None:
+        messageLog.close()
 
-    print('Will wait for client messages at port ' +
-          str(server.getsockname()[1]))
+    log.close()
+    sys.exit(0)
 
-    server.listen()
+
+def serve(server):
+    """Runs the event loop on a listening socket until the process exits
+
+    Args:
+        server (socket object): the listening socket
+    """
     server.setblocking(False)
 
     sel.register(server, selectors.EVENT_READ)
 
     # create a closure for signalHandler
 
+    stopping = False
+
     def signalHandler(sig, frame):
         """Executed when a user press control + c"""
-        print('Interrupt received, shutting down ...')
-
-        disconnectMsg = 'DISCONNECT CHAT/1.0'
-        broadcast('', disconnectMsg)
+        nonlocal stopping
+        if stopping:
+            return
+        stopping = True
 
+        log.info('shutdown', 'Interrupt received, shutting down ...')
         server.close()
-        sys.exit(0)
+        shutdown()
 
     # Register our signal handler for shutting down.
 
     signal.signal(signal.SIGINT, signalHandler)
+    signal.signal(signal.SIGTERM, signalHandler)
+
+    def upgradeHandler(sig, frame):
+        """Executed on SIGUSR2, hands the clients over to a new server process"""
+        startUpgrade()
+
+    signal.signal(signal.SIGUSR2, upgradeHandler)
 
-    print('Waiting for incoming client connections ...')
+    log.info('startup', 'Waiting for incoming client connections ...')
+
+    # timers scheduled and frames queued before the loop started, e.g. the
+    # retry of a peer that was not up yet or the HELLO to one that was
+
+    timeout = wheel.advance(time.monotonic())
+    flushPending()
 
     while True:
 
-        events = sel.select(timeout=None)
-        for key, _ in events:
+        events = sel.select(timeout=timeout)
+        started = time.perf_counter()
+
+        for key, mask in events:
+
+            if key.fileobj is adminServer:
+                acceptAdmin()
+                continue
+
+            if key.fileobj is upgradeLink:
+                upgradeService(server)
+                continue
+
+            if key.fileobj is peerServer:
+                acceptPeer()
+                continue
 
             if key.data is None:
                 acceptClient(key.fileobj)
+                continue
+
+            if key.data.state == 'dialing':
+                peerDialed(key.data)
+                continue
+
+            if mask & selectors.EVENT_WRITE:
+                writeService(key)
+            if not mask & selectors.EVENT_READ or key.data.closed:
+                continue
+            if key.data is busData:
+                busService(key)
+            elif key.data.state == 'admin':
+                adminService(key)
+            elif key.data.state == 'peer':
+                peerService(key)
             else:
                 performService(key)
 
+        timeout = wheel.advance(time.monotonic())
+        continueReplays()
+        flushPending()
+
+        # a replay whose client took everything goes on right away
+
+        if any(not data.writing for data in replays.values()):
+            timeout = 0
+
+        loopSeconds.observe(time.perf_counter() - started)
+
+
+def startWorkers():
+    """Forks the worker processes and relays messages between them
+
+    The parent binds the port without listening on it. Every worker listens
+    on its own SO_REUSEPORT socket bound to the same port, so the kernel
+    spreads new connections over the workers' accept queues.
+    """
+    portHolder = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    portHolder.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    portHolder.bind(ADDR)
+    addr = portHolder.getsockname()
+
+    log.info('startup', 'Will wait for client messages at port {port}', port=addr[1])
+
+    links = []
+    pids = []
+
+    for number in range(options.workers):
+        parentEnd, workerEnd = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        pid = os.fork()
+
+        if pid == 0:
+            portHolder.close()
+            parentEnd.close()
+            for link in links:
+                link.close()
+            runWorker(addr, workerEnd, number)
+
+        workerEnd.close()
+        links.append(parentEnd)
+        pids.append(pid)
+
+    def signalHandler(sig, frame):
+        """Executed when a user press control + c, the workers shut down
+        and the hub returns once all of them are gone"""
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, signalHandler)
+    signal.signal(signal.SIGTERM, signalHandler)
+
+    bus.runHub(links)
+
+    for pid in pids:
+        os.waitpid(pid, 0)
+    log.close()
+
+
+def runWorker(addr, link, number):
+    """Serves clients in a forked worker process
+
+    Args:
+        addr (tuple): the address the parent reserved
+        link (socket object): this worker's end of the bus
+        number (int): the worker's number, it logs to worker<number> in the log directory
+    """
+    global busLink, busData
+
+    busLink = link
+    busLink.setblocking(False)
+    busData = Connection(busLink, None)
+    busData.name = 'bus'
+    busData.state = 'bus'
+    busData.reader = bus.BusReader()
+    sel.register(busLink, selectors.EVENT_READ, data=busData)
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    server.bind(addr)
+    server.listen(options.backlog)
+
+    if options.log_dir:
+        openLog(os.path.join(options.log_dir, f'worker{number}'))
+    if options.admin_port is not None or options.admin_socket:
+        openAdmin(number)
+
+    serve(server)
+
+
+def openLog(directory):
+    """Opens the durable log and continues its sequence numbers
+
+    Args:
+        directory (string): where the segment files live
+    """
+    global messageLog
+
+    messageLog = segmentlog.MessageLog(
+        directory,
+        segmentSize=options.log_segment_size,
+        retainSize=options.log_retain_size,
+        retainAge=options.log_retain_age,
+        fsync=options.log_fsync,
+        fsyncInterval=options.log_fsync_interval)
+    history.last = messageLog.last
+
+    log.info('startup', 'Logging broadcasts to {directory}, {logged} logged so far',
+             directory=directory, logged=messageLog.last)
+
+
+def main():
+
+    global options
+    options = getArgs()
+    log.configure(options.log_level, options.log_format, options.log_sample)
+
+    if options.engine == 'asyncio':
+        import aioserver
+        aioserver.main(options)
+        return
+
+    if options.workers > 1:
+        startWorkers()
+        return
+
+    # a hot upgrade takes the listening socket over instead of binding a new one
+
+    if options.upgrade_fd is not None:
+        server = takeOver(options.upgrade_fd)
+    else:
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(ADDR)
+        server.listen(options.backlog)
+
+    log.info('startup', 'Will wait for client messages at port {port}',
+             port=server.getsockname()[1])
+
+    if options.log_dir:
+        openLog(options.log_dir)
+    if adminServer is None and (options.admin_port is not None or options.admin_socket):
+        openAdmin()
+    if options.upgrade_fd is not None:
+        serveAdopted()
+    if options.peer or options.peer_port is not None:
+        openPeering(server)
+
+    serve(server)
+
 
 if __name__ == '__main__':
     main()
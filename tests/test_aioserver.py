@@ -0,0 +1,78 @@
+"""Tests for the message handling of the asyncio engine in aioserver.py"""
+
+import asyncio
+import unittest
+from unittest import mock
+
+import aioserver
+import server
+
+
+class ChatProtocolTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        patch = mock.patch.object(server.log, 'log')    # keeps the output quiet
+        patch.start()
+        self.addCleanup(patch.stop)
+
+        options = server.getArgs(['--engine', 'asyncio'])
+        loop = asyncio.get_running_loop()
+        self.server = await loop.create_server(lambda: aioserver.ChatProtocol(options), '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.alice = await self.register('alice')
+        self.bob = await self.register('bob')
+
+    async def asyncTearDown(self):
+        for protocol in list(aioserver.connections):
+            protocol.transport.close()
+        self.server.close()
+        await self.server.wait_closed()
+        await asyncio.sleep(0)
+        aioserver.clients.clear()
+
+    async def register(self, name):
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.port)
+        self.addCleanup(writer.close)
+        writer.write(f'REGISTER {name} CHAT/1.0\n'.encode())
+        self.assertEqual(await reader.readline(), b'200 Registration successful\n')
+        return reader, writer
+
+    async def answer(self, client, line):
+        reader, writer = client
+        writer.write(line)
+        return await asyncio.wait_for(reader.readline(), 1)
+
+    async def assertNothingReceived(self, client):
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(client[0].readline(), 0.1)
+
+    async def test_broadcast(self):
+        self.alice[1].write('@alice: café\n'.encode())
+        self.assertEqual(await asyncio.wait_for(self.bob[0].readline(), 1), '@alice: café\n'.encode())
+        await self.assertNothingReceived(self.alice)
+
+    async def test_direct_and_room_messages_are_not_broadcast(self):
+        for line in (b'@alice @bob: secret\n', b'@alice #room: hi\n'):
+            self.assertEqual(await self.answer(self.alice, line), b'400 Unsupported\n')
+        await self.assertNothingReceived(self.bob)
+
+    async def test_commands_other_than_disconnect_are_refused(self):
+        for line in (b'JOIN #room CHAT/1.0\n', b'HISTORY LAST 10 CHAT/1.0\n', b'LEAVE #room CHAT/1.0\n'):
+            self.assertEqual(await self.answer(self.alice, line), b'400 Unsupported\n')
+        await self.assertNothingReceived(self.bob)
+
+    async def test_malformed_and_invalid_messages_are_refused(self):
+        self.assertEqual(await self.answer(self.alice, b'hello\n'), b'400 Malformed message\n')
+        self.assertEqual(await self.answer(self.alice, b'@alice: caf\xe9\n'), b'400 Invalid UTF-8\n')
+        await self.assertNothingReceived(self.bob)
+
+    async def test_registration_that_is_not_utf8_is_refused(self):
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.port)
+        self.addCleanup(writer.close)
+        writer.write(b'REGISTER \xff CHAT/1.0\n')
+        self.assertEqual(await reader.readline(), b'400 Invalid registration\n')
+        self.assertEqual(await reader.read(), b'')
+
+
+if __name__ == '__main__':
+    unittest.main()
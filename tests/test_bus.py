@@ -0,0 +1,78 @@
+"""Tests for the bus hub in bus.py"""
+
+import socket
+import threading
+import unittest
+
+import bus
+
+
+class HubTest(unittest.TestCase):
+
+    def setUp(self):
+        # the hub runs in a thread, the test plays three workers
+        pairs = [socket.socketpair() for _ in range(3)]
+        self.workers = [worker for worker, _ in pairs]
+        for worker in self.workers:
+            worker.settimeout(5)
+        self.hub = threading.Thread(target=bus.runHub, args=([link for _, link in pairs],), daemon=True)
+        self.hub.start()
+        self.addCleanup(self.stop)
+
+    def stop(self):
+        for worker in self.workers:
+            worker.close()
+        self.hub.join(5)
+        self.assertFalse(self.hub.is_alive())
+
+    def receive(self, worker, until):
+        """Reads bus messages up to the first one of a kind
+
+        Args:
+            worker (socket): the worker end of a link
+            until (int): the bus message kind to stop after
+
+        Returns:
+            [list]: (kind, payload) tuples
+        """
+        reader = bus.BusReader()
+        messages = []
+        while not messages or messages[-1][0] != until:
+            self.assertTrue(reader.fill(worker))
+            messages += reader.messages()
+        return messages
+
+    def test_claims(self):
+        first, second, _ = self.workers
+        first.sendall(bus.encode(bus.CLAIM, b'alice'))
+        self.assertEqual(self.receive(first, bus.GRANT), [(bus.GRANT, b'alice')])
+        second.sendall(bus.encode(bus.CLAIM, b'alice'))
+        self.assertEqual(self.receive(second, bus.DENY), [(bus.DENY, b'alice')])
+
+    def test_stalled_worker_does_not_hold_up_the_others(self):
+        sender, reader, stalled = self.workers
+        frames = 800
+        frame = bus.encode(bus.FRAME, b'alice\0\0' + b'x' * 10000)
+        received = []
+        readerThread = threading.Thread(target=lambda: received.extend(self.receive(reader, bus.GRANT)))
+        readerThread.start()
+
+        # the claim after the FRAMEs tells when the hub got to the end of them
+
+        threading.Thread(target=sender.sendall, daemon=True,
+                         args=(frame * frames + bus.encode(bus.CLAIM, b'alice'),)).start()
+        self.assertEqual(self.receive(sender, bus.GRANT), [(bus.GRANT, b'alice')])
+        reader.sendall(bus.encode(bus.CLAIM, b'bob'))
+        readerThread.join(5)
+        self.assertEqual(len(received), frames + 1)
+
+        # the stalled worker missed chat messages, not the answer to its claim
+
+        stalled.sendall(bus.encode(bus.CLAIM, b'carol'))
+        received = self.receive(stalled, bus.GRANT)
+        self.assertLess(len(received), frames + 1)
+        self.assertEqual(received[-1], (bus.GRANT, b'carol'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+"""Tests for the zlib streams in compression.py"""
+
+import unittest
+import zlib
+
+import compression
+
+
+class StreamTest(unittest.TestCase):
+
+    def test_round_trip_over_several_batches(self):
+        sender, receiver = compression.Stream(), compression.Stream()
+        for batch in ([b'@alice: hello\n'], [b'@bob: hi\n', b'@alice: how are you?\n'], []):
+            self.assertEqual(receiver.decompress(sender.compress(batch)), b''.join(batch))
+        self.assertEqual(sender.counters.rawOut, receiver.counters.rawIn)
+        self.assertEqual(sender.counters.wireOut, receiver.counters.wireIn)
+
+    def test_chunk_past_the_limit_is_decompressed_in_steps(self):
+        lines = [b'@alice: the same line over and over\n'] * 200000
+        wire = compression.Stream().compress(lines)
+        self.assertLess(len(wire), 100 * 1024)
+
+        receiver = compression.Stream()
+        raw = bytearray()
+        for start in range(0, len(wire), 4096):    # as it comes off the wire
+            step = receiver.decompress(wire[start:start + 4096], 1024 * 1024)
+            while True:
+                self.assertLessEqual(len(step), 1024 * 1024)
+                raw += step
+                if not receiver.tail:
+                    break
+                step = receiver.decompress(b'', 1024 * 1024)
+        self.assertEqual(raw, b''.join(lines))
+
+    def test_decompression_bomb_is_decompressed_a_step_at_a_time(self):
+        wire = compression.Stream(zlib.Z_BEST_COMPRESSION).compress([b'a' * (10 * 1024 * 1024)])
+        self.assertLess(len(wire), 16 * 1024)
+
+        receiver = compression.Stream()
+        step = receiver.decompress(wire, 65536)
+        self.assertEqual(step, b'a' * 65536)
+        self.assertTrue(receiver.tail)
+        self.assertEqual(receiver.counters.rawIn, 65536)
+
+        total = len(step)
+        while receiver.tail:
+            total += len(receiver.decompress(b'', 65536))
+        self.assertEqual(total, 10 * 1024 * 1024)
+        self.assertEqual(receiver.counters.wireIn, len(wire))
+
+    def test_invalid_stream_is_refused(self):
+        with self.assertRaises(ValueError):
+            compression.Stream().decompress(b'REGISTER alice CHAT/1.0\n', 1024)
+
+    def test_decompressor_keeps_its_dictionary(self):
+        sender, receiver = compression.Stream(zlib.Z_BEST_COMPRESSION), compression.Stream()
+        first = sender.compress([b'@alice: a message that repeats\n'])
+        second = sender.compress([b'@alice: a message that repeats\n'])
+        self.assertLess(len(second), len(first))
+        receiver.decompress(first)
+        self.assertEqual(receiver.decompress(second), b'@alice: a message that repeats\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
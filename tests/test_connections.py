@@ -0,0 +1,142 @@
+"""Tests for the connection records of server.py"""
+
+import selectors
+import socket
+import tracemalloc
+import unittest
+from unittest import mock
+
+import bus
+import server
+
+
+class FakeSocket:
+    """Stands in for a socket, a record only asks it for its file descriptor"""
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    def fileno(self):
+        return self.fd
+
+
+def registeredRecord(registry, fd, name):
+    data = server.Connection(FakeSocket(fd), ('127.0.0.1', 40000 + fd))
+    registry.add(data)
+    data.name = name
+    data.state = 'registered'
+    registry.register(data)
+    return data
+
+
+class ConnectionRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = server.ConnectionRegistry()
+
+    def test_handshaking_connection_is_found_by_fd_only(self):
+        data = server.Connection(FakeSocket(7), ('127.0.0.1', 40007))
+        self.registry.add(data)
+        self.assertIs(self.registry.byFd[7], data)
+        self.assertIs(self.registry.handshaking[7], data)
+        self.assertEqual(self.registry.byName, {})
+        self.assertEqual(len(self.registry), 1)
+
+    def test_registered_connection_is_found_by_name(self):
+        data = registeredRecord(self.registry, 7, 'alice')
+        self.assertIs(self.registry.byName['alice'], data)
+        self.assertIs(self.registry.byFd[7], data)
+        self.assertEqual(self.registry.handshaking, {})
+
+    def test_remove_forgets_every_index(self):
+        data = registeredRecord(self.registry, 7, 'alice')
+        other = registeredRecord(self.registry, 8, 'bob')
+        self.registry.remove(data)
+        self.assertEqual(self.registry.byFd, {8: other})
+        self.assertEqual(self.registry.byName, {'bob': other})
+        self.assertEqual(len(self.registry), 1)
+
+    def test_remove_leaves_a_newer_owner_of_the_name(self):
+        old = registeredRecord(self.registry, 7, 'alice')
+        new = registeredRecord(self.registry, 8, 'alice')
+        self.registry.remove(old)
+        self.assertIs(self.registry.byName['alice'], new)
+
+    def test_idle_record_stays_small(self):
+        # the part of the ~1.5 KB per idle client in Capacity in the README
+        # that is the record, its reader and its registry entries
+
+        count = 5000
+        sockets = [FakeSocket(fd) for fd in range(1000, 1000 + count)]
+        names = [f'user{n}' for n in range(count)]
+        tracemalloc.start()
+        self.addCleanup(tracemalloc.stop)
+        before = tracemalloc.get_traced_memory()[0]
+        for sock, name in zip(sockets, names):
+            data = server.Connection(sock, ('127.0.0.1', sock.fd))
+            self.registry.add(data)
+            data.name = name
+            self.registry.register(data)
+        perRecord = (tracemalloc.get_traced_memory()[0] - before) / count
+        self.assertLess(perRecord, 768)
+
+
+class BusLinkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.link, self.hub = socket.socketpair()
+        self.link.setblocking(False)
+        data = server.Connection(self.link, None)
+        data.name = 'bus'
+        data.state = 'bus'
+        data.reader = bus.BusReader()
+        server.sel.register(self.link, selectors.EVENT_READ, data=data)
+
+        patches = [mock.patch.object(server, 'busLink', self.link),
+                   mock.patch.object(server, 'busData', data),
+                   mock.patch.object(server, 'shutdown', side_effect=SystemExit),
+                   mock.patch.object(server.log, 'error')]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.addCleanup(self.hub.close)
+        self.addCleanup(self.link.close)
+        self.addCleanup(self.unregister)
+
+    def unregister(self):
+        if server.sel.get_map().get(self.link) is not None:
+            server.sel.unregister(self.link)
+
+    def test_failed_write_shuts_the_worker_down(self):
+        self.hub.close()
+        server.sendBus(bus.RELEASE, b'alice')
+        with self.assertRaises(SystemExit):
+            server.flushPending()
+        server.shutdown.assert_called_once_with()
+        self.assertTrue(server.busData.closed)
+
+    def test_chat_messages_are_dropped_while_the_hub_is_slow(self):
+        patch = mock.patch.object(server.log, 'warning')
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.addCleanup(server.dirty.clear)
+
+        body = b'alice\0\0' + b'x' * 10000
+        for _ in range(bus.HIGH_WATER_MARK // len(body) + 1):
+            server.sendBus(bus.FRAME, body)
+        self.assertTrue(server.busData.throttled)
+        queued = server.busData.queued
+        server.sendBus(bus.FRAME, body)
+        self.assertEqual(server.busData.queued, queued)
+        server.sendBus(bus.CLAIM, b'bob')
+        self.assertGreater(server.busData.queued, queued)
+
+    def test_end_of_stream_shuts_the_worker_down(self):
+        self.hub.close()
+        with self.assertRaises(SystemExit):
+            server.busService(None)
+        server.shutdown.assert_called_once_with()
+
+
+if __name__ == '__main__':
+    unittest.main()
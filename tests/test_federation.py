@@ -0,0 +1,53 @@
+"""Tests for the flooding of messages between nodes in federation.py"""
+
+import unittest
+
+import federation
+
+
+class FloodTest(unittest.TestCase):
+
+    def setUp(self):
+        self.a = federation.Flood('a')
+        self.b = federation.Flood('b')
+
+    def test_message_is_accepted_once(self):
+        payload = self.a.stamp(b'alice\0a')
+        self.assertEqual(self.b.accept(payload), ('a', b'alice\0a'))
+        self.assertIsNone(self.b.accept(payload))
+
+    def test_own_messages_are_dropped(self):
+        self.assertIsNone(self.a.accept(self.a.stamp(b'alice\0a')))
+
+    def test_older_message_of_an_origin_is_dropped(self):
+        first = self.a.stamp(b'one')
+        second = self.a.stamp(b'two')
+        self.assertEqual(self.b.accept(second), ('a', b'two'))
+        self.assertIsNone(self.b.accept(first))
+
+    def test_restarted_node_is_not_a_replay(self):
+        self.b.accept(self.a.stamp(b'before'))
+        restarted = federation.Flood('a')
+        self.assertEqual(self.b.accept(restarted.stamp(b'after')), ('a', b'after'))
+
+    def test_body_may_hold_nul_bytes(self):
+        self.assertEqual(self.b.accept(self.a.stamp(b'\0room\0text')), ('a', b'\0room\0text'))
+
+    def test_payload_without_a_stamp_is_refused(self):
+        with self.assertRaises(ValueError):
+            self.b.accept(b'no stamp')
+
+
+class ParseAddressTest(unittest.TestCase):
+
+    def test_host_and_port(self):
+        self.assertEqual(federation.parseAddress('10.0.0.2:7001'), ('10.0.0.2', 7001))
+
+    def test_missing_port_is_refused(self):
+        for text in ('10.0.0.2', ':7001', '10.0.0.2:http'):
+            with self.assertRaises(ValueError):
+                federation.parseAddress(text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+"""Tests for the broadcast history of server.py and the HISTORY command"""
+
+import unittest
+from unittest import mock
+
+import protocol
+import server
+from tests.test_server import ServerTestCase
+
+
+def frames(text):
+    return server.encodeMessage(b'alice\0\0' + text)
+
+
+class HistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.history = server.History()
+
+    def limit(self, **limits):
+        for name, value in limits.items():
+            patch = mock.patch.object(server.options, name, value)
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_broadcasts_are_numbered_in_order(self):
+        self.assertEqual([self.history.append(frames(b'%d' % n)) for n in range(3)], [1, 2, 3])
+        self.assertEqual(self.history.first(), 1)
+        self.assertEqual(self.history.get(2), frames(b'1'))
+
+    def test_oldest_broadcasts_are_forgotten_past_the_count(self):
+        self.limit(history=3)
+        for n in range(5):
+            self.history.append(frames(b'%d' % n))
+        self.assertEqual((self.history.first(), self.history.last), (3, 5))
+        self.assertEqual(self.history.get(3), frames(b'2'))
+        self.assertEqual(len(self.history.entries), 3)
+
+    def test_oldest_broadcasts_are_forgotten_past_the_size(self):
+        size = sum(map(len, frames(b'x' * 10)))
+        self.limit(history_bytes=2 * size + 1)
+        for n in range(5):
+            self.history.append(frames(b'%010d' % n))
+        self.assertEqual((self.history.first(), self.history.last), (4, 5))
+        self.assertEqual(self.history.size, 2 * size)
+
+    def test_a_broadcast_over_the_size_is_not_kept(self):
+        self.limit(history_bytes=10)
+        self.assertEqual(self.history.append(frames(b'too long to keep')), 1)
+        self.assertEqual((self.history.first(), self.history.size), (2, 0))
+
+
+class HistoryCommandTest(ServerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        patch = mock.patch.object(server, 'history', server.History())
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.addCleanup(server.replays.clear)
+
+        self.alice, self.aliceData = self.register('alice')
+        self.bob, self.bobData = self.register('bob')
+        for text in (b'one', b'two', b'three'):
+            self.send(self.alice, self.aliceData, b'@alice: %s\n' % text)
+        self.received(self.bob)
+
+    def ask(self, peer, data, request):
+        """Sends a HISTORY request and returns the whole replay"""
+        self.send(peer, data, request)
+        while data.replay is not None:
+            server.continueReplays()
+            server.flushPending()
+        return self.received(peer)
+
+    def test_last(self):
+        self.assertEqual(self.ask(self.bob, self.bobData, b'HISTORY LAST 2 CHAT/1.0\n'),
+                         b'@alice: two\n@alice: three\n200 History through 3\n')
+
+    def test_since(self):
+        self.assertEqual(self.ask(self.bob, self.bobData, b'HISTORY SINCE 1 CHAT/1.0\n'),
+                         b'@alice: two\n@alice: three\n200 History through 3\n')
+        self.assertEqual(self.ask(self.bob, self.bobData, b'HISTORY SINCE 3 CHAT/1.0\n'),
+                         b'200 History through 3\n')
+
+    def test_forgotten_broadcasts_are_skipped(self):
+        with mock.patch.object(server.options, 'history', 2):
+            self.send(self.alice, self.aliceData, b'@alice: four\n')
+        self.received(self.bob)
+        self.assertEqual(self.ask(self.bob, self.bobData, b'HISTORY SINCE 0 CHAT/1.0\n'),
+                         b'@alice: three\n@alice: four\n200 History through 4\n')
+
+    def test_search_returns_the_newest_matches_first(self):
+        self.assertEqual(self.ask(self.bob, self.bobData, b'HISTORY SEARCH t CHAT/1.0\n'),
+                         b'@alice: three\n@alice: two\n200 Search done\n')
+        self.assertEqual(self.ask(self.bob, self.bobData, b'HISTORY SEARCH four CHAT/1.0\n'),
+                         b'200 Search done\n')
+
+    def test_replay_to_a_binary_client(self):
+        vee, veeData = self.register('vee', 'CHAT/2.0')
+        self.assertEqual(self.ask(vee, veeData, protocol.encode(protocol.COMMAND, b'HISTORY LAST 1 CHAT/2.0')),
+                         frames(b'three')[1] + protocol.encode(protocol.STATUS, b'200 History through 3'))
+
+    def test_invalid_request_is_refused(self):
+        for request in (b'HISTORY LAST many CHAT/1.0\n', b'HISTORY FIRST 2 CHAT/1.0\n',
+                        b'HISTORY LAST 2\n'):
+            self.assertEqual(self.ask(self.bob, self.bobData, request), b'400 Invalid history request\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
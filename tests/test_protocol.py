@@ -0,0 +1,77 @@
+"""Tests for the CHAT/2.0 framing in protocol.py"""
+
+import unittest
+
+import protocol
+
+
+class ReadFramesTest(unittest.TestCase):
+
+    def test_coalesced_frames_are_all_read(self):
+        data = (protocol.encode(protocol.SEND, b'\0hello') +
+                protocol.encode(protocol.COMMAND, b'JOIN #room CHAT/2.0'))
+        frames, consumed = protocol.readFrames(memoryview(data), 1024)
+        self.assertEqual(frames, [(protocol.SEND, b'\0hello'),
+                                  (protocol.COMMAND, b'JOIN #room CHAT/2.0')])
+        self.assertEqual(consumed, len(data))
+
+    def test_partial_header_and_body_wait_for_more(self):
+        frame = protocol.encode(protocol.STATUS, b'200 Joined #room')
+        for cut in (0, 3, protocol.HEADER.size, len(frame) - 1):
+            frames, consumed = protocol.readFrames(memoryview(frame[:cut]), 1024)
+            self.assertEqual((frames, consumed), ([], 0))
+
+    def test_complete_frames_before_a_partial_one_are_read(self):
+        first = protocol.encode(protocol.SEND, b'\0one')
+        second = protocol.encode(protocol.SEND, b'\0two')
+        frames, consumed = protocol.readFrames(memoryview(first + second[:-2]), 1024)
+        self.assertEqual(frames, [(protocol.SEND, b'\0one')])
+        self.assertEqual(consumed, len(first))
+
+    def test_empty_body(self):
+        frames, consumed = protocol.readFrames(memoryview(protocol.encode(protocol.SEND, b'')), 1024)
+        self.assertEqual(frames, [(protocol.SEND, b'')])
+        self.assertEqual(consumed, protocol.HEADER.size)
+
+    def test_oversized_frame_is_refused_from_its_header(self):
+        header = protocol.HEADER.pack(protocol.SEND, 1025)
+        with self.assertRaises(ValueError):
+            protocol.readFrames(memoryview(header), 1024)
+
+    def test_frame_of_the_maximum_size_is_accepted(self):
+        body = b'x' * 1024
+        frames, _ = protocol.readFrames(memoryview(protocol.encode(protocol.SEND, body)), 1024)
+        self.assertEqual(frames, [(protocol.SEND, body)])
+
+
+class SplitFramesTest(unittest.TestCase):
+
+    def test_consumes_complete_frames_and_keeps_the_rest(self):
+        second = protocol.encode(protocol.DELIVER, b'alice\0\0hi')
+        pending = bytearray(protocol.encode(protocol.STATUS, b'200 ok') + second[:4])
+        self.assertEqual(protocol.splitFrames(pending, 1024), [(protocol.STATUS, b'200 ok')])
+        self.assertEqual(pending, second[:4])
+
+        pending += second[4:]
+        self.assertEqual(protocol.splitFrames(pending, 1024), [(protocol.DELIVER, b'alice\0\0hi')])
+        self.assertEqual(pending, b'')
+
+    def test_byte_by_byte_arrival(self):
+        stream = b''.join(protocol.encode(protocol.SEND, b'\0m%d' % n) for n in range(5))
+        pending = bytearray()
+        frames = []
+        for n in range(len(stream)):
+            pending += stream[n:n + 1]
+            frames += protocol.splitFrames(pending, 1024)
+        self.assertEqual(frames, [(protocol.SEND, b'\0m%d' % n) for n in range(5)])
+        self.assertEqual(pending, b'')
+
+    def test_oversized_frame_leaves_the_buffer_alone(self):
+        pending = bytearray(protocol.HEADER.pack(protocol.SEND, 5000))
+        with self.assertRaises(ValueError):
+            protocol.splitFrames(pending, 1024)
+        self.assertEqual(len(pending), protocol.HEADER.size)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+"""Tests for the registration, rate limiting and routing helpers of server.py"""
+
+import unittest
+from unittest import mock
+
+import protocol
+import server
+from tests.test_connections import FakeSocket, registeredRecord
+
+
+class ParseRegistrationTest(unittest.TestCase):
+
+    def test_valid_registration(self):
+        self.assertEqual(server.parseRegistration('REGISTER luca CHAT/1.0', {}),
+                         ('200 Registration successful', 'luca', 'CHAT/1.0', {}))
+        self.assertEqual(server.parseRegistration('REGISTER luca CHAT/2.0 compress=zlib resume=abc', {}),
+                         ('200 Registration successful', 'luca', 'CHAT/2.0',
+                          {'compress': 'zlib', 'resume': 'abc'}))
+
+    def test_taken_nickname(self):
+        self.assertEqual(server.parseRegistration('REGISTER luca CHAT/1.0', {'luca': None}),
+                         ('401 Client already registered', None, None, None))
+
+    def test_invalid_registration(self):
+        for line in ('', 'REGISTER luca', 'HELLO luca CHAT/1.0', 'REGISTER luca CHAT/9.9',
+                     'REGISTER luca CHAT/1.0 compress=lz4', 'REGISTER luca CHAT/1.0 compress',
+                     'REGISTER luca CHAT/1.0 color=red', 'REGISTER luca CHAT/1.0 resume=a resume=b'):
+            self.assertEqual(server.parseRegistration(line, {}),
+                             ('400 Invalid registration', None, None, None), line)
+
+    def test_versions_and_extensions_of_another_engine(self):
+        self.assertEqual(server.parseRegistration('REGISTER luca CHAT/2.0', {}, versions=('CHAT/1.0',))[0],
+                         '400 Invalid registration')
+        self.assertEqual(server.parseRegistration('REGISTER luca CHAT/1.0 compress=zlib', {},
+                                                  extensions={'resume': None})[0],
+                         '400 Invalid registration')
+
+
+class TakeTokensTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        patches = [mock.patch.object(server.time, 'monotonic', lambda: self.now),
+                   mock.patch.object(server, 'options', server.getArgs(
+                       ['--rate-limit', '2', '--rate-burst', '3', '--byte-limit', '100', '--byte-burst', '200']))]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.data = server.Connection(FakeSocket(7), ('127.0.0.1', 40007))
+
+    def test_burst_then_the_rate(self):
+        self.assertEqual([server.takeTokens(self.data, 1) for _ in range(3)], [0, 0, 0])
+        self.assertEqual(server.takeTokens(self.data, 1), 0.5)
+        self.now += 0.5
+        self.assertEqual(server.takeTokens(self.data, 1), 0)
+        self.assertEqual(server.takeTokens(self.data, 1), 0.5)
+
+    def test_message_over_the_limit_takes_nothing(self):
+        for _ in range(3):
+            server.takeTokens(self.data, 1)
+        for _ in range(3):
+            self.assertEqual(server.takeTokens(self.data, 1), 0.5)
+        self.now += 0.5
+        self.assertEqual(server.takeTokens(self.data, 1), 0)
+
+    def test_byte_limit(self):
+        self.assertEqual(server.takeTokens(self.data, 150), 0)
+        self.assertEqual(server.takeTokens(self.data, 100), 0.5)
+        self.now += 0.5
+        self.assertEqual(server.takeTokens(self.data, 100), 0)
+
+    def test_message_larger_than_the_byte_burst_costs_the_burst(self):
+        self.assertEqual(server.takeTokens(self.data, 5000), 0)
+        self.assertEqual(server.takeTokens(self.data, 1), 0.01)
+        self.now += 2
+        self.assertEqual(server.takeTokens(self.data, 5000), 0)
+
+    def test_full_buckets_reset_the_warning(self):
+        for _ in range(3):
+            server.takeTokens(self.data, 1)
+        self.data.limited = True
+        server.takeTokens(self.data, 1)
+        self.assertTrue(self.data.limited)
+        self.now += 10
+        server.takeTokens(self.data, 1)
+        self.assertFalse(self.data.limited)
+
+
+class RouteMessageTest(unittest.TestCase):
+
+    def setUp(self):
+        patch = mock.patch.object(server, 'history', server.History())
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.addCleanup(server.dirty.clear)   # the fake sockets are never flushed
+
+        self.alice = self.connect(20, 'alice')
+        self.bob = self.connect(21, 'bob')
+        self.vee = self.connect(22, 'vee')
+        self.vee.binary = True
+
+    def connect(self, fd, name):
+        data = registeredRecord(server.connectionRegistry, fd, name)
+        self.addCleanup(server.connectionRegistry.remove, data)
+        return data
+
+    def join(self, data, room):
+        server.addMembership(data, room)
+        self.addCleanup(server.dropMembership, data.conn, data, room)
+
+    def route(self, target, message):
+        return server.routeMessage(self.alice.conn, self.alice, target, message)
+
+    def test_broadcast(self):
+        self.assertTrue(self.route(b'', b'hi'))
+        self.assertEqual(self.alice.outbox, [])
+        self.assertEqual(self.bob.outbox, [b'@alice: hi\n'])
+        self.assertEqual(self.vee.outbox, [protocol.encode(protocol.DELIVER, b'alice\0\0hi')])
+        self.assertEqual(server.history.last, 1)
+
+    def test_direct_message(self):
+        self.route(b'@vee', b'psst')
+        self.assertEqual(self.bob.outbox, [])
+        self.assertEqual(self.vee.outbox, [protocol.encode(protocol.DELIVER, b'alice\0@vee\0psst')])
+        self.assertEqual(server.history.last, 0)
+
+    def test_unknown_recipient(self):
+        self.route(b'@nobody', b'psst')
+        self.assertEqual(self.alice.outbox, [b'404 Unknown recipient nobody\n'])
+        self.assertEqual(self.bob.outbox, [])
+
+    def test_room_message_reaches_the_other_members(self):
+        for data in (self.alice, self.bob):
+            self.join(data, '#room')
+        self.route(b'#room', b'hi')
+        self.assertEqual(self.bob.outbox, [b'@alice #room: hi\n'])
+        self.assertEqual((self.alice.outbox, self.vee.outbox), ([], []))
+
+    def test_room_message_from_outside_the_room(self):
+        self.join(self.bob, '#room')
+        self.route(b'#room', b'hi')
+        self.assertEqual(self.alice.outbox, [b'403 Not a member of #room\n'])
+        self.assertEqual(self.bob.outbox, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
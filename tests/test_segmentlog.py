@@ -0,0 +1,141 @@
+"""Tests for the segment log in segmentlog.py"""
+
+import os
+import tempfile
+import time
+import unittest
+
+import segmentlog
+
+
+def body(seq):
+    return b'\0alice\0message %d' % seq
+
+
+def appendEach(log, seqs):
+    """Appends records one batch at a time, so a full segment rotates between them"""
+    for seq in seqs:
+        log.append(seq, body(seq))
+        deadline = time.monotonic() + 5
+        while log.last < seq and time.monotonic() < deadline:
+            time.sleep(0.001)
+
+
+class MessageLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def open(self, **options):
+        log = segmentlog.MessageLog(self.directory.name, fsync='never', **options)
+        self.addCleanup(log.close)
+        return log
+
+    def segmentFiles(self):
+        return sorted(name for name in os.listdir(self.directory.name) if name.endswith('.log'))
+
+    def test_appended_records_are_read_back(self):
+        log = self.open()
+        for seq in range(1, 101):
+            log.append(seq, body(seq))
+        log.close()
+        log = self.open()
+        self.assertEqual(log.first(), 1)
+        self.assertEqual(log.last, 100)
+        self.assertEqual([log.read(seq) for seq in range(1, 101)],
+                         [body(seq) for seq in range(1, 101)])
+        self.assertIsNone(log.read(101))
+
+    def test_segment_rotates_when_full(self):
+        log = self.open(segmentSize=500)
+        appendEach(log, range(1, 101))
+        log.close()
+        self.assertGreater(len(self.segmentFiles()), 1)
+
+        log = self.open(segmentSize=500)
+        self.assertEqual([log.read(seq) for seq in (1, 50, 100)],
+                         [body(1), body(50), body(100)])
+
+    def test_appending_continues_after_reopen(self):
+        log = self.open()
+        for seq in range(1, 11):
+            log.append(seq, body(seq))
+        log.close()
+        log = self.open()
+        for seq in range(1, 21):    # the records already on disk are skipped
+            log.append(seq, body(seq))
+        log.close()
+        log = self.open()
+        self.assertEqual(log.last, 20)
+        self.assertEqual(self.segmentFiles(), ['%020d.log' % 1])
+        self.assertEqual(log.read(15), body(15))
+
+    def test_gap_starts_a_new_segment(self):
+        log = self.open()
+        log.append(1, body(1))
+        log.append(5, body(5))
+        log.close()
+        self.assertEqual(self.segmentFiles(), ['%020d.log' % 1, '%020d.log' % 5])
+        log = self.open()
+        self.assertEqual((log.read(1), log.read(3), log.read(5)), (body(1), None, body(5)))
+
+    def test_torn_tail_is_cut_off(self):
+        log = self.open()
+        for seq in range(1, 11):
+            log.append(seq, body(seq))
+        log.close()
+        path = os.path.join(self.directory.name, self.segmentFiles()[0])
+        with open(path, 'ab') as file:
+            file.write(segmentlog.RECORD.pack(11, 100, 0) + b'torn')
+        log = self.open()
+        self.assertEqual(log.last, 10)
+        self.assertEqual(log.read(10), body(10))
+
+    def test_size_retention_drops_the_oldest_segments(self):
+        log = self.open(segmentSize=500, retainSize=1500)
+        appendEach(log, range(1, 201))
+        log.close()
+        log = self.open(segmentSize=500, retainSize=1500)
+        self.assertGreater(log.first(), 1)
+        self.assertIsNone(log.read(1))
+        self.assertEqual(log.read(200), body(200))
+        total = sum(os.path.getsize(os.path.join(self.directory.name, name))
+                    for name in self.segmentFiles())
+        self.assertLessEqual(total, 1500 + 500 + segmentlog.RECORD.size + len(body(200)))
+
+    def test_age_retention_drops_old_segments_on_rotation(self):
+        log = self.open(segmentSize=500)
+        appendEach(log, range(1, 21))
+        log.close()
+        past = time.time() - 3600
+        for name in self.segmentFiles():
+            os.utime(os.path.join(self.directory.name, name), (past, past))
+
+        log = self.open(segmentSize=500, retainAge=60)
+        appendEach(log, range(21, 41))
+        log.close()
+        log = self.open(segmentSize=500, retainAge=60)
+        self.assertIsNone(log.read(1))
+        self.assertEqual(log.read(40), body(40))
+
+    def test_age_retention_applies_to_an_idle_log(self):
+        log = self.open(segmentSize=500)
+        appendEach(log, range(1, 41))
+        log.close()
+        files = self.segmentFiles()
+        past = time.time() - 3600
+        for name in files[:-1]:
+            os.utime(os.path.join(self.directory.name, name), (past, past))
+
+        log = self.open(segmentSize=500, retainAge=0.1)
+        newest = int(files[-1][:-len('.log')])
+        deadline = time.monotonic() + 5
+        while log.first() < newest and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.segmentFiles(), files[-1:])
+        self.assertEqual(log.read(40), body(40))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,311 @@
+"""Tests for the handshake and message handling of server.py
+
+Each test connects through a socket pair. The test writes to one end and
+runs the server's handler for the other end, the way the event loop would,
+then reads what the server answered.
+"""
+
+import selectors
+import socket
+import time
+import types
+import unittest
+from unittest import mock
+
+import compression
+import protocol
+import server
+
+
+class ServerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        patch = mock.patch.object(server.log, 'log')    # keeps the output quiet
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def connect(self):
+        """Opens a connection the server has just accepted
+
+        Returns:
+            [socket]: the client's end
+            [Connection]: the server's record of the other end
+        """
+        conn, peer = socket.socketpair()
+        conn.setblocking(False)
+        peer.settimeout(1)
+        data = server.Connection(conn, ('127.0.0.1', conn.fileno()))
+        server.connectionRegistry.add(data)
+        server.sel.register(conn, selectors.EVENT_READ, data=data)
+        self.addCleanup(peer.close)
+        self.addCleanup(server.disconnectClient, conn, data)
+        return peer, data
+
+    def register(self, name, version='CHAT/1.0'):
+        peer, data = self.connect()
+        self.send(peer, data, f'REGISTER {name} {version}\n'.encode())
+        self.assertEqual(self.received(peer), b'200 Registration successful\n')
+        return peer, data
+
+    def send(self, peer, data, raw):
+        """Sends bytes to the server and lets it handle them"""
+        peer.sendall(raw)
+        server.performService(types.SimpleNamespace(fileobj=data.conn, data=data))
+        server.flushPending()
+
+    def received(self, peer):
+        """Returns everything the server sent so far, b'' once it closed the connection"""
+        peer.setblocking(False)
+        chunks = []
+        try:
+            while True:
+                chunk = peer.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        except BlockingIOError:
+            pass
+        peer.settimeout(1)
+        return b''.join(chunks)
+
+
+class RegistrationTest(ServerTestCase):
+
+    def test_registration(self):
+        peer, data = self.register('alice')
+        self.assertIs(server.clients['alice'], data)
+
+    def test_invalid_registration_is_refused(self):
+        for line in (b'HELLO alice CHAT/1.0\n', b'REGISTER alice CHAT/9.9\n',
+                     b'REGISTER alice CHAT/1.0 compress=lz4\n'):
+            peer, data = self.connect()
+            self.send(peer, data, line)
+            self.assertEqual(self.received(peer), b'400 Invalid registration\n')
+            self.assertTrue(data.closed)
+
+    def test_registration_that_is_not_utf8_is_refused(self):
+        peer, data = self.connect()
+        self.send(peer, data, b'REGISTER \xff CHAT/1.0\n')
+        self.assertEqual(self.received(peer), b'400 Invalid registration\n')
+        self.assertTrue(data.closed)
+        self.assertNotIn('�', server.clients)
+
+    def test_messages_sent_while_claiming_are_capped(self):
+        patches = [mock.patch.object(server, 'busLink', mock.Mock()), mock.patch.object(server, 'sendBus')]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.addCleanup(server.claims.pop, 'alice', None)
+
+        peer, data = self.connect()
+        self.send(peer, data, b'REGISTER alice CHAT/1.0\n@alice: hi\n')
+        self.assertEqual(data.state, 'claiming')
+        for _ in range(4):
+            self.send(peer, data, b'a' * 16000)
+        self.assertFalse(data.closed)
+        self.send(peer, data, b'a' * 16000)
+        self.assertTrue(data.closed)
+
+    def test_taken_nickname_is_refused(self):
+        self.register('alice')
+        peer, data = self.connect()
+        self.send(peer, data, b'REGISTER alice CHAT/1.0\n')
+        self.assertEqual(self.received(peer), b'401 Client already registered\n')
+
+
+class RoomAndCommandTest(ServerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.alice, self.aliceData = self.register('alice')
+        self.bob, self.bobData = self.register('bob')
+
+    def test_room_message_reaches_members_only(self):
+        carol, _ = self.register('carol')
+        for peer, data in ((self.alice, self.aliceData), (self.bob, self.bobData)):
+            self.send(peer, data, 'JOIN #café CHAT/1.0\n'.encode())
+            self.assertEqual(self.received(peer), '200 Joined #café\n'.encode())
+        self.send(self.alice, self.aliceData, '@alice #café: bonjour\n'.encode())
+        self.assertEqual(self.received(self.bob), '@alice #café: bonjour\n'.encode())
+        self.assertEqual(self.received(carol), b'')
+
+    def test_join_of_a_room_that_is_not_utf8_is_refused(self):
+        self.send(self.alice, self.aliceData, b'JOIN #\xff CHAT/1.0\n')
+        self.assertEqual(self.received(self.alice), b'400 Invalid UTF-8\n')
+        self.assertEqual(self.aliceData.rooms, server.NO_ROOMS)
+
+    def test_room_message_to_a_room_that_is_not_utf8_is_refused(self):
+        self.send(self.alice, self.aliceData, b'@alice #\xff: hi\n')
+        self.assertEqual(self.received(self.alice), b'400 Invalid UTF-8\n')
+        self.assertEqual(self.received(self.bob), b'')
+
+    def test_command_that_is_not_utf8_is_refused(self):
+        for line in (b'JOIN \xff CHAT/1.0\n', b'HISTORY SEARCH \xfe CHAT/1.0\n',
+                     b'LEAVE #r\xc3 CHAT/1.0\n'):
+            self.send(self.alice, self.aliceData, line)
+            self.assertEqual(self.received(self.alice), b'400 Invalid UTF-8\n')
+        self.assertFalse(self.aliceData.closed)
+
+    def test_messages_after_an_invalid_one_are_still_handled(self):
+        self.send(self.alice, self.aliceData, b'JOIN \xff CHAT/1.0\n@alice: hello\n')
+        self.assertEqual(self.received(self.alice), b'400 Invalid UTF-8\n')
+        self.assertEqual(self.received(self.bob), b'@alice: hello\n')
+
+
+class BroadcastTest(ServerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.alice, self.aliceData = self.register('alice')
+        self.bob, self.bobData = self.register('bob')
+
+    def test_broadcast_reaches_everyone_but_the_sender(self):
+        vee, _ = self.register('vee', 'CHAT/2.0')
+        self.send(self.alice, self.aliceData, '@alice: café\n'.encode())
+        self.assertEqual(self.received(self.bob), '@alice: café\n'.encode())
+        self.assertEqual(self.received(vee),
+                         protocol.encode(protocol.DELIVER, 'alice\0\0café'.encode()))
+        self.assertEqual(self.received(self.alice), b'')
+
+    def test_line_without_a_separator_is_refused(self):
+        for line in (b'hello\n', b'@alice hello\n', b'@alice:hello\n'):
+            self.send(self.alice, self.aliceData, line)
+            self.assertEqual(self.received(self.alice), b'400 Malformed message\n')
+        self.assertEqual(self.received(self.bob), b'')
+
+    def test_empty_text_is_relayed(self):
+        self.send(self.alice, self.aliceData, b'@alice: \n')
+        self.assertEqual(self.received(self.bob), b'@alice: \n')
+
+    def test_send_frame_without_a_target_is_refused(self):
+        vee, veeData = self.register('vee', 'CHAT/2.0')
+        self.send(vee, veeData, protocol.encode(protocol.SEND, b'hello'))
+        self.assertEqual(self.received(vee), protocol.encode(protocol.STATUS, b'400 Malformed message'))
+        self.assertEqual(self.received(self.bob), b'')
+
+    def test_text_that_is_not_utf8_is_not_relayed(self):
+        self.send(self.alice, self.aliceData, b'@alice: caf\xe9\n')
+        self.assertEqual(self.received(self.alice), b'400 Invalid UTF-8\n')
+        self.assertEqual(self.received(self.bob), b'')
+
+    def test_binary_text_that_is_not_utf8_is_not_relayed(self):
+        vee, veeData = self.register('vee', 'CHAT/2.0')
+        self.send(vee, veeData, protocol.encode(protocol.SEND, b'\0caf\xe9'))
+        self.assertEqual(self.received(vee), protocol.encode(protocol.STATUS, b'400 Invalid UTF-8'))
+        self.assertEqual(self.received(self.bob), b'')
+
+
+class DirectMessageTest(ServerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.alice, self.aliceData = self.register('alice')
+        self.bob, self.bobData = self.register('bob')
+
+    def test_direct_message_reaches_the_recipient_only(self):
+        carol, _ = self.register('carol')
+        self.send(self.alice, self.aliceData, b'@alice @bob: psst\n')
+        self.assertEqual(self.received(self.bob), b'@alice @bob: psst\n')
+        self.assertEqual(self.received(carol), b'')
+
+    def test_unknown_recipient(self):
+        self.send(self.alice, self.aliceData, b'@alice @nobody: psst\n')
+        self.assertEqual(self.received(self.alice), b'404 Unknown recipient nobody\n')
+
+    def test_recipient_that_is_not_utf8_is_refused(self):
+        self.send(self.alice, self.aliceData, b'@alice @\xff: hi\n')
+        self.assertEqual(self.received(self.alice), b'400 Invalid UTF-8\n')
+        self.assertEqual(self.received(self.bob), b'')
+
+    def test_binary_recipient_that_is_not_utf8_is_refused(self):
+        vee, veeData = self.register('vee', 'CHAT/2.0')
+        self.send(vee, veeData, protocol.encode(protocol.SEND, b'@\xff\0hi'))
+        self.assertEqual(self.received(vee), protocol.encode(protocol.STATUS, b'400 Invalid UTF-8'))
+        self.send(vee, veeData, protocol.encode(protocol.SEND, b'@bob\0hi'))
+        self.assertEqual(self.received(self.bob), b'@vee @bob: hi\n')
+
+
+class BinaryCommandTest(ServerTestCase):
+
+    def test_command_frame(self):
+        vee, veeData = self.register('vee', 'CHAT/2.0')
+        self.send(vee, veeData, protocol.encode(protocol.COMMAND, b'JOIN #room CHAT/2.0'))
+        self.assertEqual(self.received(vee), protocol.encode(protocol.STATUS, b'200 Joined #room'))
+
+    def test_command_frame_that_is_not_utf8_is_refused(self):
+        vee, veeData = self.register('vee', 'CHAT/2.0')
+        self.send(vee, veeData, protocol.encode(protocol.COMMAND, b'JOIN #\xff CHAT/2.0'))
+        self.assertEqual(self.received(vee), protocol.encode(protocol.STATUS, b'400 Invalid UTF-8'))
+        self.assertFalse(veeData.closed)
+
+
+class CompressionTest(ServerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.bob, self.bobData = self.register('bob')
+        self.alice, self.aliceData = self.connect()
+        self.send(self.alice, self.aliceData, b'REGISTER alice CHAT/1.0 compress=zlib\n')
+        self.assertEqual(self.received(self.alice), b'200 Registration successful\n')
+        self.stream = compression.Stream()
+
+        # how much decompressed text the reader holds whenever it is split into messages
+
+        self.buffered = []
+        frames = server.FrameReader.frames
+
+        def measured(reader):
+            self.buffered.append(len(reader.pending))
+            return frames(reader)
+
+        patch = mock.patch.object(server.FrameReader, 'frames', measured)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_burst_is_relayed_a_step_at_a_time(self):
+        lines = [b'@alice: the same line over and over\n'] * 5000
+        self.send(self.alice, self.aliceData, self.stream.compress(lines))
+        relayed = bytearray()
+        while len(relayed) < len(lines) * len(lines[0]):
+            chunk = self.bob.recv(65536)
+            self.assertTrue(chunk)
+            relayed += chunk
+            server.flushClient(self.bobData.conn, self.bobData)   # as on EVENT_WRITE
+        self.assertEqual(relayed, b''.join(lines))
+        self.assertGreater(len(self.buffered), 1)
+        self.assertLessEqual(max(self.buffered), server.MAX_INFLATE + len(lines[0]))
+
+    def test_decompression_bomb_is_disconnected(self):
+        bomb = self.stream.compress([b'@alice: ' + b'a' * (10 * 1024 * 1024)])
+        self.send(self.alice, self.aliceData, bomb)
+        self.assertTrue(self.aliceData.closed)
+        self.assertLessEqual(max(self.buffered), server.MAX_FRAME_SIZE + server.MAX_INFLATE)
+        self.assertEqual(self.received(self.bob), b'')
+
+
+class AdminTest(ServerTestCase):
+
+    def test_idle_scrape_is_closed(self):
+        listener = socket.create_server(('127.0.0.1', 0))
+        self.addCleanup(listener.close)
+        patch = mock.patch.object(server, 'adminServer', listener)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+        scraper = socket.create_connection(listener.getsockname())
+        self.addCleanup(scraper.close)
+        server.acceptAdmin()
+        data = next(key.data for key in server.sel.get_map().values()
+                    if key.data is not None and key.data.state == 'admin')
+        self.addCleanup(server.disconnectClient, data.conn, data)
+
+        server.wheel.advance(time.monotonic() + server.options.handshake_timeout / 2)
+        self.assertFalse(data.closed)
+        server.wheel.advance(time.monotonic() + server.options.handshake_timeout + 1)
+        self.assertTrue(data.closed)
+        scraper.settimeout(1)
+        self.assertEqual(scraper.recv(1), b'')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+"""Tests for the hierarchical timer wheel in timerwheel.py"""
+
+import random
+import unittest
+
+import timerwheel
+
+
+class TimerWheelTest(unittest.TestCase):
+
+    def setUp(self):
+        # small wheels so that a few hundred ticks cross every level: 4, 16 and 64 ticks
+        self.wheel = timerwheel.TimerWheel(0.0, tick=1.0, slots=4, levels=3)
+        self.fired = []
+
+    def fire(self, name):
+        self.fired.append((name, self.wheel.current))
+
+    def tickFor(self, ticks):
+        for now in range(self.wheel.current + 1, self.wheel.current + ticks + 1):
+            self.wheel.advance(float(now))
+
+    def test_fires_once_the_delay_has_passed(self):
+        self.wheel.schedule(3, self.fire, 'a')
+        self.wheel.advance(2.9)
+        self.assertEqual(self.fired, [])
+        self.wheel.advance(3.0)
+        self.assertEqual(self.fired, [('a', 3)])
+        self.assertEqual(self.wheel.count, 0)
+
+    def test_delay_rounds_up_to_a_whole_tick(self):
+        self.wheel.schedule(0, self.fire, 'now')
+        self.wheel.schedule(1.5, self.fire, 'later')
+        self.tickFor(2)
+        self.assertEqual(self.fired, [('now', 1), ('later', 2)])
+
+    def test_cascade_across_levels(self):
+        delays = [1, 3, 4, 5, 15, 16, 17, 40, 63, 64, 65, 200, 1000]
+        for delay in delays:
+            self.wheel.schedule(delay, self.fire, delay)
+        self.tickFor(1000)
+        self.assertEqual(self.fired, [(delay, delay) for delay in delays])
+
+    def test_cascade_from_any_starting_tick(self):
+        expected = []
+        rng = random.Random(3357)
+        for start in range(0, 70, 7):
+            self.tickFor(start - self.wheel.current)
+            for _ in range(20):
+                delay = rng.randint(1, 150)
+                self.wheel.schedule(delay, self.fire, len(expected))
+                expected.append((len(expected), start + delay))
+        self.tickFor(300)
+        self.assertEqual(sorted(self.fired, key=lambda fired: fired[0]), expected)
+
+    def test_advance_can_skip_ticks(self):
+        for delay in (2, 30, 90):
+            self.wheel.schedule(delay, self.fire, delay)
+        self.wheel.advance(100.0)
+        self.assertEqual([name for name, _ in self.fired], [2, 30, 90])
+
+    def test_cancel(self):
+        keep = self.wheel.schedule(20, self.fire, 'keep')
+        drop = self.wheel.schedule(20, self.fire, 'drop')
+        far = self.wheel.schedule(100, self.fire, 'far')
+        self.wheel.cancel(drop)
+        self.tickFor(30)
+        self.wheel.cancel(far)    # after it cascaded down a level
+        self.wheel.cancel(keep)   # after it fired, nothing happens
+        self.wheel.cancel(None)
+        self.tickFor(100)
+        self.assertEqual(self.fired, [('keep', 20)])
+        self.assertEqual(self.wheel.count, 0)
+
+    def test_reschedule_from_the_callback(self):
+        def again(remaining):
+            self.fire(remaining)
+            if remaining:
+                self.wheel.schedule(5, again, remaining - 1)
+
+        self.wheel.schedule(5, again, 3)
+        self.tickFor(40)
+        self.assertEqual(self.fired, [(3, 5), (2, 10), (1, 15), (0, 20)])
+
+    def test_reschedule_by_cancelling(self):
+        timer = self.wheel.schedule(10, self.fire, 'idle')
+        for _ in range(5):  # activity keeps pushing the timeout back
+            self.tickFor(6)
+            self.wheel.cancel(timer)
+            timer = self.wheel.schedule(10, self.fire, 'idle')
+        self.tickFor(20)
+        self.assertEqual(self.fired, [('idle', 40)])
+
+    def test_advance_returns_the_time_until_the_next_timer(self):
+        self.assertIsNone(self.wheel.advance(0.0))
+        self.wheel.schedule(2, self.fire, 'a')
+        self.assertEqual(self.wheel.advance(0.5), 1.5)
+        self.assertEqual(self.wheel.advance(2.0), None)
+
+    def test_next_timeout_never_passes_a_cascade(self):
+        self.wheel.schedule(50, self.fire, 'far')
+        now = 0.0
+        timeout = self.wheel.advance(now)
+        while timeout is not None:
+            self.assertLessEqual(timeout, self.wheel.slots)
+            now += timeout
+            timeout = self.wheel.advance(now)
+        self.assertEqual(self.fired, [('far', 50)])
+
+
+if __name__ == '__main__':
+    unittest.main()
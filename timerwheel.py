@@ -0,0 +1,158 @@
+"""Hierarchical timer wheel, the server's notion of time
+
+Timers are kept in LEVELS wheels of SLOTS slots each. A slot of the first
+wheel covers one tick, a slot of the next wheel covers SLOTS ticks, and so
+on, so four wheels of 64 slots at 0.1 second ticks reach about 19 days
+ahead. Scheduling and cancelling a timer is O(1). Every tick the event loop
+fires the slot of the current tick, and every SLOTS ticks the next slot of
+the wheel above is cascaded into the ones below. The work per tick depends
+on the timers that are due, not on how many timers exist.
+"""
+
+import math
+
+TICK = 0.1
+SLOTS = 64
+LEVELS = 4
+
+
+class Timer:
+    """A scheduled call, returned by TimerWheel.schedule to cancel it"""
+
+    __slots__ = ('expires', 'callback', 'args', 'slot')
+
+    def __init__(self, expires, callback, args):
+        self.expires = expires  # the tick the timer fires at
+        self.callback = callback
+        self.args = args
+        self.slot = None        # the set the timer is waiting in
+
+
+class TimerWheel:
+    """Fires callbacks after a delay, at the resolution of a tick"""
+
+    def __init__(self, now, tick=TICK, slots=SLOTS, levels=LEVELS):
+        """Creates the wheels
+
+        Args:
+            now (float): the current time.monotonic()
+            tick (float): seconds per tick
+            slots (int): slots per wheel
+            levels (int): number of wheels
+        """
+        self.start = now
+        self.tick = tick
+        self.slots = slots
+        self.spans = [slots ** level for level in range(levels)]  # ticks per slot
+        self.wheels = [[set() for _ in range(slots)] for _ in range(levels)]
+        self.current = 0    # the last tick that was processed
+        self.count = 0      # timers scheduled and not fired or cancelled
+
+    def schedule(self, delay, callback, *args):
+        """Calls callback(*args) once delay seconds have passed
+
+        Args:
+            delay (float): seconds from now, rounded up to whole ticks
+            callback (function): the function to call
+            args: its arguments
+
+        Returns:
+            [Timer]: the timer, to cancel it
+        """
+        timer = Timer(self.current + max(1, math.ceil(delay / self.tick)), callback, args)
+        self.place(timer)
+        self.count += 1
+        return timer
+
+    def cancel(self, timer):
+        """Cancels a timer, if it did not fire yet
+
+        Args:
+            timer (Timer): the timer returned by schedule
+        """
+        if timer is not None and timer.slot is not None:
+            timer.slot.discard(timer)
+            timer.slot = None
+            self.count -= 1
+
+    def place(self, timer):
+        """Puts a timer in the slot of the lowest wheel that reaches its tick
+
+        Args:
+            timer (Timer): the timer
+        """
+        expires = max(timer.expires, self.current)
+        delta = expires - self.current
+
+        level = 0
+        while level + 1 < len(self.spans) and delta >= self.spans[level] * self.slots:
+            level += 1
+
+        # beyond the top wheel, wait in its farthest slot and cascade down from there
+
+        span = self.spans[level]
+        if delta >= span * self.slots:
+            expires = self.current + span * (self.slots - 1)
+
+        timer.slot = self.wheels[level][(expires // span) % self.slots]
+        timer.slot.add(timer)
+
+    def advance(self, now):
+        """Fires the timers that are due
+
+        Args:
+            now (float): the current time.monotonic()
+
+        Returns:
+            [float]: seconds until the loop should call advance again, None
+            if no timer is scheduled
+        """
+        target = int((now - self.start) / self.tick)
+
+        if not self.count:
+            self.current = max(self.current, target)
+            return None
+
+        while self.current < target:
+            self.current += 1
+
+            for level in range(1, len(self.spans)):
+                span = self.spans[level]
+                if self.current % span:
+                    break
+                slot = self.wheels[level][(self.current // span) % self.slots]
+                waiting = list(slot)
+                slot.clear()
+                for timer in waiting:
+                    self.place(timer)
+
+            slot = self.wheels[0][self.current % self.slots]
+            for timer in list(slot):
+                if timer.slot is slot and timer.expires <= self.current:
+                    slot.discard(timer)
+                    timer.slot = None
+                    self.count -= 1
+                    timer.callback(*timer.args)
+
+        return self.untilNext(now)
+
+    def untilNext(self, now):
+        """Returns the seconds until the next tick with something to do
+
+        Only the rest of the first wheel's turn is looked at, the end of
+        the turn is when the wheels above cascade.
+
+        Args:
+            now (float): the current time.monotonic()
+
+        Returns:
+            [float]: seconds, None if no timer is scheduled
+        """
+        if not self.count:
+            return None
+        ticks = self.slots - self.current % self.slots
+        for ahead in range(1, ticks):
+            if self.wheels[0][(self.current + ahead) % self.slots]:
+                ticks = ahead
+                break
+        return max(0, self.start + (self.current + ticks) * self.tick - now)
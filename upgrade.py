@@ -0,0 +1,84 @@
+"""Hands a running server's sockets over to a freshly started server process
+
+On SIGUSR2 the running server starts a new process of itself with one end
+of a Unix domain socket pair. Once the new process is up it says READY, and
+the old one sends, in this order:
+
+    STATE        the history as JSON, with the listening sockets attached
+    CONNECTIONS  the records of up to FDS_PER_MESSAGE connections as JSON,
+                 with their sockets attached, as many of them as needed
+    DONE         nothing follows
+
+The sockets travel as SCM_RIGHTS ancillary data, so the kernel duplicates
+the file descriptors into the new process and the connections never close.
+The new process answers TAKEN once it adopted everything, and the old one
+closes its copies and exits.
+
+Messages on the link are framed like the bus: a one-byte message kind and
+a four-byte payload length, followed by the payload.
+"""
+
+import socket
+
+from protocol import HEADER, encode
+
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+FDS_PER_MESSAGE = 200       # the kernel passes at most 253 descriptors per message
+
+# message kinds
+READY = 1           # new -> old: started, send everything over
+STATE = 2           # old -> new: the server's state, the listening sockets attached
+CONNECTIONS = 3     # old -> new: connection records, their sockets attached
+DONE = 4            # old -> new: that was everything
+TAKEN = 5           # new -> old: adopted everything, close your copies and exit
+
+
+def sendMessage(sock, kind, payload=b'', fds=()):
+    """Sends a message, with file descriptors attached if there are any
+
+    Args:
+        sock (socket object): the blocking upgrade link
+        kind (int): the message kind
+        payload (bytes): the message
+        fds (list): file descriptors to pass along
+    """
+    frame = encode(kind, payload)
+    sent = socket.send_fds(sock, [frame], list(fds)) if fds else 0
+    sock.sendall(memoryview(frame)[sent:])
+
+
+def receiveMessage(sock):
+    """Receives a message and the file descriptors that came with it
+
+    Every read asks for ancillary data, descriptors that arrive on a read
+    that does not would be closed by the kernel.
+
+    Args:
+        sock (socket object): the blocking upgrade link
+
+    Raises:
+        ConnectionError: if the other process went away
+        ValueError: if the message is larger than MAX_MESSAGE_SIZE
+
+    Returns:
+        [int]: the message kind
+        [bytes]: the payload
+        [list]: the file descriptors received
+    """
+    fds = []
+
+    def receive(size):
+        chunks = []
+        while size:
+            chunk, received, _, _ = socket.recv_fds(sock, size, FDS_PER_MESSAGE)
+            fds.extend(received)
+            if not chunk:
+                raise ConnectionError('the upgrade link closed')
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    kind, length = HEADER.unpack(receive(HEADER.size))
+    if length > MAX_MESSAGE_SIZE:
+        raise ValueError('upgrade message exceeds MAX_MESSAGE_SIZE')
+    return kind, receive(length), fds